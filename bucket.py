@@ -28,7 +28,18 @@ from lib.models.nn import NN
 
 #***************************************************************
 class Bucket(Configurable):
-  """"""
+  """
+    Stores its sentences ragged and only pads them out to a
+    (n_sents x size x width) cube for the minibatches that are asked for.
+    Each sentence keeps its token rows in one flat int32 array; trailing
+    columns that only repeat a single value (the 'O' padding after the real
+    SRL columns) are stored as a count and that value. The words are kept in
+    one byte array per bucket. A whole buffer of sentences can be kept in one
+    unbounded (size -1) bucket and the sized buckets filled from it in slices.
+  """
+  
+  # the arrays a finalized bucket is made of, as saved by the data cache
+  ARRAYS = ('values', 'lens', 'widths', 'n_stored', 'fills', 'sent_offsets', 'word_table')
   
   #=============================================================
   def __init__(self, *args, **kwargs):
@@ -45,29 +56,43 @@ class Bucket(Configurable):
     """"""
     
     self._size = size
+    self._data = []
+    self._sents = []
+    self._finalized = False
     if pad:
-      self._data = [(0,)]
-      self._sents = [('',)]
-    else:
-      self._data = []
-      self._sents = []
+      self._append([''], np.zeros((1, 1), dtype=np.int32))
     return
   
   #=============================================================
   def add(self, sent):
     """"""
     
-    if isinstance(self._data, np.ndarray):
+    if self._finalized:
       raise TypeError("The buckets have already been finalized, you can't add more")
     if len(sent) > self.size and self.size != -1:
       raise ValueError('Bucket of size %d received sequence of len %d' % (self.size, len(sent)))
     
-    # words = [word[0] for word in sent][1:] # remove root
-    # idxs = [word[1:] for word in sent]
-    words = [word[0] for word in sent]
-    idxs = [word[1:] for word in sent]
+    if isinstance(sent, np.ndarray):
+      words = list(sent[:,0])
+      idxs = sent[:,1:].astype(np.int32)
+    else:
+      words = [word[0] for word in sent]
+      idxs = np.array([word[1:] for word in sent], dtype=np.int32)
+    return self._append(words, idxs)
+  
+  #=============================================================
+  def _append(self, words, idxs):
+    """"""
+    
+    sent_len, width = idxs.shape
+    fill = 0
+    n_stored = width
+    if sent_len and width:
+      fill = idxs[0, -1]
+      is_fill = np.all(idxs == fill, axis=0)[::-1]
+      n_stored = width - (np.argmin(is_fill) if not np.all(is_fill) else width)
     self._sents.append(words)
-    self._data.append(idxs)
+    self._data.append((np.ascontiguousarray(idxs[:,:n_stored]), width, fill))
     return len(self._data)-1
   
   #=============================================================
@@ -77,35 +102,115 @@ class Bucket(Configurable):
     if self._data is None:
       raise ValueError('You need to reset the Buckets before finalizing them')
     
-    if len(self._data) > 0:
-      lens = map(len, [item for sublist in self._data for item in sublist])
-      max_len = max(lens)
-      shape = (len(self._data), self.size, max_len)
-      data = np.zeros(shape, dtype=np.int32)
-
-      # if len(self._data) == 416:
-      #   print("lens", lens)
-      #   print("max_len", max_len)
-      #   print("data shape", shape)
-      #   print("self._data", len(self._data), len(self._data[-1]), len(self._data[-1][-1]))
-
-      for i, datum in enumerate(self._data):
-        # if len(self._data) == 416:
-          # print("datum", datum)
-          # print("datum shape", datum.shape)
-          # print("datum len", len(datum))
-        datum = np.array(datum)
-        data[i, :datum.shape[0], :datum.shape[1]] = datum
-      self._data = data
-      self._sents = np.array(self._sents)
+    if self._data:
+      values = np.concatenate([idxs.ravel() for idxs, _, _ in self._data])
     else:
-      self._data = np.zeros((0, 1), dtype=np.float32)
-      self._sents = np.zeros((0, 1), dtype=str)
-    print('Bucket %s is %d x %d' % ((self._name,) + self._data.shape[0:2]))
+      values = np.zeros(0, dtype=np.int32)
+    sent_strs = [' '.join(words) + '\n' for words in self._sents]
+    self._set_arrays(values=values,
+                     lens=np.array([len(words) for words in self._sents], dtype=np.int32),
+                     widths=np.array([width for _, width, _ in self._data], dtype=np.int32),
+                     n_stored=np.array([idxs.shape[1] for idxs, _, _ in self._data], dtype=np.int32),
+                     fills=np.array([fill for _, _, fill in self._data], dtype=np.int32),
+                     sent_offsets=np.cumsum([0] + [len(sent_str) for sent_str in sent_strs], dtype=np.int64),
+                     word_table=np.frombuffer(''.join(sent_strs), dtype=np.uint8))
+    print('Bucket %s is %d x %d' % (self._name, len(self), self.size))
+    return
+  
+  #=============================================================
+  def _set_arrays(self, values, lens, widths, n_stored, fills, sent_offsets, word_table):
+    """"""
+    
+    # word_table holds each sentence's words joined by spaces and ended by a
+    # newline; sentence i is word_table[sent_offsets[i]:sent_offsets[i+1]]
+    self._values = values
+    self._lens = lens
+    self._widths = widths
+    self._n_stored = n_stored
+    self._fills = fills
+    self._sent_offsets = sent_offsets
+    self._word_table = word_table
+    self._n_sents = len(lens)
+    self._max_width = max(np.max(widths), 1) if self._n_sents else 1
+    n_values = lens.astype(np.int64) * n_stored
+    self._offsets = np.cumsum(n_values) - n_values
+    self._data = None
+    self._sents = None
+    self._finalized = True
+    return
+  
+  #=============================================================
+  def fill(self, bucket, idxs):
+    """
+      Finalizes the bucket with sentences idxs of the finalized bucket, taking
+      their values and words over in a few slices rather than one by one.
+    """
+    
+    if np.any(bucket._lens[idxs] > self.size) and self.size != -1:
+      raise ValueError('Bucket of size %d received sequence of len %d' % (self.size, np.max(bucket._lens[idxs])))
+    
+    n_values = bucket._lens[idxs].astype(np.int64) * bucket._n_stored[idxs]
+    sent_lens = bucket._sent_offsets[idxs+1] - bucket._sent_offsets[idxs]
+    self._set_arrays(values=gather(bucket._values, bucket._offsets[idxs], n_values),
+                     lens=bucket._lens[idxs],
+                     widths=bucket._widths[idxs],
+                     n_stored=bucket._n_stored[idxs],
+                     fills=bucket._fills[idxs],
+                     sent_offsets=np.concatenate([[0], np.cumsum(sent_lens)]),
+                     word_table=gather(bucket._word_table, bucket._sent_offsets[idxs], sent_lens))
+    print('Bucket %s is %d x %d' % (self._name, len(self), self.size))
     return
   
+  #=============================================================
+  def get_field(self, field):
+    """"""
+    
+    # field `field` of every token (data[:,:,field] without the padding)
+    sent_idxs = np.repeat(np.arange(self._n_sents), self._lens)
+    rows = np.arange(len(sent_idxs)) - np.repeat(np.cumsum(self._lens) - self._lens, self._lens)
+    is_stored = field < self._n_stored[sent_idxs]
+    values = np.array(self._fills[sent_idxs])
+    values[is_stored] = self._values[(self._offsets[sent_idxs] + rows * self._n_stored[sent_idxs] + field)[is_stored]]
+    return values
+  
+  #=============================================================
+  def get_data(self, idxs):
+    """"""
+    
+    if np.isscalar(idxs):
+      return self.get_data([idxs])[0]
+    
+    data = np.zeros((len(idxs), self.size, self._max_width), dtype=np.int32)
+    for i, idx in enumerate(idxs):
+      sent_len, n_stored, width = self._lens[idx], self._n_stored[idx], self._widths[idx]
+      offset = self._offsets[idx]
+      data[i, :sent_len, :n_stored] = self._values[offset:offset+sent_len*n_stored].reshape(sent_len, n_stored)
+      data[i, :sent_len, n_stored:width] = self._fills[idx]
+    return data
+  
+  #=============================================================
+  def get_sents(self, idxs):
+    """"""
+    
+    if np.isscalar(idxs):
+      return self.get_sents([idxs])[0]
+    
+    sents = []
+    for idx in idxs:
+      sent_str = self._word_table[self._sent_offsets[idx]:self._sent_offsets[idx+1]-1].tostring()
+      sents.append(sent_str.split(' ') if self._lens[idx] else [])
+    return sents
+  
+  #=============================================================
+  def get_lens(self, idxs):
+    """"""
+    
+    return self._lens[idxs]
+  
   #=============================================================
   def __len__(self):
+    if self._finalized:
+      return self._n_sents
     return len(self._data)
   
   #=============================================================
@@ -113,8 +218,41 @@ class Bucket(Configurable):
   def size(self):
     return self._size
   @property
-  def data(self):
-    return self._data
+  def arrays(self):
+    return dict((name, getattr(self, '_' + name)) for name in self.ARRAYS)
   @property
-  def sents(self):
-    return self._sents
+  def nbytes(self):
+    return sum(array.nbytes for array in self.arrays.values()) + self._offsets.nbytes
+
+#***************************************************************
+def gather(array, starts, lens):
+  """"""
+  
+  # the concatenation of array[start:start+len] for each start and len
+  lens = np.asarray(lens, dtype=np.int64)
+  ends = np.cumsum(lens)
+  return array[np.repeat(starts - (ends - lens), lens) + np.arange(ends[-1] if len(ends) else 0)]
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+  
+  # compare the ragged storage of a bucket of CoNLL-2012 style sentences
+  # (9 token fields plus one srl column per token, mostly 'O' padding)
+  # against the zero-padded cube it used to be stored as
+  size = 60
+  bucket = Bucket()
+  bucket.reset(size)
+  for i in xrange(2000):
+    sent_len = np.random.randint(40, size+1)
+    n_preds = np.random.randint(0, 6)
+    sent = np.empty((sent_len, 10+sent_len), dtype=object)
+    sent[:,0] = ['word%d' % np.random.randint(10000) for j in xrange(sent_len)]
+    sent[:,1:10] = np.random.randint(1, 100, size=(sent_len, 9))
+    sent[:,10:] = 3
+    sent[:,10:10+n_preds] = np.random.randint(1, 30, size=(sent_len, n_preds))
+    bucket.add(sent)
+  bucket._finalize()
+  dense_bytes = len(bucket) * size * (9+size) * 4
+  print('dense cube: %.1f MB' % (dense_bytes / 2**20))
+  print('ragged:     %.1f MB' % (bucket.nbytes / 2**20))
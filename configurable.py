@@ -24,7 +24,65 @@ import argparse
 import numpy as np
 import tensorflow as tf
 
-from ConfigParser import SafeConfigParser
+from ConfigParser import SafeConfigParser, Error as ConfigParserError
+
+#***************************************************************
+class ConfigSnapshot(object):
+  """"""
+  
+  #=============================================================
+  def __init__(self, config):
+    """"""
+    
+    # interpolate every option once up front; typed values are converted on
+    # first access and memoized, so properties never go back to the parser
+    self._parser = config
+    self._values = {}
+    self._typed = {}
+    for section in config.sections():
+      for option in config.options(section):
+        try:
+          self._values[section, option] = config.get(section, option)
+        except ConfigParserError:
+          # leave it to the parser to raise if anyone actually asks for it
+          pass
+    return
+  
+  #=============================================================
+  def _get(self, section, option, conv):
+    """"""
+    
+    key = (conv, section, option)
+    if key not in self._typed:
+      if (section, option) not in self._values:
+        return getattr(self._parser, conv)(section, option)
+      value = self._values[section, option]
+      if conv == 'getboolean':
+        if value.lower() not in self._parser._boolean_states:
+          raise ValueError('Not a boolean: %s' % value)
+        value = self._parser._boolean_states[value.lower()]
+      elif conv == 'getint':
+        value = int(value)
+      elif conv == 'getfloat':
+        value = float(value)
+      self._typed[key] = value
+    return self._typed[key]
+  
+  #=============================================================
+  def get(self, section, option):
+    return self._get(section, option, 'get')
+  def getint(self, section, option):
+    return self._get(section, option, 'getint')
+  def getfloat(self, section, option):
+    return self._get(section, option, 'getfloat')
+  def getboolean(self, section, option):
+    return self._get(section, option, 'getboolean')
+  def sections(self):
+    return self._parser.sections()
+  def options(self, section):
+    return self._parser.options(section)
+  def write(self, fileobject):
+    return self._parser.write(fileobject)
 
 #***************************************************************
 class Configurable(object):
@@ -45,6 +103,8 @@ class Configurable(object):
       self._config = args[0]
     else:
       self._config = self._configure(**kwargs)
+    if not isinstance(self._config, ConfigSnapshot):
+      self._config = ConfigSnapshot(self._config)
     return
   
   #=============================================================
@@ -162,6 +222,11 @@ class Configurable(object):
   def transition_statistics(self):
     return self._config.get('OS', 'transition_statistics')
   argparser.add_argument('--transition_statistics')
+
+  @property
+  def cache_dir(self):
+    return self._config.get('OS', 'cache_dir')
+  argparser.add_argument('--cache_dir')
   
   #=============================================================
   # [Dataset]
@@ -226,6 +291,19 @@ class Configurable(object):
   def train_domains(self):
     return self._config.get('Dataset', 'train_domains')
   argparser.add_argument('--train_domains')
+
+  @property
+  def use_cache(self):
+    return self._config.getboolean('Dataset', 'use_cache')
+  argparser.add_argument('--use_cache')
+  @property
+  def n_load_workers(self):
+    return self._config.getint('Dataset', 'n_load_workers')
+  argparser.add_argument('--n_load_workers')
+  @property
+  def bucket_cost(self):
+    return self._config.get('Dataset', 'bucket_cost')
+  argparser.add_argument('--bucket_cost')
   
   #=============================================================
   # [Layers]
@@ -292,6 +370,10 @@ class Configurable(object):
   def role_mlp_size(self):
     return self._config.getint('Sizes', 'role_mlp_size')
   argparser.add_argument('--role_mlp_size')
+  @property
+  def bilinear_rank(self):
+    return self._config.getint('Sizes', 'bilinear_rank')
+  argparser.add_argument('--bilinear_rank')
   
   #=============================================================
   # [Functions]
@@ -454,6 +536,26 @@ class Configurable(object):
     return self._config.getint('Training', 'test_batch_size')
   argparser.add_argument('--test_batch_size')
   @property
+  def batch_cost_tokens(self):
+    return self._config.getfloat('Training', 'batch_cost_tokens')
+  argparser.add_argument('--batch_cost_tokens')
+  @property
+  def batch_cost_quadratic(self):
+    return self._config.getfloat('Training', 'batch_cost_quadratic')
+  argparser.add_argument('--batch_cost_quadratic')
+  @property
+  def batch_cost_predicates(self):
+    return self._config.getfloat('Training', 'batch_cost_predicates')
+  argparser.add_argument('--batch_cost_predicates')
+  @property
+  def n_prefetch(self):
+    return self._config.getint('Training', 'n_prefetch')
+  argparser.add_argument('--n_prefetch')
+  @property
+  def use_tf_data(self):
+    return self._config.getboolean('Training', 'use_tf_data')
+  argparser.add_argument('--use_tf_data')
+  @property
   def validate_every(self):
     return self._config.getint('Training', 'validate_every')
   argparser.add_argument('--validate_every')
@@ -504,6 +606,10 @@ class Configurable(object):
   def viterbi_decode(self):
     return self._config.getboolean('Training', 'viterbi_decode')
   argparser.add_argument('--viterbi_decode')
+  @property
+  def viterbi_in_graph(self):
+    return self._config.getboolean('Training', 'viterbi_in_graph')
+  argparser.add_argument('--viterbi_in_graph')
 
   @property
   def predicate_loss_penalty(self):
@@ -661,6 +767,19 @@ class Configurable(object):
     return self._config.getboolean('Training', 'eval_by_domain')
   argparser.add_argument('--eval_by_domain')
 
+  @property
+  def perl_eval(self):
+    return self._config.getboolean('Training', 'perl_eval')
+  argparser.add_argument('--perl_eval')
+  @property
+  def periodic_srl_sanity(self):
+    return self._config.getboolean('Training', 'periodic_srl_sanity')
+  argparser.add_argument('--periodic_srl_sanity')
+  @property
+  def async_eval(self):
+    return self._config.getboolean('Training', 'async_eval')
+  argparser.add_argument('--async_eval')
+
   @property
   def num_capsule_heads(self):
     return self._config.getint('Training', 'num_capsule_heads')
@@ -730,3 +849,15 @@ class Configurable(object):
   def label_smoothing(self):
     return self._config.getfloat('Training', 'label_smoothing')
   argparser.add_argument('--label_smoothing')
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+  
+  import timeit
+  
+  configurable = Configurable()
+  parser = configurable._config._parser
+  n = 100000
+  print('parser:   %.3fs for %d reads' % (timeit.timeit(lambda: parser.getboolean('Dataset', 'conll2012'), number=n), n))
+  print('snapshot: %.3fs for %d reads' % (timeit.timeit(lambda: configurable.conll2012, number=n), n))
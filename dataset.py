@@ -19,33 +19,49 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import shutil
+import hashlib
+import pickle as pkl
+
 import numpy as np
 import tensorflow as tf
 from collections import Counter
 
-from lib.etc.k_means import KMeans
+from lib.etc.dp_buckets import DPBuckets
+from lib.etc.shards import shard_file, map_shards, iter_lines
 from configurable import Configurable
 from vocab import Vocab
+from bucket import Bucket
 from metabucket import Metabucket
 
 #***************************************************************
 class Dataset(Configurable):
   """"""
   
+  # bump whenever the layout of _process_buff's output or of the cached buckets changes
+  CACHE_VERSION = 3
+  # size of the pieces the training file is read in when streaming
+  STREAM_CHUNK_BYTES = 1 << 20
+  
   #=============================================================
   def __init__(self, filename, vocabs, builder, *args, **kwargs):
     """"""
     
     super(Dataset, self).__init__(*args, **kwargs)
     self.vocabs = vocabs
+    # ids of the predicate labels that mark a token as a predicate
+    self._true_predicates = [idx for string, idx in vocabs[4].iteritems() if string.startswith('True')] if self.conll2012 else []
 
     self.train_domains_set = set(self.train_domains.split(',')) if self.train_domains != '-' and self.name == "Trainset" else set()
     print("Loading training data from domains:", self.train_domains_set if self.train_domains_set else "all")
 
-    self._file_iterator = self.file_iterator(filename)
     self._train = (filename == self.train_file)
+    self._file_iterator = self.file_iterator(filename)
     self._metabucket = Metabucket(self._config, n_bkts=self.n_bkts)
     self._data = None
+    self._sent_id_strs = None
+    self._sent_id_idxs = None
     self.rebucket()
 
     if self.use_elmo:
@@ -53,130 +69,272 @@ class Dataset(Configurable):
       with tf.variable_scope(tf.get_variable_scope(), reuse=(self.name != "Trainset")):
         self.elmo_encoder = ElmoLSTMEncoder(self)
 
-    self.inputs = tf.placeholder(dtype=tf.int32, shape=(None,None,None), name='inputs')
-    self.targets = tf.placeholder(dtype=tf.int32, shape=(None,None,None), name='targets')
+    if self.uses_tf_data:
+      self._build_tf_data()
+    else:
+      self.inputs = tf.placeholder(dtype=tf.int32, shape=(None,None,None), name='inputs')
+      self.targets = tf.placeholder(dtype=tf.int32, shape=(None,None,None), name='targets')
     self.step = tf.placeholder_with_default(0., shape=None, name='step')
     self.builder = builder()
   
+  #=============================================================
+  def _build_tf_data(self):
+    """"""
+    
+    # get_minibatches decides the order of each pass and leaves it in
+    # self._tf_data_plan; tf.data builds the arrays and prefetches them
+    self._tf_data_plan = None
+    def tf_data_minibatches():
+      input_idxs, target_idxs, minibatches = self._tf_data_plan
+      for bkt_idx, bkt_mb in minibatches:
+        yield self._get_arrays(bkt_idx, bkt_mb, input_idxs, target_idxs)
+    
+    dataset = tf.data.Dataset.from_generator(tf_data_minibatches,
+                                             output_types=(tf.int32, tf.int32),
+                                             output_shapes=(tf.TensorShape([None,None,None]),)*2)
+    dataset = dataset.prefetch(max(self.n_prefetch, 1))
+    iterator = dataset.make_initializable_iterator()
+    self._tf_data_init = iterator.initializer
+    self.inputs, self.targets = iterator.get_next()
+    return
+  
   #=============================================================
   def file_iterator(self, filename):
     """"""
     
-    with open(filename) as f:
-      if self.lines_per_buffer > 0:
-        buff = [[]]
-        while True:
-          line = f.readline()
-          while line:
-            line = line.strip().split()
-            if line and (not self.train_domains_set or line[0].split('/')[0] in self.train_domains):
-              buff[-1].append(line)
-            else:
-              if len(buff) < self.lines_per_buffer:
-                if len(buff[-1]) > 0:
-                  buff.append([])
-                else:
-                  buff[-1] = []
-              else:
-                break
-            line = f.readline()
-          if not line:
-            f.seek(0)
-          else:
-            buff = self._process_buff(buff)
-            yield buff
-            line = line.strip().split()
-            if line:
-              buff = [[line]]
-            else:
-              buff = [[]]
+    if self.streaming:
+      for buff in self._stream_file(filename):
+        yield buff
+    else:
+      while True:
+        buff = self._load_cache(filename)
+        if buff is None:
+          buff = self._read_file(filename)
+          self._save_cache(filename, *buff)
+        # hand the buffer over without holding on to it here, so that it can
+        # be freed as soon as it has been bucketed
+        buff = [buff]
+        yield buff.pop()
+  
+  #=============================================================
+  def _stream_file(self, filename):
+    """"""
+    
+    # the file is cut into sentence-aligned chunks that are read in a new random
+    # order on every pass, so each window mixes sentences from all over the corpus
+    # and only lines_per_buffer sentences are ever held in memory at once
+    n_chunks = max(os.path.getsize(filename) // self.STREAM_CHUNK_BYTES, 1)
+    chunks = shard_file(filename, n_chunks)
+    buff = []
+    while True:
+      for chunk_idx in np.random.permutation(len(chunks)):
+        start, stop = chunks[chunk_idx]
+        for sent in self._read_sents(filename, start, stop):
+          buff.append(sent)
+          if len(buff) == self.lines_per_buffer:
+            buff = [self._bucket_buff(*self._process_buff(buff))]
+            yield buff.pop()
+  
+  #=============================================================
+  def _read_file(self, filename):
+    """"""
+    
+    shards = map_shards(self._process_shard, filename, self.n_load_workers)
+    if self.conll2012 and len(shards) > 1:
+      # sentence ids restart at 1 in every shard; shift them so they stay unique
+      sent_idx = 6
+      n_sents = 0
+      for shard, _ in shards:
+        for sent in shard:
+          sent[:, sent_idx] += n_sents
+        if shard:
+          n_sents = shard[-1][0, sent_idx]
+    buff = [sent for shard, _ in shards for sent in shard]
+    sent_ids = np.concatenate([sent_ids for _, sent_ids in shards])
+    del shards
+    return self._bucket_buff(buff, sent_ids)
+  
+  #=============================================================
+  def _bucket_buff(self, buff, sent_ids):
+    """"""
+    
+    # the whole buffer goes into one unbounded bucket, which is what gets
+    # cached and what rebucket sorts into the metabucket
+    bucket = Bucket(self._config, name='%s-buffer' % self.name)
+    bucket.reset(-1)
+    # popped off so that each sentence can be freed once it's been added
+    buff.reverse()
+    while buff:
+      bucket.add(buff.pop())
+    bucket._finalize()
+    return bucket, sent_ids
+  
+  #=============================================================
+  def _process_shard(self, filename, start, stop):
+    """"""
+    
+    return self._process_buff(self._read_sents(filename, start, stop))
+  
+  #=============================================================
+  def _read_sents(self, filename, start=0, stop=None):
+    """"""
+    
+    buff = [[]]
+    for line in iter_lines(filename, start, stop):
+      line = line.strip().split()
+      if line and (not self.train_domains_set or line[0].split('/')[0] in self.train_domains):
+        buff[-1].append(line)
       else:
-        buff = [[]]
-        for line in f:
-          line = line.strip().split()
-          if line and (not self.train_domains_set or line[0].split('/')[0] in self.train_domains):
-            buff[-1].append(line)
-          else:
-            if len(buff[-1]) > 0:
-              buff.append([])
-            else:
-              buff[-1] = []
-        if buff[-1] == []:
-          buff.pop()
-        buff = self._process_buff(buff)
-        while True:
-          yield buff
+        if len(buff[-1]) > 0:
+          buff.append([])
+        else:
+          buff[-1] = []
+    if buff[-1] == []:
+      buff.pop()
+    return buff
+  
+  #=============================================================
+  def _cache_path(self, filename):
+    """"""
+    
+    if not self.use_cache:
+      return None
+    
+    sha = hashlib.sha1()
+    sha.update(str(self.CACHE_VERSION))
+    with open(filename, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        sha.update(chunk)
+    for vocab in self.vocabs:
+      sha.update(vocab.name)
+      sha.update(repr(sorted(vocab.iteritems())))
+      if vocab.use_pretrained:
+        embed_stat = os.stat(vocab.embed_file)
+        sha.update(repr((len(vocab._str2embed), embed_stat.st_size, embed_stat.st_mtime)))
+    options = (self.conll, self.conll2012, self.train_on_nested, self.joint_pos_predicates,
+               self.one_example_per_predicate, self.predicate_str, sorted(self.train_domains_set))
+    sha.update(repr(options))
+    return os.path.join(self.cache_dir, '%s-%s' % (self.name.lower(), sha.hexdigest()))
+  
+  #=============================================================
+  def _load_cache(self, filename):
+    """"""
+    
+    cache_path = self._cache_path(filename)
+    if cache_path is None or not os.path.isfile(os.path.join(cache_path, 'meta.pkl')):
+      return None
+    
+    with open(os.path.join(cache_path, 'meta.pkl'), 'rb') as f:
+      meta = pkl.load(f)
+    if meta['version'] != self.CACHE_VERSION:
+      return None
+    sent_ids = np.load(os.path.join(cache_path, 'sent_ids.npy'))
+    buff = Bucket(self._config, name='%s-buffer' % self.name)
+    buff.reset(-1)
+    # mapped rather than read in, since rebucket only ever takes a slice of
+    # them for each bucket
+    buff._set_arrays(**dict((name, np.load(os.path.join(cache_path, '%s.npy' % name), mmap_mode='r')) for name in Bucket.ARRAYS))
+    print("Loaded %s from cache %s (%s)" % (meta['summary'], cache_path, self.name))
+    return buff, sent_ids
+  
+  #=============================================================
+  def _save_cache(self, filename, buff, sent_ids):
+    """"""
+    
+    cache_path = self._cache_path(filename)
+    if cache_path is None or not len(buff):
+      return
+    
+    meta = {'version': self.CACHE_VERSION,
+            'filename': filename,
+            'summary': '%d sentences with %d tokens' % (len(buff), np.sum(buff.get_lens(slice(None))))}
+    
+    # write to a temporary directory and rename so that a crash never leaves a half-written cache
+    tmp_path = '%s.tmp%d' % (cache_path, os.getpid())
+    if not os.path.isdir(tmp_path):
+      os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'sent_ids.npy'), sent_ids)
+    for name, array in buff.arrays.iteritems():
+      np.save(os.path.join(tmp_path, '%s.npy' % name), array)
+    with open(os.path.join(tmp_path, 'meta.pkl'), 'wb') as f:
+      pkl.dump(meta, f)
+    try:
+      os.rename(tmp_path, cache_path)
+      print("Wrote data cache %s (%s)" % (cache_path, self.name))
+    except OSError:
+      # another process got there first
+      shutil.rmtree(tmp_path, ignore_errors=True)
+    return
   
   #=============================================================
   def _process_buff(self, buff):
     """"""
-
-    # tmp_f = open("debug_data_%s" % self.name, 'w')
     
     words, tags, rels, srls, predicates, domains = self.vocabs
-    srl_start_field = srls.conll_idx[0]
-    sents = 0
-    toks = 0
+    sents = len(buff)
+    sent_lens = np.array([len(sent) for sent in buff], dtype=np.int64)
+    sent_starts = np.cumsum(sent_lens) - sent_lens
+    tokens = [token for sent in buff for token in sent]
+    toks = len(tokens)
+    column = lambda idx: np.array([token[idx] for token in tokens], dtype=str)
+    
+    # every field is pulled out as one flat column over the whole buffer and
+    # mapped to ids in a single vocab lookup instead of token by token
+    positions = np.arange(toks) - np.repeat(sent_starts, sent_lens)
+    word_strs = column(words.conll_idx)
+    rel_strs = column(rels.conll_idx)
+    gold_tag_strs = column(tags.conll_idx[1])
+    is_root = rel_strs == 'root'
+    heads = np.where(is_root, positions, 0)
+    heads[~is_root] = column(6)[~is_root].astype(np.int64) - 1
+    fields = [words.index_array(word_strs)]
+    if self.conll:
+      fields.extend([tags.index_array(column(tags.conll_idx[0])),
+                     tags.index_array(gold_tag_strs),
+                     heads[:,None],
+                     rels.index_array(rel_strs)])
+      sent_srls = None
+      is_predicate = np.zeros(toks, dtype=bool)
+    else:
+      sent_srls, has_predicate_str = self._process_srls(buff, sent_lens)
+      is_predicate = column(predicates.conll_idx[0] if self.joint_pos_predicates else predicates.conll_idx) != '-'
+      if not self.train_on_nested:
+        is_predicate &= has_predicate_str
+      predicate_strs = np.where(is_predicate, 'True', 'False')
+      if self.joint_pos_predicates:
+        predicate_strs = np.core.defchararray.add(np.core.defchararray.add(predicate_strs, '/'), gold_tag_strs)
+      docids, docid_inverse = np.unique(column(0), return_inverse=True)
+      domain_strs = np.array([docid.split('/')[0] for docid in docids], dtype=str)[docid_inverse]
+      fields.extend([tags.index_array(column(tags.conll_idx[0])),
+                     predicates.index_array(predicate_strs),
+                     domains.index_array(domain_strs),
+                     np.repeat(np.arange(1, sents+1), sent_lens)[:,None],
+                     tags.index_array(gold_tag_strs),
+                     heads[:,None],
+                     rels.index_array(rel_strs)])
+    fields = np.concatenate(fields, axis=1)
+    
     examples = 0
     total_predicates = 0
     buff2 = []
-    for i, sent in enumerate(buff):
-      # if not self.conll2012 or (self.conll2012 and len(list(sent)) > 1):
-      # print(sent, len(sent))
-      sents += 1
-      sent_len = len(sent)
-      num_fields = len(sent[0])
-      srl_take_indices = [idx for idx in range(srl_start_field, srl_start_field + sent_len) if idx < num_fields - 1 and (self.train_on_nested or np.all(['/' not in sent[j][idx] for j in range(sent_len)]))]
-      predicate_indices = []
-      for j, token in enumerate(sent):
-        toks += 1
-        if self.conll:
-          word, tag1, tag2, head, rel = token[words.conll_idx], token[tags.conll_idx[0]], token[tags.conll_idx[1]], token[6], token[rels.conll_idx]
-          if rel == 'root':
-            head = j
-          else:
-            head = int(head) - 1
-          buff[i][j] = (word,) + words[word] + tags[tag1] + tags[tag2] + (head,) + rels[rel]
-        elif self.conll2012:
-          word, auto_tag, gold_tag, head, rel = token[words.conll_idx], token[tags.conll_idx[0]], token[tags.conll_idx[1]], token[6], token[rels.conll_idx]
-          domain = token[0].split('/')[0]
-          # print(word, tag1, tag2, head, rel)
-          if rel == 'root':
-            head = j
-          else:
-            head = int(head) - 1
-
-          # srl_fields = [token[idx] if idx < len(token)-1 else 'O' for idx in range(srl_start_field, srl_start_field + sent_len)]
-          srl_fields = [token[idx] for idx in srl_take_indices] # todo can we use fancy indexing here?
-          srl_fields += ['O'] * (sent_len - len(srl_take_indices))
-          srl_tags = [srls[s][0] for s in srl_fields]
-
-          if self.joint_pos_predicates:
-            is_predicate = token[predicates.conll_idx[0]] != '-' and (self.train_on_nested or self.predicate_str in srl_fields)
-            tok_predicate_str = str(is_predicate) + '/' + gold_tag
-          else:
-            is_predicate = token[predicates.conll_idx] != '-' and (self.train_on_nested or self.predicate_str in srl_fields)
-            tok_predicate_str = str(is_predicate)
-
-          if is_predicate:
-            predicate_indices.append(j)
-
-          buff[i][j] = (word,) + words[word] + tags[auto_tag] + predicates[tok_predicate_str] + domains[domain] + (sents,) + tags[gold_tag] + (head,) + rels[rel] + tuple(srl_tags)
-
+    for i, (start, sent_len) in enumerate(zip(sent_starts, sent_lens)):
+      stop = start + sent_len
+      sent_width = 1 + fields.shape[1] + (sent_len if sent_srls is not None else 0)
+      sent = np.empty((sent_len, sent_width), dtype=object)
+      sent[:,0] = word_strs[start:stop]
+      sent[:,1:1+fields.shape[1]] = fields[start:stop]
+      if sent_srls is not None:
+        sent[:,1+fields.shape[1]:] = sent_srls[i]
+      
       # Expand sentences into one example per predicate
       if self.one_example_per_predicate:
-        # grab the sent
-        # should be sent_len x sent_elements
-        sent = np.array(buff[i])
-        # print(sent)
+        predicate_indices = np.where(is_predicate[start:stop])[0]
         is_predicate_idx = 4
         srl_start_idx = 10
-        word_part = sent[:, 0].astype('O')
+        word_part = sent[:, 0]
         srl_part = sent[:, srl_start_idx:].astype(np.int32)
         rest_part = sent[:, 1:srl_start_idx].astype(np.int32)
-        # print("orig sent (%d):" % len(predicate_indices), sent[:, :8+len(predicate_indices)])
-        # print("orig preds:", [map(lambda x: srls[int(x)], t) for t in sent[:, srl_start_idx:srl_start_idx+len(predicate_indices)]])
-        if predicate_indices:
+        if len(predicate_indices):
           for k, p_idx in enumerate(predicate_indices):
             # should be sent_len x sent_elements
             rest_part[:, is_predicate_idx-1] = predicates["False"][0]
@@ -184,28 +342,63 @@ class Dataset(Configurable):
             correct_srls = srl_part[:, k]
             new_sent = np.concatenate([np.expand_dims(word_part, -1), rest_part, np.expand_dims(correct_srls, -1)], axis=1)
             buff2.append(new_sent)
-            # print("new sent:", new_sent)
-            # print("new preds:", map(lambda x: srls[int(x)], new_sent[:, -1]))
-            # tokens_str = ' '.join(word_part)
-            # labels_str = ' '.join(map(lambda x: srls[x], correct_srls))
-            ## idx, tokens, labels
-            # print("%d %s ||| %s" % (p_idx, tokens_str, labels_str), file=tmp_f)
             total_predicates += 1
             examples += 1
         else:
-           new_sent = np.concatenate([np.expand_dims(word_part, -1), rest_part], axis=1)
-           buff2.append(new_sent)
-           examples += 1
-      # else:
-      #   buff2.append(np.concatenate[np.expand_dims(word_part, -1), rest_part, srl_part], axis=1) #(sent[0],) + map(int, sent[1:]))
-      #   examples += 1
-    # tmp_f.close()
+          new_sent = np.concatenate([np.expand_dims(word_part, -1), rest_part], axis=1)
+          buff2.append(new_sent)
+          examples += 1
+      else:
+        buff2.append(sent)
     if self.one_example_per_predicate:
       print("Loaded %d sentences with %d tokens, %d examples (%d predicates) (%s)" % (sents, toks, examples, total_predicates, self.name))
-      return buff2
     else:
       print("Loaded %d sentences with %d tokens (%s)" % (sents, toks, self.name))
-      return buff
+    # the first two fields of each sentence (document and sentence ids in
+    # CoNLL-2012), so the writers never have to go back to the file for them
+    sent_ids = np.array([sent[0][:2] for sent in buff], dtype=str).reshape(sents, 2)
+    return buff2, sent_ids
+  
+  #=============================================================
+  def _process_srls(self, buff, sent_lens):
+    """"""
+    
+    srls = self.vocabs[3]
+    srl_start_field = srls.conll_idx[0]
+    
+    # sentence i has one srl column per predicate, stored in fields
+    # srl_start_field .. srl_start_field+n_cols[i]-1 (the last field is always skipped)
+    n_cols = np.array([min(len(sent), len(sent[0])-1-srl_start_field) if sent else 0 for sent in buff], dtype=np.int64)
+    n_cols = np.maximum(n_cols, 0)
+    cells = np.array([cell for sent, n_col in zip(buff, n_cols) for token in sent for cell in token[srl_start_field:srl_start_field+n_col]], dtype=str)
+    cell_ids = srls.index_array(cells)[:,0]
+    
+    # a column is dropped when any of its cells is nested (contains a '/')
+    col_starts = np.cumsum(n_cols) - n_cols
+    cells_per_sent = sent_lens * n_cols
+    cell_starts = np.cumsum(cells_per_sent) - cells_per_sent
+    cell_sents = np.repeat(np.arange(len(buff)), cells_per_sent)
+    cell_cols = col_starts[cell_sents] + (np.arange(len(cells)) - cell_starts[cell_sents]) % np.maximum(n_cols, 1)[cell_sents]
+    if self.train_on_nested:
+      keep_col = np.ones(np.sum(n_cols), dtype=bool)
+    else:
+      is_nested = np.core.defchararray.find(cells, '/') >= 0
+      keep_col = np.bincount(cell_cols, weights=is_nested, minlength=np.sum(n_cols)) == 0
+    
+    # whether each token carries the predicate tag in one of the kept columns
+    is_predicate_str = (cells == self.predicate_str) & keep_col[cell_cols]
+    cell_toks = np.repeat(np.arange(np.sum(sent_lens)), np.repeat(n_cols, sent_lens))
+    has_predicate_str = np.bincount(cell_toks, weights=is_predicate_str, minlength=np.sum(sent_lens)) > 0
+    
+    sent_srls = []
+    outside = srls['O'][0]
+    for sent_len, n_col, col_start, cell_start in zip(sent_lens, n_cols, col_starts, cell_starts):
+      sent_cells = cell_ids[cell_start:cell_start+sent_len*n_col].reshape(sent_len, n_col)
+      sent_keep = keep_col[col_start:col_start+n_col]
+      sent_srl = np.full((sent_len, sent_len), outside, dtype=np.int32)
+      sent_srl[:,:np.sum(sent_keep)] = sent_cells[:,sent_keep]
+      sent_srls.append(sent_srl)
+    return sent_srls, has_predicate_str
   
   #=============================================================
   def reset(self, sizes):
@@ -220,18 +413,58 @@ class Dataset(Configurable):
   def rebucket(self):
     """"""
 
-    buff = self._file_iterator.next()
-    len_cntr = Counter()
-    
-    for sent in buff:
-      len_cntr[len(sent)] += 1
-    self.reset(KMeans(self.n_bkts, len_cntr).splits)
+    buff, sent_ids = self._file_iterator.next()
+    self._sent_id_strs, sent_id_idxs = np.unique(sent_ids, return_inverse=True)
+    self._sent_id_idxs = sent_id_idxs.reshape(sent_ids.shape).astype(np.int32)
+    lens, counts = np.unique(buff.get_lens(slice(None)), return_counts=True)
+    len_cntr = Counter(dict(zip(lens.tolist(), counts.tolist())))
+    self.reset(DPBuckets(self.n_bkts, len_cntr, cost=self.bucket_cost).splits)
+    self._metabucket.fill(buff)
     
-    for sent in buff:
-      self._metabucket.add(sent)
-    self._finalize()
+    # kept per bucket for the batch cost model (each bucket keeps its
+    # sentences in the order of the buffer)
+    n_predicates = self._count_predicates(buff)
+    bkt_idxs = self._metabucket.data[:,0]
+    self._n_predicates = [n_predicates[bkt_idxs == bkt_idx] for bkt_idx in xrange(len(self._metabucket))]
     return
   
+  #=============================================================
+  def sent_ids(self, sent_num):
+    """
+      The document and sentence ids from the file of the sent_num-th sentence,
+      counting from 1 like the sentence numbers in the data do.
+    """
+    
+    return tuple(self._sent_id_strs[self._sent_id_idxs[sent_num-1]])
+  
+  #=============================================================
+  def _count_predicates(self, buff):
+    """"""
+    
+    # how many tokens of each sentence are marked as predicates
+    predicate_idx = 4
+    lens = buff.get_lens(slice(None))
+    is_predicate = np.in1d(buff.get_field(predicate_idx-1), self._true_predicates)
+    return np.bincount(np.repeat(np.arange(len(lens)), lens), weights=is_predicate, minlength=len(lens)).astype(np.int32)
+  
+  #=============================================================
+  def sent_cost(self, sent_len, n_predicates):
+    """"""
+    
+    # estimated cost of one sentence padded to sent_len: its tokens, the
+    # (sent_len x sent_len) attention and arc scores, and the srl scores
+    # computed for each of its predicates
+    return self.batch_cost_tokens * sent_len + \
+           self.batch_cost_quadratic * sent_len**2 + \
+           self.batch_cost_predicates * n_predicates * sent_len
+  
+  #=============================================================
+  def minibatch_cost(self, bkt_idx, bkt_mb):
+    """"""
+    
+    # cost at the bucket's padded length, as _plan_minibatches sizes it
+    return np.sum(self.sent_cost(self[bkt_idx].size, self._n_predicates[bkt_idx][bkt_mb]))
+  
   #=============================================================
   def _finalize(self):
     """"""
@@ -240,48 +473,80 @@ class Dataset(Configurable):
     return
   
   #=============================================================
-  def get_minibatches(self, batch_size, input_idxs, target_idxs, shuffle=True):
+  def get_minibatches(self, batch_size, input_idxs, target_idxs, shuffle=True, sess=None, with_costs=False):
+    """"""
+    
+    minibatches = self._plan_minibatches(batch_size, shuffle)
+    if self.uses_tf_data:
+      self._tf_data_plan = (input_idxs, target_idxs, minibatches)
+      sess.run(self._tf_data_init)
+    for bkt_idx, bkt_mb in minibatches:
+      feed_dict = {}
+      sents = self[bkt_idx].get_sents(bkt_mb)
+      if not self.uses_tf_data:
+        inputs, targets = self._get_arrays(bkt_idx, bkt_mb, input_idxs, target_idxs)
+        feed_dict.update({
+          self.inputs: inputs,
+          self.targets: targets
+        })
+      if self.use_elmo:
+        feed_dict = self.elmo_encoder.get_feed_dict(feed_dict, sents)
+      if with_costs:
+        yield feed_dict, sents, self.minibatch_cost(bkt_idx, bkt_mb)
+      else:
+        yield feed_dict, sents
+    if self.streaming:
+      # move on to the next window of the training file
+      self.rebucket()
+  
+  #=============================================================
+  def _plan_minibatches(self, batch_size, shuffle):
     """"""
     
     minibatches = []
     for bkt_idx, bucket in enumerate(self._metabucket):
+      # batch_size is a budget in the units of the batch cost model
+      # (by default just tokens, counting padding)
+      costs = self.sent_cost(bucket.size, self._n_predicates[bkt_idx])
       if batch_size == 0:
         n_splits = 1
       else:
-        n_tokens = len(bucket) * bucket.size
-        n_splits = max(n_tokens // batch_size, 1)
+        n_splits = max(int(np.sum(costs) // batch_size), 1)
       if shuffle:
         range_func = np.random.permutation
       else:
         range_func = np.arange
-      arr_sp = np.array_split(range_func(len(bucket)), n_splits)
+      order = range_func(len(bucket))
+      if not len(costs) or np.all(costs == costs[0]):
+        arr_sp = np.array_split(order, n_splits)
+      else:
+        # split where the running cost crosses each multiple of total/n_splits
+        cum_costs = np.cumsum(costs[order])
+        split_points = np.searchsorted(cum_costs, cum_costs[-1] * np.arange(1, n_splits) / n_splits)
+        arr_sp = np.split(order, split_points)
       for bkt_mb in arr_sp:
-        minibatches.append( (bkt_idx, bkt_mb) )
+        if len(bkt_mb):
+          minibatches.append( (bkt_idx, bkt_mb) )
     if shuffle:
       np.random.shuffle(minibatches)
-    for bkt_idx, bkt_mb in minibatches:
-      feed_dict = {}
-      data = self[bkt_idx].data[bkt_mb]
-      sents = self[bkt_idx].sents[bkt_mb]
-      maxlen = np.max(np.sum(np.greater(data[:,:,0], 0), axis=1))
-
-      # np.set_printoptions(threshold=np.nan)
-      # print("maxlen", maxlen)
-      # print("maxlen+max(target_idxs)", maxlen+max(target_idxs))
-      # print("data.shape[2]", data.shape[2])
-      # targets = data[:,:maxlen,min(target_idxs):maxlen+max(target_idxs)+1]
-      # print("data shape", targets.shape)
-      # print("data[:,:,3:] shape", targets[:,:,3:].shape)
-
-      feed_dict.update({
-        self.inputs: data[:,:maxlen,input_idxs],
-        self.targets: data[:,:maxlen,min(target_idxs):maxlen+max(target_idxs)+1]
-      })
-      if self.use_elmo:
-        feed_dict = self.elmo_encoder.get_feed_dict(feed_dict, sents)
-      yield feed_dict, sents
+    return minibatches
   
   #=============================================================
+  def _get_arrays(self, bkt_idx, bkt_mb, input_idxs, target_idxs):
+    """"""
+    
+    data = self[bkt_idx].get_data(bkt_mb)
+    maxlen = np.max(np.sum(np.greater(data[:,:,0], 0), axis=1))
+    
+    return data[:,:maxlen,input_idxs], data[:,:maxlen,min(target_idxs):maxlen+max(target_idxs)+1]
+  
+  #=============================================================
+  @property
+  def streaming(self):
+    return self._train and self.lines_per_buffer > 0
+  @property
+  def uses_tf_data(self):
+    return self._train and self.use_tf_data
   @property
   def n_bkts(self):
     if self._train:
@@ -291,8 +556,8 @@ class Dataset(Configurable):
 
   # =============================================================
   def max_batch_size(self):
-    print([b._data.shape[0] for b in self._metabucket._buckets])
-    max_batch_size = np.max([b._data.shape[0] for b in self._metabucket._buckets])
+    print([len(b) for b in self._metabucket._buckets])
+    max_batch_size = np.max([len(b) for b in self._metabucket._buckets])
     print("max batch size: ", max_batch_size)
     if self.name == "Testset":
       return self.max_test_batch_size
@@ -305,3 +570,194 @@ class Dataset(Configurable):
     return self._metabucket[key]
   def __len__(self):
     return len(self._metabucket)
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+  
+  import shutil
+  import tempfile
+  import itertools
+  
+  def process_buff_by_token(self, buff):
+    """The per-token tuple version of Dataset._process_buff it replaced"""
+    
+    words, tags, rels, srls, predicates, domains = self.vocabs
+    srl_start_field = srls.conll_idx[0]
+    sents = 0
+    buff2 = []
+    for i, sent in enumerate(buff):
+      sents += 1
+      sent_len = len(sent)
+      num_fields = len(sent[0])
+      srl_take_indices = [idx for idx in range(srl_start_field, srl_start_field + sent_len) if idx < num_fields - 1 and (self.train_on_nested or np.all(['/' not in sent[j][idx] for j in range(sent_len)]))]
+      predicate_indices = []
+      for j, token in enumerate(sent):
+        if self.conll:
+          word, tag1, tag2, head, rel = token[words.conll_idx], token[tags.conll_idx[0]], token[tags.conll_idx[1]], token[6], token[rels.conll_idx]
+          if rel == 'root':
+            head = j
+          else:
+            head = int(head) - 1
+          buff[i][j] = (word,) + words[word] + tags[tag1] + tags[tag2] + (head,) + rels[rel]
+        elif self.conll2012:
+          word, auto_tag, gold_tag, head, rel = token[words.conll_idx], token[tags.conll_idx[0]], token[tags.conll_idx[1]], token[6], token[rels.conll_idx]
+          domain = token[0].split('/')[0]
+          if rel == 'root':
+            head = j
+          else:
+            head = int(head) - 1
+          srl_fields = [token[idx] for idx in srl_take_indices]
+          srl_fields += ['O'] * (sent_len - len(srl_take_indices))
+          srl_tags = [srls[s][0] for s in srl_fields]
+          if self.joint_pos_predicates:
+            is_predicate = token[predicates.conll_idx[0]] != '-' and (self.train_on_nested or self.predicate_str in srl_fields)
+            tok_predicate_str = str(is_predicate) + '/' + gold_tag
+          else:
+            is_predicate = token[predicates.conll_idx] != '-' and (self.train_on_nested or self.predicate_str in srl_fields)
+            tok_predicate_str = str(is_predicate)
+          if is_predicate:
+            predicate_indices.append(j)
+          buff[i][j] = (word,) + words[word] + tags[auto_tag] + predicates[tok_predicate_str] + domains[domain] + (sents,) + tags[gold_tag] + (head,) + rels[rel] + tuple(srl_tags)
+      
+      if self.one_example_per_predicate:
+        sent = np.array(buff[i])
+        is_predicate_idx = 4
+        srl_start_idx = 10
+        word_part = sent[:, 0].astype('O')
+        srl_part = sent[:, srl_start_idx:].astype(np.int32)
+        rest_part = sent[:, 1:srl_start_idx].astype(np.int32)
+        if predicate_indices:
+          for k, p_idx in enumerate(predicate_indices):
+            rest_part[:, is_predicate_idx-1] = predicates["False"][0]
+            rest_part[p_idx, is_predicate_idx-1] = predicates["True"][0]
+            correct_srls = srl_part[:, k]
+            buff2.append(np.concatenate([np.expand_dims(word_part, -1), rest_part, np.expand_dims(correct_srls, -1)], axis=1))
+        else:
+          buff2.append(np.concatenate([np.expand_dims(word_part, -1), rest_part], axis=1))
+    if self.one_example_per_predicate:
+      return buff2
+    return buff
+  
+  def make_dataset(tmp_dir, train_file, **options):
+    """A training set with the vocabs network.py builds for it"""
+    
+    save_dir = tempfile.mkdtemp(dir=tmp_dir)
+    config = Configurable(save_dir=save_dir, train_file=train_file, embed_file=os.path.join(tmp_dir, 'embed.txt'),
+                          embed_aux_file=os.path.join(tmp_dir, 'none.txt'), use_cache=False, use_tf_data=False, **options)._config
+    conll = config.getboolean('Dataset', 'conll')
+    joint_pos_predicates = config.getboolean('Dataset', 'joint_pos_predicates')
+    # (CoNLL-X has no srls, predicates or domains)
+    if conll:
+      vocab_files = [(config.get('OS', 'word_file'), 1, 'Words'), (config.get('OS', 'tag_file'), [3, 4], 'Tags'),
+                     (config.get('OS', 'rel_file'), 7, 'Rels')]
+    else:
+      vocab_files = [(config.get('OS', 'word_file'), 3, 'Words'), (config.get('OS', 'tag_file'), [5, 4], 'Tags'),
+                     (config.get('OS', 'rel_file'), 7, 'Rels')]
+    vocab_files += [(config.get('OS', 'srl_file'), range(14, 50), 'SRLs'),
+                    (config.get('OS', 'predicate_file'), [10, 4] if joint_pos_predicates else 10, 'Predicates'),
+                    (config.get('OS', 'domain_file'), 0, 'Domains')]
+    vocabs = [Vocab(vocab_file, idx, 0, config, name=name, use_pretrained=(not i),
+                    counts=(Counter() if conll and i > 2 else None))
+              for i, (vocab_file, idx, name) in enumerate(vocab_files)]
+    return Dataset(train_file, vocabs, lambda: None, config, name='Trainset')
+  
+  def write_corpus(filename, n_sents):
+    """Random CoNLL-2012 training sentences"""
+    
+    rng = np.random.RandomState(0)
+    roles = np.array(['O', 'O', 'O', 'O', 'B-ARG0', 'I-ARG0', 'B-ARG1', 'I-ARG1'])
+    with open(filename, 'w') as f:
+      for sent_idx in xrange(n_sents):
+        sent_len = rng.randint(1, 41)
+        predicates = rng.choice(sent_len, rng.randint(0, min(sent_len, 4)+1), replace=False)
+        srls = roles[rng.randint(len(roles), size=(sent_len, len(predicates)))]
+        srls[predicates, np.arange(len(predicates))] = 'B-V'
+        heads = rng.randint(sent_len, size=sent_len) + 1
+        heads[0] = 0
+        for i in xrange(sent_len):
+          f.write('\t'.join(['nw/x/%d' % sent_idx, '0', str(i), 'word%d' % rng.randint(5000), 'NN', 'NN', str(heads[i]),
+                             'root' if i == 0 else 'dep', '_', '_', 'pred' if i in predicates else '-', '_', '_', '_'] +
+                            list(srls[i]) + ['_']) + '\n')
+        f.write('\n')
+  
+  conll12_file = os.path.join('bin', 'fixtures', 'conll12-train.txt')
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    with open(os.path.join(tmp_dir, 'embed.txt'), 'w') as f:
+      for word in ('the', 'cat', 'ran', ',', '.', 'word0', 'word1'):
+        f.write('%s 0.1 0.2 0.3\n' % word)
+    
+    # golden check of the columnar _process_buff against the per-token one it
+    # replaced: both buffers are bucketed the same way and have to come out
+    # with identical bucket contents for every combination of the data options
+    # (the CoNLL-X file holds the same sentences, for conll=True)
+    conllx_file = os.path.join(tmp_dir, 'conllx-train.txt')
+    with open(conll12_file) as f, open(conllx_file, 'w') as g:
+      for line in f:
+        line = line.split()
+        if line:
+          g.write('\t'.join([str(int(line[2])+1), line[3], '_', line[5], line[4], '_', line[6], line[7], '_', '_']))
+        g.write('\n')
+    for conll, train_on_nested, joint_pos_predicates, one_example_per_predicate in itertools.product((True, False), repeat=4):
+      options = dict(conll=conll, conll2012=not conll, train_on_nested=train_on_nested,
+                     joint_pos_predicates=joint_pos_predicates, one_example_per_predicate=one_example_per_predicate)
+      train_file = conllx_file if conll else conll12_file
+      dataset = make_dataset(tmp_dir, train_file, n_bkts=3, lines_per_buffer=0, **options)
+      by_token = Metabucket(dataset._config, n_bkts=dataset.n_bkts)
+      by_token.reset([bucket.size for bucket in dataset])
+      for sent in process_buff_by_token(dataset, dataset._read_sents(train_file)):
+        by_token.add(sent)
+      by_token._finalize()
+      
+      assert np.array_equal(by_token.data, dataset._metabucket.data), options
+      for old_bucket, new_bucket in zip(by_token, dataset):
+        idxs = np.arange(len(new_bucket))
+        assert len(old_bucket) == len(new_bucket), options
+        assert np.array_equal(old_bucket.get_data(idxs), new_bucket.get_data(idxs)), options
+        assert old_bucket.get_sents(idxs) == new_bucket.get_sents(idxs), options
+      print('Identical buckets for %s' % ', '.join('%s=%s' % item for item in sorted(options.items())))
+      tf.reset_default_graph()
+    
+    # streaming keeps only one window of lines_per_buffer sentences at a time:
+    # neither the buckets held per window nor the resident memory should grow
+    # as more windows go by, or be any bigger when the file is 8 times longer,
+    # and each pass should cut the file into different windows
+    def current_rss():
+      with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    lines_per_buffer = 1000
+    resident = {}
+    peak_rss = {}
+    for n_windows in (4, 32):
+      train_file = os.path.join(tmp_dir, 'train-%d.txt' % n_windows)
+      write_corpus(train_file, n_windows * lines_per_buffer)
+      dataset = make_dataset(tmp_dir, train_file, conll=False, conll2012=True, n_bkts=10, lines_per_buffer=lines_per_buffer)
+      window_bytes = []
+      window_rss = []
+      windows = []
+      # two passes over the file
+      for window in xrange(2 * n_windows):
+        assert sum(len(bucket) for bucket in dataset) == lines_per_buffer
+        window_bytes.append(sum(bucket.nbytes for bucket in dataset))
+        window_rss.append(current_rss())
+        windows.append(frozenset(doc_id for doc_id, _ in dataset._sent_id_strs[dataset._sent_id_idxs]))
+        dataset.rebucket()
+      resident[n_windows] = max(window_bytes)
+      peak_rss[n_windows] = max(window_rss)
+      corpus_bytes = sum(window_bytes[:n_windows])
+      # how much more the second pass held than the first
+      rss_growth = max(window_rss[n_windows:]) - max(window_rss[:n_windows])
+      print('%2d windows: %5.1f MB in buckets at most (%5.1f MB for the whole file), %5.1f MB RSS at most, %+5.1f MB in the second pass' %
+            (n_windows, resident[n_windows] / 2**20, corpus_bytes / 2**20, peak_rss[n_windows] / 2**20, rss_growth / 2**20))
+      # every sentence once per pass, in windows that change from pass to pass
+      assert len(frozenset.union(*windows[:n_windows])) == n_windows * lines_per_buffer
+      assert windows[:n_windows] != windows[n_windows:], 'the windows are the same on every pass'
+      tf.reset_default_graph()
+    assert resident[32] < 1.25 * resident[4], resident
+    # (a few windows are too few to tell growth from noise, so the RSS is only
+    # checked on the long file, against a fraction of what it all takes in buckets)
+    assert rss_growth < corpus_bytes / 2, rss_growth
+    assert peak_rss[32] - peak_rss[4] < corpus_bytes / 2, peak_rss
+  finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright 2016 Timothy Dozat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import Counter
+
+import numpy as np
+
+#***************************************************************
+class DPBuckets(object):
+  """
+    Finds the k bucket sizes that minimize the padded cost of a length
+    histogram exactly, by dynamic programming over the distinct lengths.
+    Every sentence is charged the cost of the bucket it lands in: its size
+    (cost='linear', i.e. padded tokens) or its size squared
+    (cost='quadratic', e.g. for attention over bucket_size x bucket_size).
+    O(k * L^2) for L distinct lengths.
+  """
+
+  COSTS = {'linear': lambda sizes: sizes,
+           'quadratic': lambda sizes: sizes**2}
+
+  #=============================================================
+  def __init__(self, k, len_cntr, cost='linear'):
+    """"""
+
+    # Error checking
+    if len(len_cntr) < k:
+      raise ValueError('Trying to sort %d data points into %d buckets' % (len(len_cntr), k))
+    if cost not in self.COSTS:
+      raise ValueError('Bucket cost must be one of %s, not %s' % (', '.join(sorted(self.COSTS)), cost))
+
+    self._k = k
+    self._len_cntr = len_cntr
+    self._lengths = np.array(sorted(len_cntr.keys()), dtype=np.int64)
+    self._cost = cost
+    counts = np.array([len_cntr[length] for length in self._lengths], dtype=np.float64)
+    cum_counts = np.concatenate([[0], np.cumsum(counts)])
+    unit_costs = self.COSTS[cost](self._lengths.astype(np.float64))
+    n_lengths = len(self._lengths)
+
+    # bucket_costs[i,j] is the cost of one bucket holding lengths[i:j+1] (so padded to lengths[j])
+    bucket_costs = unit_costs[None,:] * (cum_counts[None,1:] - cum_counts[:-1,None])
+    bucket_costs[np.tril_indices(n_lengths, -1)] = np.inf
+
+    # best[j] is the cheapest way to cover lengths[:j+1] with the buckets so far;
+    # backptrs[b][j] is where the last of those b+1 buckets starts
+    best = bucket_costs[0].copy()
+    backptrs = []
+    for b in xrange(1, k):
+      # candidates[i,j]: buckets up to lengths[i-1], then one bucket for lengths[i:j+1]
+      candidates = best[:-1,None] + bucket_costs[1:]
+      starts = np.argmin(candidates, axis=0)
+      best = candidates[starts, np.arange(n_lengths)]
+      backptrs.append(starts + 1)
+    self._mass = best[-1]
+
+    splits = [n_lengths-1]
+    for starts in reversed(backptrs):
+      splits.append(starts[splits[-1]] - 1)
+    self._splits = [int(self._lengths[split]) for split in reversed(splits)]
+    return
+
+  #=============================================================
+  def get_mass(self):
+    """"""
+
+    return self._mass
+
+  #=============================================================
+  def __len__(self):
+    return self._k
+
+  def __iter__(self):
+    return (split for split in self.splits)
+
+  def __getitem__(self, key):
+    return self._splits[key]
+
+  #=============================================================
+  @property
+  def splits(self):
+    return self._splits
+  @property
+  def cost(self):
+    return self._cost
+
+#***************************************************************
+def padded_cost(splits, len_cntr, cost='linear'):
+  """"""
+
+  splits = np.array(sorted(splits))
+  unit_costs = DPBuckets.COSTS[cost](splits.astype(np.float64))
+  return sum(unit_costs[np.searchsorted(splits, length)] * count for length, count in len_cntr.iteritems())
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+
+  import time
+  from lib.etc.k_means import KMeans
+
+  len_cntr = Counter()
+  for i in xrange(100000):
+    len_cntr[1+int(10**(1+.3*np.random.randn()))] += 1
+  n_tokens = sum(length * count for length, count in len_cntr.iteritems())
+  for k in (10, 40):
+    start_time = time.time()
+    kmeans = KMeans(k, len_cntr)
+    kmeans_time = time.time() - start_time
+    start_time = time.time()
+    linear = DPBuckets(k, len_cntr)
+    linear_time = time.time() - start_time
+    start_time = time.time()
+    quadratic = DPBuckets(k, len_cntr, cost='quadratic')
+    quadratic_time = time.time() - start_time
+    print('%d buckets over %d distinct lengths (%d tokens)' % (k, len(len_cntr), n_tokens))
+    for name, splits, split_time in (('KMeans', kmeans.splits, kmeans_time),
+                                     ('DP linear', linear.splits, linear_time),
+                                     ('DP quadratic', quadratic.splits, quadratic_time)):
+      print('  %-13s padded tokens: %10d  padded quadratic: %13d  (%.3fs)' % (name, padded_cost(splits, len_cntr), padded_cost(splits, len_cntr, 'quadratic'), split_time))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright 2016 Timothy Dozat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import signal
+import traceback
+import collections
+import multiprocessing
+import Queue
+
+#***************************************************************
+class EvalWorker(object):
+  """
+    Runs func on each set of arguments submitted to it, one after another, in
+    a process of its own, and hands back the results tagged with whatever
+    they were submitted with. Meant for decoding and scoring an evaluation,
+    which is pure Python and would hold the GIL against training if it ran
+    in a thread. The process is forked when the worker is made, so it has to
+    be made before there's a session for it to inherit; func can then be a
+    method of anything that existed by then, and only the arguments and
+    results go through pickles. An exception in func is raised again by
+    results(), as a RuntimeError with the worker's traceback.
+  """
+
+  _STOP = None
+
+  #=============================================================
+  def __init__(self, func):
+    """"""
+
+    self._jobs = multiprocessing.Queue()
+    self._results = multiprocessing.Queue()
+    self._tags = collections.deque()
+    # or the child would write out whatever is still buffered here too
+    sys.stdout.flush()
+    sys.stderr.flush()
+    self._process = multiprocessing.Process(target=self._run, args=(func,))
+    self._process.daemon = True
+    self._process.start()
+    return
+
+  #=============================================================
+  def _run(self, func):
+    """"""
+
+    # a Ctrl-C is for the training loop to deal with
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+      job = self._jobs.get()
+      if job is self._STOP:
+        return
+      args, kwargs = job
+      try:
+        self._results.put((func(*args, **kwargs), None))
+      except Exception:
+        self._results.put((None, traceback.format_exc()))
+      sys.stdout.flush()
+    return
+
+  #=============================================================
+  def submit(self, tag, *args, **kwargs):
+    """"""
+
+    self._tags.append(tag)
+    self._jobs.put((args, kwargs))
+    return
+
+  #=============================================================
+  def results(self, block=False):
+    """
+      The (tag, result) of each job that has finished since the last call, in
+      the order they were submitted. With block, waits for all of the jobs
+      submitted so far.
+    """
+
+    finished = []
+    while self._tags:
+      try:
+        result, error = self._results.get(block=block)
+      except Queue.Empty:
+        break
+      tag = self._tags.popleft()
+      if error is not None:
+        raise RuntimeError('Evaluation of %s failed:\n%s' % (tag, error))
+      finished.append((tag, result))
+    return finished
+
+  #=============================================================
+  def close(self):
+    """"""
+
+    self._jobs.put(self._STOP)
+    self._process.join()
+    return
+
+  #=============================================================
+  @property
+  def n_pending(self):
+    return len(self._tags)
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+
+  import threading
+
+  # a 'training loop' whose steps are pure Python, like building minibatches
+  # and the bookkeeping between sess.runs, scored in steps/sec while nothing
+  # else runs, while a pure Python 'evaluation' runs in a thread (the GIL
+  # goes back and forth between them), and while it runs in an EvalWorker.
+  # With more than one core, the last should be as fast as the first
+  def work(n):
+    total = 0
+    for i in xrange(n):
+      total += i % 7
+    return total
+
+  def steps_per_sec(duration):
+    n_steps = 0
+    start_time = time.time()
+    while time.time() - start_time < duration:
+      work(10000)
+      n_steps += 1
+    return n_steps / (time.time() - start_time)
+
+  # (about 3s of work, to outlast the 2s of training measured alongside it)
+  n_eval = 6 * 10**7
+  print('%d cores' % multiprocessing.cpu_count())
+  print('nothing else:  %6.1f steps/sec' % steps_per_sec(2))
+  thread = threading.Thread(target=work, args=(n_eval,))
+  thread.daemon = True
+  thread.start()
+  print('eval thread:   %6.1f steps/sec' % steps_per_sec(2))
+  thread.join()
+  worker = EvalWorker(work)
+  worker.submit('eval', n_eval)
+  print('eval process:  %6.1f steps/sec' % steps_per_sec(2))
+  assert worker.results(block=True) == [('eval', work(n_eval))]
+  worker.submit('bad', None)
+  try:
+    worker.results(block=True)
+  except RuntimeError as e:
+    print(str(e).strip().split('\n')[-1])
+  else:
+    raise AssertionError('no error from a bad job')
+  worker.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright 2016 Timothy Dozat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import threading
+import Queue
+
+#***************************************************************
+class Prefetcher(object):
+  """
+    Runs an iterator in a background thread and keeps up to n_ahead of its
+    items waiting in a bounded queue, so that building the next minibatch
+    overlaps with sess.run on the current one. wait_time is how long the
+    consumer has spent blocked on the queue. With n_ahead = 0 the iterator is
+    just run in the calling thread.
+  """
+
+  _END = object()
+
+  #=============================================================
+  def __init__(self, iterable, n_ahead):
+    """"""
+
+    self._n_ahead = n_ahead
+    self.wait_time = 0
+    if n_ahead > 0:
+      self._queue = Queue.Queue(maxsize=n_ahead)
+      self._stopped = threading.Event()
+      self._thread = threading.Thread(target=self._fill, args=(iterable,))
+      self._thread.daemon = True
+      self._thread.start()
+    else:
+      self._iter = iter(iterable)
+    return
+
+  #=============================================================
+  def _fill(self, iterable):
+    """"""
+
+    try:
+      for item in iterable:
+        if not self._put((item, None)):
+          return
+    except Exception:
+      self._put((self._END, sys.exc_info()))
+    else:
+      self._put((self._END, None))
+    return
+
+  #=============================================================
+  def _put(self, item):
+    """"""
+
+    # time out now and then so that close() can't leave the thread blocked forever
+    while not self._stopped.is_set():
+      try:
+        self._queue.put(item, timeout=.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  #=============================================================
+  def close(self):
+    """"""
+
+    if self._n_ahead > 0:
+      self._stopped.set()
+      self._thread.join()
+    return
+
+  #=============================================================
+  def __iter__(self):
+    return self
+
+  def next(self):
+    start_time = time.time()
+    if self._n_ahead > 0:
+      item, exc_info = self._queue.get()
+      self.wait_time += time.time() - start_time
+      if item is self._END:
+        self._thread.join()
+        if exc_info is not None:
+          raise exc_info[0], exc_info[1], exc_info[2]
+        raise StopIteration
+    else:
+      item = next(self._iter)
+      self.wait_time += time.time() - start_time
+    return item
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+
+  # a producer and a consumer that each take 10ms per item should take ~1s
+  # serially and ~.5s with prefetching
+  def slow_range(n):
+    for i in xrange(n):
+      time.sleep(.01)
+      yield i
+
+  for n_ahead in (0, 1, 4):
+    start_time = time.time()
+    prefetcher = Prefetcher(slow_range(50), n_ahead)
+    for i in prefetcher:
+      time.sleep(.01)
+    print('n_ahead = %d: %.3fs total, %.3fs waiting for input' % (n_ahead, time.time() - start_time, prefetcher.wait_time))
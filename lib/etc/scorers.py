@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright 2016 Timothy Dozat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unicodedata
+from collections import Counter, defaultdict
+
+import numpy as np
+
+# In-process versions of bin/eval.pl and bin/srl-eval.pl. Scores are kept
+# for everything added (domain None) and for each domain separately, so a
+# per-domain breakdown doesn't need another pass over the data.
+
+#***************************************************************
+def is_punct(word):
+  """"""
+
+  # eval.pl's test: every character is in a Unicode punctuation category
+  if isinstance(word, str):
+    word = word.decode('utf-8', 'replace')
+  return bool(word) and all(unicodedata.category(char).startswith('P') for char in word)
+
+#***************************************************************
+def prec_rec_f1(n_ok, n_op, n_ms):
+  """"""
+
+  prec = 100 * n_ok / (n_ok + n_op) if n_ok + n_op > 0 else 0.
+  rec = 100 * n_ok / (n_ok + n_ms) if n_ok + n_ms > 0 else 0.
+  f1 = 2 * prec * rec / (prec + rec) if prec + rec > 0 else 0.
+  return prec, rec, f1
+
+#***************************************************************
+def props_phrases(tags):
+  """
+    Reads one predicate's column of CoNLL props tags ('(A0*', '*', '*)', ...)
+    into the (start, end, type, subphrases) of its phrases, where subphrases
+    holds the (start, end) of the phrases directly nested in it. They're in
+    the order srl-eval.pl keeps them: by start, longer ones first. Nested
+    phrases are arguments too; of several phrases over the same span, the
+    innermost one is kept.
+  """
+
+  phrases = {}
+  started = []
+  for i, tag in enumerate(tags):
+    opens, _, closes = tag.partition('*')
+    for phrase_type in opens.split('(')[1:]:
+      started.append((i, phrase_type, []))
+    for _ in xrange(closes.count(')')):
+      start, phrase_type, subphrases = started.pop()
+      phrases.setdefault((start, i), (start, i, phrase_type, tuple(subphrases)))
+      if started:
+        started[-1][2].append((start, i))
+  return [phrases[span] for span in sorted(phrases, key=lambda span: (span[0], -span[1]))]
+
+#***************************************************************
+def _read_sents(filename):
+  """"""
+
+  # the whitespace-split lines of each blank-line separated sentence
+  with open(filename) as f:
+    lines = []
+    for line in f:
+      line = line.split()
+      if line:
+        lines.append(line)
+      elif lines:
+        yield lines
+        lines = []
+    if lines:
+      yield lines
+
+#***************************************************************
+def read_props(filename):
+  """
+    Reads a CoNLL props file into a list with, for each sentence, its length
+    and a dict from the position of each predicate to its phrases.
+  """
+
+  return [_sent_props(lines) for lines in _read_sents(filename)]
+
+def _sent_props(lines):
+  """"""
+
+  # a predicate without a column of its own has no arguments
+  columns = zip(*lines)
+  positions = [i for i, target in enumerate(columns[0]) if target != '-']
+  return len(lines), dict((position, props_phrases(columns[i+1]) if i+1 < len(columns) else [])
+                          for i, position in enumerate(positions))
+
+#***************************************************************
+def read_conll(filename):
+  """
+    Reads the forms, heads and labels of each sentence of a CoNLL file, the
+    fields eval.pl looks at.
+  """
+
+  return [_sent_parse(lines) for lines in _read_sents(filename)]
+
+def _sent_parse(lines):
+  """"""
+
+  return ([line[1] for line in lines],
+          np.array([int(line[6]) for line in lines]),
+          np.array([line[7] for line in lines]))
+
+#***************************************************************
+class ParseScorer(object):
+  """
+    Accumulates eval.pl's labeled and unlabeled attachment and label accuracy
+    scores. Like eval.pl, tokens that are all punctuation aren't scored unless
+    score_on_punct is set.
+  """
+
+  #=============================================================
+  def __init__(self, score_on_punct=False):
+    """"""
+
+    self._score_on_punct = score_on_punct
+    self._punct = {}
+    # scored tokens, right heads, right labels, right heads and labels
+    self._counts = defaultdict(lambda: np.zeros(4, dtype=np.int64))
+    return
+
+  #=============================================================
+  def add(self, words, heads, rels, gold_heads, gold_rels, domain=None):
+    """"""
+
+    if self._score_on_punct:
+      scored = np.ones(len(words), dtype=bool)
+    else:
+      for word in words:
+        if word not in self._punct:
+          self._punct[word] = is_punct(word)
+      scored = ~np.array([self._punct[word] for word in words], dtype=bool)
+    right_heads = (np.asarray(heads) == np.asarray(gold_heads)) & scored
+    right_rels = (np.asarray(rels) == np.asarray(gold_rels)) & scored
+    counts = [np.sum(scored), np.sum(right_heads), np.sum(right_rels), np.sum(right_heads & right_rels)]
+    self._counts[None] += counts
+    if domain is not None:
+      self._counts[domain] += counts
+    return
+
+  #=============================================================
+  def scores(self, domain=None):
+    """"""
+
+    n_tokens, n_heads, n_rels, n_both = self._counts[domain]
+    return {'LAS': 100 * n_both / n_tokens if n_tokens else 0.,
+            'UAS': 100 * n_heads / n_tokens if n_tokens else 0.,
+            'LA': 100 * n_rels / n_tokens if n_tokens else 0.}
+
+  #=============================================================
+  def summary(self, domain=None):
+    """"""
+
+    # the first three lines of eval.pl's output
+    n_tokens, n_heads, n_rels, n_both = self._counts[domain]
+    scores = self.scores(domain)
+    return '\n'.join(['  Labeled   attachment score: %d / %d * 100 = %.2f %%' % (n_both, n_tokens, scores['LAS']),
+                      '  Unlabeled attachment score: %d / %d * 100 = %.2f %%' % (n_heads, n_tokens, scores['UAS']),
+                      '  Label accuracy score:       %d / %d * 100 = %.2f %%' % (n_rels, n_tokens, scores['LA'])])
+
+  #=============================================================
+  @property
+  def domains(self):
+    return sorted(domain for domain in self._counts if domain is not None)
+
+#***************************************************************
+class SRLScorer(object):
+  """
+    Accumulates srl-eval.pl's span-level precision, recall and F1. Arguments
+    are matched by their exact span and role; a C-X phrase continues the
+    last X argument of its predicate into a discontinuous one (or is an X
+    argument if there isn't one), and V isn't counted in the overall score.
+    Predicted predicates with no gold counterpart are skipped and gold
+    predicates with no prediction count all of their arguments as missed.
+  """
+
+  EXCLUDED = set(['V'])
+
+  #=============================================================
+  def __init__(self):
+    """"""
+
+    # keys: 'sents', 'props', 'perfect' and (role, 'ok'/'op'/'ms')
+    self._counts = defaultdict(Counter)
+    return
+
+  #=============================================================
+  @staticmethod
+  def _args(phrases):
+    """"""
+
+    # srl-eval.pl's arguments, as [start, end, role, subphrases] lists. A
+    # C-X phrase is added to the subphrases of the last X argument (after a
+    # copy of its own span, if it had no subphrases yet) and extends its end;
+    # arguments nested in others are shared with them, so the outer ones see
+    # those changes too
+    by_span = dict(((start, end), [start, end, role, list(subphrases)]) for start, end, role, subphrases in phrases)
+    for phrase in by_span.itervalues():
+      phrase[3] = [by_span.get(span, span) for span in phrase[3]]
+    args = []
+    last_args = {}
+    for start, end, role, _ in phrases:
+      phrase = by_span[start, end]
+      if role.startswith('C-') and role[2:] in last_args:
+        arg = last_args[role[2:]]
+        if not arg[3]:
+          arg[3].append((arg[0], arg[1]))
+        arg[3].append(phrase)
+        arg[1] = phrase[1]
+      else:
+        if role.startswith('C-'):
+          phrase[2] = role[2:]
+        args.append(phrase)
+        last_args[phrase[2]] = phrase
+    return args
+
+  #=============================================================
+  @staticmethod
+  def _matches(gold, pred):
+    """"""
+
+    # same role and either both single spans or both the same set of subphrases
+    if gold[2] != pred[2] or bool(gold[3]) != bool(pred[3]):
+      return False
+    gold_spans = set((phrase[0], phrase[1]) for phrase in gold[3])
+    for phrase in pred[3]:
+      if (phrase[0], phrase[1]) not in gold_spans:
+        return False
+      gold_spans.remove((phrase[0], phrase[1]))
+    return not gold_spans
+
+  #=============================================================
+  def add(self, gold_props, pred_props, domain=None):
+    """
+      Adds one sentence. gold_props and pred_props map the position of each
+      predicate to its phrases, as given by props_phrases.
+    """
+
+    counts = Counter({'sents': 1})
+    for position, gold_phrases in gold_props.iteritems():
+      gold_args = {}
+      for arg in self._args(gold_phrases):
+        gold_args[arg[0], arg[1]] = arg
+      prop_counts = Counter()
+      for arg in self._args(pred_props.get(position, [])):
+        gold = gold_args.get((arg[0], arg[1]))
+        if gold is not None and self._matches(gold, arg):
+          del gold_args[arg[0], arg[1]]
+          prop_counts[arg[2], 'ok'] += 1
+        else:
+          prop_counts[arg[2], 'op'] += 1
+      for arg in gold_args.itervalues():
+        prop_counts[arg[2], 'ms'] += 1
+      counts['props'] += 1
+      counts['perfect'] += not any(prop_counts[key] for key in prop_counts if key[0] not in self.EXCLUDED and key[1] != 'ok')
+      counts.update(prop_counts)
+    self._counts[None].update(counts)
+    if domain is not None:
+      self._counts[domain].update(counts)
+    return
+
+  #=============================================================
+  @staticmethod
+  def _roles(counts):
+    """"""
+
+    return set(key[0] for key in counts if isinstance(key, tuple))
+
+  #=============================================================
+  def _totals(self, counts, roles):
+    """"""
+
+    return tuple(sum(counts[role, kind] for role in roles) for kind in ('ok', 'op', 'ms'))
+
+  #=============================================================
+  def scores(self, domain=None):
+    """"""
+
+    counts = self._counts[domain]
+    roles = self._roles(counts)
+    prec, rec, f1 = prec_rec_f1(*self._totals(counts, roles - self.EXCLUDED))
+    return {'P': prec, 'R': rec, 'F1': f1}
+
+  #=============================================================
+  def summary(self, domain=None):
+    """"""
+
+    # srl-eval.pl's output
+    counts = self._counts[domain]
+    roles = self._roles(counts)
+    line = '%10s   %6d  %6d  %6d   %6.2f  %6.2f  %6.2f'
+    lines = ['Number of Sentences    :      %6d' % counts['sents'],
+             'Number of Propositions :      %6d' % counts['props'],
+             'Percentage of perfect props : %6.2f' % (100 * counts['perfect'] / counts['props'] if counts['props'] else 0),
+             '',
+             '%10s   %6s  %6s  %6s   %6s  %6s  %6s' % ('', 'corr.', 'excess', 'missed', 'prec.', 'rec.', 'F1'),
+             '-' * 60]
+    totals = self._totals(counts, roles - self.EXCLUDED)
+    lines.append(line % (('Overall',) + totals + prec_rec_f1(*totals)))
+    lines.append('-' * 10)
+    for role in sorted(roles - self.EXCLUDED):
+      totals = self._totals(counts, [role])
+      lines.append(line % ((role,) + totals + prec_rec_f1(*totals)))
+    lines.append('-' * 60)
+    for role in sorted(roles & self.EXCLUDED):
+      totals = self._totals(counts, [role])
+      lines.append(line % ((role,) + totals + prec_rec_f1(*totals)))
+    lines.append('-' * 60)
+    return '\n'.join(lines) + '\n'
+
+  #=============================================================
+  @property
+  def domains(self):
+    return sorted(domain for domain in self._counts if domain is not None)
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+
+  import os
+  from subprocess import check_output
+
+  # parity with bin/eval.pl and bin/srl-eval.pl on the gold/predicted files
+  # in bin/fixtures (punctuation, nested, reference and continuation args,
+  # missing and extra predicates); run from the root directory
+  fixture = lambda name: os.path.join('bin', 'fixtures', name)
+  with open(os.devnull, 'w') as devnull:
+    for score_on_punct in (False, True):
+      parse_scorer = ParseScorer(score_on_punct=score_on_punct)
+      for (words, heads, rels), (_, gold_heads, gold_rels) in zip(read_conll(fixture('pred-parse.txt')), read_conll(fixture('gold-parse.txt'))):
+        parse_scorer.add(words, heads, rels, gold_heads, gold_rels)
+      parse_eval = check_output(['perl', 'bin/eval.pl', '-g', fixture('gold-parse.txt'), '-s', fixture('pred-parse.txt')] +
+                                (['-p'] if score_on_punct else []), stderr=devnull)
+      assert parse_scorer.summary() == '\n'.join(parse_eval.split('\n')[:3]), parse_scorer.summary()
+      assert '%.2f' % parse_scorer.scores()['LAS'] == parse_eval.split('\n')[0].split()[-2]
+      print('ParseScorer(score_on_punct=%s) matches eval.pl' % score_on_punct)
+
+    srl_scorer = SRLScorer()
+    for (_, gold_props), (_, pred_props) in zip(read_props(fixture('gold-props.txt')), read_props(fixture('pred-props.txt'))):
+      srl_scorer.add(gold_props, pred_props)
+    srl_eval = check_output(['perl', 'bin/srl-eval.pl', fixture('gold-props.txt'), fixture('pred-props.txt')], stderr=devnull)
+    assert srl_scorer.summary() == srl_eval, srl_scorer.summary()
+    assert '%.2f' % srl_scorer.scores()['F1'] == srl_eval.split('\n')[6].split()[-1]
+    print('SRLScorer matches srl-eval.pl')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright 2016 Timothy Dozat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import multiprocessing
+
+# the function being mapped; set before the pool forks so that workers
+# inherit it and bound methods never have to be pickled
+_shard_func = None
+
+#***************************************************************
+def shard_file(filename, n_shards):
+  """
+    Splits a CoNLL file into at most n_shards byte ranges [start, stop), each of
+    which starts at the beginning of a sentence
+  """
+
+  size = os.path.getsize(filename)
+  offsets = [0]
+  with open(filename) as f:
+    for i in xrange(1, n_shards):
+      f.seek(max(size * i // n_shards, offsets[-1]))
+      # throw away the (partial) line we landed in and run on to the next blank line
+      line = f.readline()
+      while line and line.strip():
+        line = f.readline()
+      offset = f.tell()
+      if offset >= size:
+        break
+      if offset > offsets[-1]:
+        offsets.append(offset)
+  offsets.append(size)
+  return zip(offsets[:-1], offsets[1:])
+
+#***************************************************************
+def iter_lines(filename, start=0, stop=None):
+  """"""
+
+  with open(filename) as f:
+    f.seek(start)
+    offset = start
+    for line in f:
+      if stop is not None and offset >= stop:
+        break
+      offset += len(line)
+      yield line
+
+#***************************************************************
+def _call_shard_func(args):
+  return _shard_func(*args)
+
+def map_shards(func, filename, n_workers):
+  """
+    Calls func(filename, start, stop) on each shard of filename, using a pool of
+    n_workers forked processes when n_workers > 1, and returns the results in
+    file order
+  """
+
+  global _shard_func
+
+  shards = [(filename, start, stop) for start, stop in shard_file(filename, max(n_workers, 1))]
+  if len(shards) <= 1:
+    return [func(*shard) for shard in shards]
+
+  _shard_func = func
+  pool = multiprocessing.Pool(min(n_workers, len(shards)))
+  try:
+    return pool.map(_call_shard_func, shards, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+    _shard_func = None
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright 2016 Timothy Dozat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+# sequences are decoded this many at a time, which keeps the
+# (block_size x n_classes x n_classes) scores of each step in cache
+BLOCK_SIZE = 16
+
+#***************************************************************
+def viterbi_decode(scores, lengths, transition_params, block_size=BLOCK_SIZE):
+  """
+    Decodes a whole batch of padded sequences. scores is
+    (n_seqs x max_len x n_classes), lengths holds the true length of each
+    sequence and transition_params[i,j] is the score of going from class i to
+    class j. Gives the same paths (ties included) as running
+    tf.contrib.crf.viterbi_decode on each scores[i,:lengths[i]], with the
+    padding filled with 0.
+  """
+
+  n_seqs, max_len, n_classes = scores.shape
+  lengths = np.asarray(lengths)
+  paths = np.zeros((n_seqs, max_len), dtype=np.int32)
+  # [j,i] so that the max over the previous class runs along the last axis
+  transitions_to = np.ascontiguousarray(np.transpose(transition_params))
+
+  # longest first, so the sequences still running at step t are always a prefix of the block
+  order = np.argsort(-lengths, kind='mergesort')
+  class_idxs = np.arange(n_classes)[None,:]
+  for block_start in xrange(0, n_seqs, block_size):
+    seq_idxs = order[block_start:block_start+block_size]
+    block_lens = lengths[seq_idxs]
+    block_len = np.max(block_lens)
+    if block_len == 0:
+      continue
+    block_scores = scores[seq_idxs, :block_len]
+
+    trellis = block_scores[:,0].copy()
+    backpointers = np.zeros((len(seq_idxs), block_len, n_classes), dtype=np.int32)
+    for t in xrange(1, block_len):
+      n_running = np.sum(block_lens > t)
+      v = trellis[:n_running,None,:] + transitions_to[None]
+      best_prev = np.argmax(v, axis=2)
+      backpointers[:n_running,t] = best_prev
+      trellis[:n_running] = block_scores[:n_running,t] + v[np.arange(n_running)[:,None], class_idxs, best_prev]
+
+    # walk back from the end of each sequence
+    block_idxs = np.arange(len(seq_idxs))
+    best_last = np.argmax(trellis, axis=1)
+    path = best_last
+    for t in xrange(block_len-1, -1, -1):
+      path = np.where(t == block_lens-1, best_last, path)
+      paths[seq_idxs, t] = np.where(t < block_lens, path, 0)
+      if t > 0:
+        path = np.where(t < block_lens, backpointers[block_idxs, t, path], path)
+  return paths
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+
+  import time
+  import tensorflow as tf
+
+  # one minibatch worth of CoNLL-2012 predicates
+  n_classes = 129
+  lengths = np.random.randint(5, 60, size=2000)
+  scores = np.random.randn(len(lengths), np.max(lengths), n_classes).astype(np.float32)
+  transition_params = np.random.randn(n_classes, n_classes).astype(np.float32)
+
+  start_time = time.time()
+  old_paths = [tf.contrib.crf.viterbi_decode(seq_scores[:length], transition_params)[0] for seq_scores, length in zip(scores, lengths)]
+  old_time = time.time() - start_time
+  start_time = time.time()
+  paths = viterbi_decode(scores, lengths, transition_params)
+  new_time = time.time() - start_time
+  assert all(np.array_equal(path[:length], old_path) for path, length, old_path in zip(paths, lengths, old_paths))
+  print('one predicate at a time: %8.1f predicates/sec' % (len(lengths) / old_time))
+  print('batched:                 %8.1f predicates/sec' % (len(lengths) / new_time))
@@ -113,7 +113,7 @@ def linear(inputs, output_size, add_bias=True, n_splits=1, initializer=None, sco
       return new
 
 #===============================================================
-def bilinear(inputs1, inputs2, output_size, add_bias2=True, add_bias1=True, add_bias=False, initializer=None, scope=None, moving_params=None):
+def bilinear(inputs1, inputs2, output_size, add_bias2=True, add_bias1=True, add_bias=False, initializer=None, scope=None, moving_params=None, rank=0):
   """"""
   
   with tf.variable_scope(scope or 'Bilinear'):
@@ -142,28 +142,32 @@ def bilinear(inputs1, inputs2, output_size, add_bias2=True, add_bias1=True, add_
     if add_bias2:
       inputs2 = tf.concat(axis=2, values=[inputs2, tf.ones(tf.stack([batch_size, inputs2_bucket_size, 1]))])
     
-    # Get the matrix
-    if initializer is None and moving_params is None:
-      mat = orthonormal_initializer(inputs1_size+add_bias1, inputs2_size+add_bias2)[:,None,:]
-      mat = np.concatenate([mat]*output_size, axis=1)
-      initializer = tf.constant_initializer(mat)
-    weights = tf.get_variable('Weights', [inputs1_size+add_bias1, output_size, inputs2_size+add_bias2], initializer=initializer)
-    if moving_params is not None:
-      weights = moving_params.average(weights)
+    if rank > 0:
+      # (b x n x r x n)
+      bilin = tf.reshape(low_rank_bilinear(inputs1, inputs2, output_size, rank, initializer=initializer, moving_params=moving_params), output_shape)
     else:
-      tf.add_to_collection('Weights', weights)
-    
-    # Do the multiplications
-    # (bn x d) (d x rd) -> (bn x rd)
-    lin = tf.matmul(tf.reshape(inputs1, [-1, inputs1_size+add_bias1]),
-                        tf.reshape(weights, [inputs1_size+add_bias1, -1]))
-    # (b x nr x d) (b x n x d)T -> (b x nr x n)
-    bilin = tf.matmul(tf.reshape(lin, tf.stack([batch_size, inputs1_bucket_size*output_size, inputs2_size+add_bias2])),
-                                   inputs2, adjoint_b=True)
-    # (bn x r x n)
-    bilin = tf.reshape(bilin, tf.stack([-1, output_size, inputs2_bucket_size]))
-    # (b x n x r x n)
-    bilin = tf.reshape(bilin, output_shape)
+      # Get the matrix
+      if initializer is None and moving_params is None:
+        mat = orthonormal_initializer(inputs1_size+add_bias1, inputs2_size+add_bias2)[:,None,:]
+        mat = np.concatenate([mat]*output_size, axis=1)
+        initializer = tf.constant_initializer(mat)
+      weights = tf.get_variable('Weights', [inputs1_size+add_bias1, output_size, inputs2_size+add_bias2], initializer=initializer)
+      if moving_params is not None:
+        weights = moving_params.average(weights)
+      else:
+        tf.add_to_collection('Weights', weights)
+      
+      # Do the multiplications
+      # (bn x d) (d x rd) -> (bn x rd)
+      lin = tf.matmul(tf.reshape(inputs1, [-1, inputs1_size+add_bias1]),
+                          tf.reshape(weights, [inputs1_size+add_bias1, -1]))
+      # (b x nr x d) (b x n x d)T -> (b x nr x n)
+      bilin = tf.matmul(tf.reshape(lin, tf.stack([batch_size, inputs1_bucket_size*output_size, inputs2_size+add_bias2])),
+                                     inputs2, adjoint_b=True)
+      # (bn x r x n)
+      bilin = tf.reshape(bilin, tf.stack([-1, output_size, inputs2_bucket_size]))
+      # (b x n x r x n)
+      bilin = tf.reshape(bilin, output_shape)
     
     # Get the bias
     if add_bias:
@@ -177,7 +181,7 @@ def bilinear(inputs1, inputs2, output_size, add_bias2=True, add_bias1=True, add_
 
 # ===============================================================
 def bilinear_noreshape(inputs1, inputs2, output_size, add_bias2=True, add_bias1=True, add_bias=False, initializer=None,
-             scope=None, moving_params=None):
+             scope=None, moving_params=None, rank=0):
   """"""
 
   with tf.variable_scope(scope or 'Bilinear'):
@@ -208,29 +212,34 @@ def bilinear_noreshape(inputs1, inputs2, output_size, add_bias2=True, add_bias1=
     if add_bias2:
       inputs2 = tf.concat(axis=2, values=[inputs2, tf.ones(tf.stack([batch_size2, inputs2_bucket_size, 1]))])
 
-    # Get the matrix
-    if initializer is None and moving_params is None:
-      mat = orthonormal_initializer(inputs1_size + add_bias1, inputs2_size + add_bias2)[:, None, :]
-      mat = np.concatenate([mat] * output_size, axis=1)
-      initializer = tf.constant_initializer(mat)
-    weights = tf.get_variable('Weights', [inputs1_size + add_bias1, output_size, inputs2_size + add_bias2],
-                              initializer=initializer)
-    if moving_params is not None:
-      weights = moving_params.average(weights)
-    else:
-      tf.add_to_collection('Weights', weights)
-
     # inputs1: num_triggers_in_batch x 1 x self.trigger_mlp_size
     # inputs2: batch x seq_len x self.role_mlp_size
 
-    # Do the multiplications
-    # (bn x d) (d x rd) -> (bn x rd)
-    lin = tf.matmul(tf.reshape(inputs1, [-1, inputs1_size + add_bias1]), tf.reshape(weights, [inputs1_size + add_bias1, -1]))
-    # (b x nr x d) (b x n x d)T -> (b x nr x n)
-    lin_reshape = tf.reshape(lin, tf.stack([batch_size1, inputs1_bucket_size * output_size, inputs2_size + add_bias2]))
-    bilin = tf.matmul(lin_reshape, inputs2, adjoint_b=True)
-    # (bn x r x n)
-    bilin = tf.reshape(bilin, tf.stack([-1, output_size, inputs2_bucket_size]))
+    if rank > 0:
+      # (bn x r x n)
+      bilin = tf.reshape(low_rank_bilinear(inputs1, inputs2, output_size, rank, initializer=initializer, moving_params=moving_params),
+                         tf.stack([-1, output_size, inputs2_bucket_size]))
+    else:
+      # Get the matrix
+      if initializer is None and moving_params is None:
+        mat = orthonormal_initializer(inputs1_size + add_bias1, inputs2_size + add_bias2)[:, None, :]
+        mat = np.concatenate([mat] * output_size, axis=1)
+        initializer = tf.constant_initializer(mat)
+      weights = tf.get_variable('Weights', [inputs1_size + add_bias1, output_size, inputs2_size + add_bias2],
+                                initializer=initializer)
+      if moving_params is not None:
+        weights = moving_params.average(weights)
+      else:
+        tf.add_to_collection('Weights', weights)
+
+      # Do the multiplications
+      # (bn x d) (d x rd) -> (bn x rd)
+      lin = tf.matmul(tf.reshape(inputs1, [-1, inputs1_size + add_bias1]), tf.reshape(weights, [inputs1_size + add_bias1, -1]))
+      # (b x nr x d) (b x n x d)T -> (b x nr x n)
+      lin_reshape = tf.reshape(lin, tf.stack([batch_size1, inputs1_bucket_size * output_size, inputs2_size + add_bias2]))
+      bilin = tf.matmul(lin_reshape, inputs2, adjoint_b=True)
+      # (bn x r x n)
+      bilin = tf.reshape(bilin, tf.stack([-1, output_size, inputs2_bucket_size]))
     # (b x n x r x n)
     # bilin = tf.reshape(bilin, output_shape)
     # bilin = tf.Print(bilin, [batch_size1, inputs2_bucket_size, output_size, tf.shape(bilin)], "bilin shape")
@@ -244,6 +253,56 @@ def bilinear_noreshape(inputs1, inputs2, output_size, add_bias2=True, add_bias1=
 
     return bilin
 
+#===============================================================
+def low_rank_bilinear(inputs1, inputs2, output_size, rank, initializer=None, scope=None, moving_params=None):
+  """
+    The bilinear scores of (b x n1 x d1) inputs1 and (b x n2 x d2) inputs2 (biases
+    already appended) as a (b x n1 x output_size x n2) tensor, with the weight
+    matrix of each class factored as W_r = U S_r V^T, where U (d1 x rank) and
+    V (d2 x rank) are shared by all the classes and S_r is rank x rank. Both
+    inputs are projected down to rank once, whatever the number of classes,
+    and the last product costs rank instead of d2 per score.
+  """
+
+  with tf.variable_scope(scope or 'LowRank'):
+    inputs1_shape = tf.shape(inputs1)
+    inputs2_shape = tf.shape(inputs2)
+    inputs1_size = inputs1.get_shape().as_list()[-1]
+    inputs2_size = inputs2.get_shape().as_list()[-1]
+
+    # Get the factors. With the classifiers' zero initializer, S starts out at
+    # zero so that W does too, like the full matrix would; U and V can't, or
+    # nothing would ever get a gradient
+    initializer1 = initializer2 = None
+    if moving_params is None:
+      initializer1 = tf.constant_initializer(orthonormal_initializer(inputs1_size, rank))
+      initializer2 = tf.constant_initializer(orthonormal_initializer(inputs2_size, rank))
+      if initializer is None:
+        mat = np.eye(rank)[:,None,:]
+        initializer = tf.constant_initializer(np.concatenate([mat]*output_size, axis=1))
+    weights1 = tf.get_variable('Weights1', [inputs1_size, rank], initializer=initializer1)
+    weights2 = tf.get_variable('Weights2', [inputs2_size, rank], initializer=initializer2)
+    core = tf.get_variable('Core', [rank, output_size, rank], initializer=initializer)
+    if moving_params is not None:
+      weights1 = moving_params.average(weights1)
+      weights2 = moving_params.average(weights2)
+      core = moving_params.average(core)
+    else:
+      tf.add_to_collection('Weights', weights1)
+      tf.add_to_collection('Weights', weights2)
+      tf.add_to_collection('Weights', core)
+
+    # (bn x d) (d x k) (k x rk) -> (b x nr x k)
+    lin1 = tf.matmul(tf.matmul(tf.reshape(inputs1, [-1, inputs1_size]), weights1), tf.reshape(core, [rank, -1]))
+    lin1 = tf.reshape(lin1, tf.stack([inputs1_shape[0], inputs1_shape[1]*output_size, rank]))
+    # (bn x d) (d x k) -> (b x n x k)
+    lin2 = tf.matmul(tf.reshape(inputs2, [-1, inputs2_size]), weights2)
+    lin2 = tf.reshape(lin2, tf.stack([inputs2_shape[0], inputs2_shape[1], rank]))
+    # (b x nr x k) (b x n x k)T -> (b x nr x n) -> (b x n x r x n)
+    bilin = tf.matmul(lin1, lin2, adjoint_b=True)
+    bilin = tf.reshape(bilin, tf.stack([inputs1_shape[0], inputs1_shape[1], output_size, inputs2_shape[1]]))
+    return bilin
+
 #===============================================================
 def diagonal_bilinear(inputs1, inputs2, output_size, add_bias2=True, add_bias1=True, add_bias=False, initializer=None, scope=None, moving_params=None):
   """"""
@@ -367,3 +426,43 @@ if __name__ == '__main__':
     sess.run(tf.global_variables_initializer())
     sess.run(z)
     sess.run(zz)
+
+  import time
+
+  # flops (of the forward matmuls), peak memory and time of a forward and
+  # backward pass of the arc, rel and srl scorers at their default sizes, on a
+  # 32 x 60 bucket with CoNLL-2012's 45 rels, 129 srl labels and a predicate
+  # for every 8th token, with the full weight matrices and with low rank ones
+  def bilinear_flops(batch_size, bucket_size1, bucket_size2, inputs1_size, inputs2_size, output_size, rank):
+    if rank > 0:
+      return 2 * batch_size * rank * (bucket_size1 * inputs1_size + bucket_size2 * inputs2_size + bucket_size1 * output_size * (rank + bucket_size2))
+    return 2 * batch_size * bucket_size1 * output_size * inputs2_size * (inputs1_size + bucket_size2)
+
+  def peak_mb(run_metadata):
+    return max([memory.peak_bytes for dev_stats in run_metadata.step_stats.dev_stats
+                for node_stats in dev_stats.node_stats for memory in node_stats.memory] + [0]) / 2.**20
+
+  batch_size, bucket_size = 32, 60
+  n_predicates = batch_size * bucket_size // 8
+  scorers = [('arc', bilinear, batch_size, bucket_size, bucket_size, 500, 1),
+             ('rel', bilinear, batch_size, bucket_size, bucket_size, 100, 45),
+             ('srl', bilinear_noreshape, n_predicates, 1, bucket_size, 256, 129)]
+  for name, scorer, batch, bucket_size1, bucket_size2, input_size, output_size in scorers:
+    inputs1 = tf.constant(np.random.randn(batch, bucket_size1, input_size), dtype=tf.float32)
+    inputs2 = tf.constant(np.random.randn(batch, bucket_size2, input_size), dtype=tf.float32)
+    for rank in (0, 64, 16):
+      with tf.variable_scope('%s-%d' % (name, rank)):
+        loss = tf.reduce_sum(tf.square(scorer(inputs1, inputs2, output_size, rank=rank)))
+        train_op = tf.gradients(loss, [inputs1, inputs2] + tf.trainable_variables(tf.get_variable_scope().name))
+      with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        run_metadata = tf.RunMetadata()
+        sess.run(train_op, run_metadata=run_metadata, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+        start_time = time.time()
+        for _ in xrange(10):
+          sess.run(train_op)
+        step_time = (time.time() - start_time) / 10
+      print('%s scorer, %s: %8.1f MFLOPs  %7.1f MB peak  %7.1f ms/step' %
+            (name, 'rank %3d' % rank if rank else 'full    ',
+             bilinear_flops(batch, bucket_size1, bucket_size2, input_size+1, input_size+1, output_size, rank) / 1e6,
+             peak_mb(run_metadata), 1000 * step_time))
@@ -24,12 +24,12 @@ import tensorflow as tf
 
 from lib import linalg
 from lib.etc.tarjan import Tarjan
+from lib.etc.mst import mst_decode
 from lib.models import rnn
 from configurable import Configurable
 from vocab import Vocab
 
 import scipy.linalg
-import scipy.sparse.csgraph
 
 float32_eps = np.finfo(np.float32).eps
 
@@ -264,44 +264,51 @@ def dot_product_attention(q, k, v,
     if bias is not None:
       logits += bias
     # first num_capsule_heads capsuled, rest regular
-    weights1 = tf.nn.softmax(logits[:, :num_capsule_heads, :, :], dim=2)
-    weights2 = tf.nn.softmax(logits[:, num_capsule_heads:, :, :], dim=3)
-    weights = tf.concat([weights1, weights2], axis=1, name="attention_weights")
-    # weights is batch x heads x seq_len x seq_len
+    if num_capsule_heads > 0:
+      weights1 = tf.nn.softmax(logits[:, :num_capsule_heads, :, :], dim=2)
+      weights2 = tf.nn.softmax(logits[:, num_capsule_heads:, :, :], dim=3)
+      weights = tf.concat([weights1, weights2], axis=1, name="attention_weights")
+    else:
+      weights = tf.nn.softmax(logits, name="attention_weights")
+    # weights is batch x heads x seq_len x seq_len; the first head's weights
+    # can be swapped out right there along the heads axis, without taking
+    # the heads apart and back together
     if manual_attn is not None:
-      # heads x batch x seq_len x seq_len
-      weights_transpose = tf.transpose(weights, [1, 0, 2, 3])
-      weights_rest = weights_transpose[1:]
-      weights_comb = tf.concat([tf.expand_dims(manual_attn, 0), weights_rest], axis=0)
-      weights = tf.transpose(weights_comb, [1, 0, 2, 3])
+      weights = tf.concat([tf.expand_dims(manual_attn, 1), weights[:, 1:]], axis=1)
     if hard_attn:
-      # heads x batch x seq_len x seq_len
-      weights_transpose = tf.transpose(weights, [1, 0, 2, 3])
-      weights_rest = weights_transpose[1:]
-      w = weights_transpose[0]
-      hard_weights = tf.where(tf.equal(w, tf.tile(tf.expand_dims(tf.reduce_max(w, axis=-1), -1), [1, 1, tf.shape(w)[-1]])), tf.ones_like(w), tf.zeros_like(w))
-      # hard_weights = tf.Print(hard_weights, [hard_weights], "hard weights", summarize=100)
-      # hard_weights = tf.Print(hard_weights, [w], "w", summarize=100)
-      weights_comb = tf.concat([tf.expand_dims(hard_weights, 0), weights_rest], axis=0)
-      weights = tf.transpose(weights_comb, [1, 0, 2, 3])
+      w = weights[:, :1]
+      hard_weights = tf.to_float(tf.equal(w, tf.reduce_max(w, axis=-1, keep_dims=True)))
+      weights = tf.concat([hard_weights, weights[:, 1:]], axis=1)
     # dropping out the attention links for each of the heads
     weights_drop = tf.nn.dropout(weights, dropout_rate)
     return tf.matmul(weights_drop, v), logits
 
 
-def compute_qkv(antecedent, total_key_depth, total_value_depth):
-  """Computes query, key and value.
+def compute_qkv(antecedent, total_key_depth, total_value_depth, num_heads):
+  """Computes query, key and value, split into heads.
   Args:
+    antecedent: a Tensor with shape [batch, length, total_key_depth]
     total_key_depth: an integer
     total_value_depth: and integer
+    num_heads: an integer dividing total_key_depth and total_value_depth
   Returns:
-    q, k, v : [batch, length, depth] tensors
+    q, k, v : [batch, heads, length, depth / heads] tensors
   """
+  # stored as the kernel of a 1x1 convolution, which is just a matmul
   params = tf.get_variable("qkv_transform", [1, 1, total_key_depth, 2*total_key_depth + total_value_depth])
-  antecedent = tf.expand_dims(antecedent, 1)
-  qkv_combined = tf.nn.conv2d(antecedent, params, [1, 1, 1, 1], "SAME")
-  qkv_combined = tf.squeeze(qkv_combined, 1)
-  q, k, v = tf.split(qkv_combined, [total_key_depth, total_key_depth, total_value_depth], axis=2)
+  antecedent_shape = tf.shape(antecedent)
+  qkv_combined = tf.matmul(tf.reshape(antecedent, [-1, total_key_depth]),
+                           tf.reshape(params, [total_key_depth, 2*total_key_depth + total_value_depth]))
+  if total_key_depth == total_value_depth:
+    # [3, batch, heads, length, depth / heads] with a single transpose
+    qkv_combined = tf.reshape(qkv_combined, tf.stack([antecedent_shape[0], antecedent_shape[1], 3, num_heads, total_key_depth // num_heads]))
+    q, k, v = tf.unstack(tf.transpose(qkv_combined, [2, 0, 3, 1, 4]))
+  else:
+    qkv_combined = tf.reshape(qkv_combined, tf.stack([antecedent_shape[0], antecedent_shape[1], 2*total_key_depth + total_value_depth]))
+    q, k, v = tf.split(qkv_combined, [total_key_depth, total_key_depth, total_value_depth], axis=2)
+    q = split_heads(q, num_heads)
+    k = split_heads(k, num_heads)
+    v = split_heads(v, num_heads)
   return q, k, v
 
 
@@ -408,18 +415,16 @@ def multihead_attention(antecedent,
     raise ValueError("Value depth (%d) must be divisible by the number of "
                      "attention heads (%d)." % (total_value_depth, num_heads))
   with tf.variable_scope(name, default_name="multihead_attention", values=[antecedent]):
-    q, k, v = compute_qkv(antecedent, total_key_depth, total_value_depth)
-    q = split_heads(q, num_heads)
-    k = split_heads(k, num_heads)
-    v = split_heads(v, num_heads)
+    q, k, v = compute_qkv(antecedent, total_key_depth, total_value_depth, num_heads)
     key_depth_per_head = total_key_depth // num_heads
     q *= key_depth_per_head**-0.5
     x, attn_weights = dot_product_attention(q, k, v, bias, dropout_rate, num_capsule_heads, manual_attn, hard_attn)
     x = combine_heads(x)
+    # also a 1x1 convolution kernel
     params = tf.get_variable("final_proj", [1, 1, total_key_depth, output_depth])
-    x = tf.expand_dims(x, 1)
-    x = tf.nn.conv2d(x, params, [1, 1, 1, 1], "SAME")
-    x = tf.squeeze(x, 1)
+    x_shape = tf.shape(x)
+    x = tf.matmul(tf.reshape(x, [-1, total_key_depth]), tf.reshape(params, [total_key_depth, output_depth]))
+    x = tf.reshape(x, tf.stack([x_shape[0], x_shape[1], output_depth]))
     return x, attn_weights
 
 
@@ -447,6 +452,86 @@ def conv_hidden_relu(inputs,
     return ret
 
 
+
+def find_cycles(heads, tokens_to_keep):
+  """Checks a batch of head predictions for cycles by pointer jumping.
+  Args:
+    heads: an int32 Tensor with shape [batch, length], where token i's head is
+      heads[b, i] and heads[b, i] == i makes it the root
+    tokens_to_keep: a float Tensor with shape [batch, length], 0 for padding
+  Returns:
+    n_cycles: a bool Tensor with shape [batch], whether some tokens are in a
+      cycle of 3 or more (what find_cycles_svd's laplacian test tells)
+    len_2_cycles: a bool Tensor with shape [batch], whether any two tokens
+      are each other's heads
+  """
+  tokens = tf.zeros_like(heads) + tf.range(tf.shape(heads)[1])
+  sents = tf.zeros_like(heads) + tf.expand_dims(tf.range(tf.shape(heads)[0]), 1)
+  # per-sentence params[b, idxs[b, i]]
+  gather = lambda params, idxs: tf.gather_nd(params, tf.stack([sents, idxs], -1))
+  # padding points at itself, like the root, so that it never leads anywhere
+  heads = tf.where(tf.cast(tokens_to_keep, tf.bool), heads, tokens)
+  # 2^k >= length steps up from any token end up on the cycle (or the root)
+  # its chain of heads runs into, which takes k gathers
+  n_jumps = tf.to_int32(tf.ceil(tf.log(tf.to_float(tf.maximum(tf.shape(heads)[1], 2))) / np.log(2.)))
+  _, ancestors = tf.while_loop(lambda i, ancestors: i < n_jumps,
+                               lambda i, ancestors: (i+1, gather(ancestors, ancestors)),
+                               [tf.constant(0), heads])
+  grandheads = gather(heads, heads)
+  # a token on a cycle of 3 or more is neither its head nor its grandhead
+  n_cycles = tf.reduce_any(tf.logical_and(tf.not_equal(gather(heads, ancestors), ancestors),
+                                          tf.not_equal(gather(grandheads, ancestors), ancestors)), axis=1)
+  len_2_cycles = tf.reduce_any(tf.logical_and(tf.equal(grandheads, tokens), tf.not_equal(heads, tokens)), axis=1)
+  return n_cycles, len_2_cycles
+
+
+def find_cycles_svd(heads, tokens_to_keep):
+  """Checks a batch of head predictions for cycles from the rank of the
+  laplacian of their undirected graph: there's a cycle iff the graph has
+  more edges (half the laplacian's trace) than a forest could, which is its
+  rank. Takes an svd per sentence, and in float32 the rank can come out too
+  high and a cycle be missed; find_cycles answers the same question exactly.
+  Args:
+    heads: an int32 Tensor with shape [batch, length]
+    tokens_to_keep: a float Tensor with shape [batch, length], 0 for padding
+  Returns:
+    n_cycles, len_2_cycles: bool Tensors with shape [batch]
+  """
+  batch_size = tf.shape(heads)[0]
+  bucket_size = tf.shape(heads)[1]
+  tokens_to_keep3D = tf.expand_dims(tokens_to_keep, 2)
+  i1, i2 = tf.meshgrid(tf.range(batch_size), tf.range(bucket_size), indexing="ij")
+  idx = tf.stack([i1, i2, heads], axis=-1)
+  adj = tf.scatter_nd(idx, tf.ones([batch_size, bucket_size]), [batch_size, bucket_size, bucket_size])
+  adj = adj * tokens_to_keep3D
+
+  # zero out diagonal
+  adj = tf.matrix_set_diag(adj, tf.zeros([batch_size, bucket_size]))
+  # make it undirected
+  undirected_adj = tf.cast(tf.logical_or(tf.cast(adj, tf.bool), tf.cast(tf.transpose(adj, [0, 2, 1]) * tokens_to_keep3D, tf.bool)), tf.float32)
+
+  # compute laplacian & its trace
+  degrees = tf.reduce_sum(undirected_adj, axis=1)
+  l_trace = tf.reduce_sum(degrees, axis=1)
+  laplacian = tf.matrix_set_diag(-undirected_adj, degrees)
+
+  # 1 where i->j and j->i are both set in adj
+  pairs = tf.multiply(adj, tf.transpose(adj, [0, 2, 1]))
+  len_2_cycles = tf.greater(tf.reduce_sum(tf.reshape(pairs, [batch_size, -1]), axis=-1), tf.constant(0.))
+
+  with tf.device('/cpu:0'):
+    s = tf.svd(laplacian, compute_uv=False)
+
+  # this is what matlab does (maybe the numpy one is more suitable for QR? idk)
+  tol = tf.cast(tf.reduce_max(tf.shape(laplacian)), tf.float32) * float32_eps
+
+  l_rank = tf.reduce_sum(tf.cast(tf.greater(s, tol), tf.float32), axis=1)
+
+  # cycles iff: 0.5 * l_trace >= l_rank + 1
+  n_cycles = tf.greater_equal(0.5 * l_trace, l_rank + 1)
+  return n_cycles, len_2_cycles
+
+
 #***************************************************************
 class NN(Configurable):
   """"""
@@ -802,7 +887,8 @@ class NN(Configurable):
                             add_bias1=add_bias1,
                             add_bias2=add_bias2,
                             initializer=tf.zeros_initializer(),
-                            moving_params=self.moving_params)
+                            moving_params=self.moving_params,
+                            rank=self.bilinear_rank)
     output = tf.squeeze(bilin)
     return output
   
@@ -937,7 +1023,8 @@ class NN(Configurable):
                      add_bias1=add_bias1,
                      add_bias2=add_bias2,
                      initializer=tf.zeros_initializer(),
-                     moving_params=self.moving_params)
+                     moving_params=self.moving_params,
+                     rank=self.bilinear_rank)
     weighted_bilin = tf.matmul(bilin, tf.expand_dims(probs, 3))
     
     return weighted_bilin, bilin
@@ -988,7 +1075,8 @@ class NN(Configurable):
                             add_bias1=add_bias1,
                             add_bias2=add_bias2,
                             initializer=tf.zeros_initializer(),
-                            moving_params=self.moving_params)
+                            moving_params=self.moving_params,
+                            rank=self.bilinear_rank)
     # weighted_bilin = tf.matmul(bilin, tf.expand_dims(probs, 3))
 
     return bilin
@@ -1218,7 +1306,7 @@ class NN(Configurable):
     return output
 
   # =============================================================
-  def output_srl_gather(self, logits_transposed, targets, trigger_predictions, transition_params):
+  def output_srl_gather(self, logits_transposed, targets, trigger_predictions, transition_params, decode_transition_params=None):
     """"""
 
     # logits are triggers_in_batch x num_classes x seq_len
@@ -1256,6 +1344,14 @@ class NN(Configurable):
 
     trigger_counts = tf.reduce_sum(trigger_predictions, -1)
 
+    # constrained (viterbi) decoding of each predicate's labels, done here so
+    # that only the int32 labels ever have to leave the graph
+    if decode_transition_params is not None:
+      decode_seq_lens = tf.cast(tf.reduce_sum(mask, 1), tf.int32)
+      viterbi_predictions, _ = tf.contrib.crf.crf_decode(logits_transposed, decode_transition_params, decode_seq_lens)
+    else:
+      viterbi_predictions = predictions
+
     def compute_srl_loss(logits_transposed, srl_targets_transposed, transition_params):
       # batch*num_targets x seq_len
       srl_targets_indices = tf.where(tf.sequence_mask(tf.reshape(trigger_counts, [-1])))
@@ -1309,6 +1405,7 @@ class NN(Configurable):
       'loss': loss,
       'probabilities': probabilities,
       'predictions': predictions,
+      'viterbi_predictions': viterbi_predictions,
       'logits': logits_transposed,
       'transition_params': tf.constant(0.),
       'count': count,
@@ -1539,84 +1636,12 @@ class NN(Configurable):
 
   ########### cycles ##########
   def compute_cycles(self, logits2D_masked, tokens_to_keep3D, batch_size, bucket_size):
-    # construct predicted adjacency matrix
-
-    # # max values for every token (flattened across batches)
-    # # mask = (1 - tokens_to_keep3D) * -(tf.abs(tf.reduce_min(logits3D)) + tf.abs(tf.reduce_max(logits3D)))
-    # # logits3D_masked = logits3D + mask
-    # # logits3D_masked = tf.transpose(mask, [0, 2, 1]) + logits3D_masked
-    # # logits2D_masked = tf.reshape(logits3D_masked, [batch_size * bucket_size, -1])
-    # maxes = tf.expand_dims(tf.reduce_max(logits2D_masked, axis=1), -1)
-    # # tile the maxes across rows
-    # maxes_tiled = tf.tile(maxes, [1, bucket_size])
-    # # 1 where logits2d == max, 0 elsewhere
-    # adj_flat = tf.cast(tf.equal(logits2D_masked, maxes_tiled), tf.float32)
-    # # zero out padding
-    # adj_flat = adj_flat * tf.reshape(tokens_to_keep3D, [-1, 1])
-    # # reshape into [batch, bucket, bucket]
-    # adj = tf.reshape(adj_flat, [batch_size, bucket_size, bucket_size])
-    max_vals = tf.cast(tf.argmax(tf.reshape(logits2D_masked, [batch_size, bucket_size, bucket_size]), axis=2), tf.int32)
-    i1, i2 = tf.meshgrid(tf.range(batch_size), tf.range(bucket_size), indexing="ij")
-    idx = tf.stack([i1, i2, max_vals], axis=-1)
-    adj = tf.scatter_nd(idx, tf.ones([batch_size, bucket_size]), [batch_size, bucket_size, bucket_size])
-    adj = adj * tokens_to_keep3D
-
-
-
-    # zero out diagonal
-    adj = tf.matrix_set_diag(adj, tf.zeros([batch_size, bucket_size]))
-    # make it undirected
-    undirected_adj = tf.cast(tf.logical_or(tf.cast(adj, tf.bool), tf.cast(tf.transpose(adj, [0, 2, 1]) * tokens_to_keep3D, tf.bool)), tf.float32)
-
-    # compute laplacian & its trace
-    degrees = tf.reduce_sum(undirected_adj, axis=1)
-    l_trace = tf.reduce_sum(degrees, axis=1)
-    laplacian = tf.matrix_set_diag(-undirected_adj, degrees)
-
-    # 1 where i->j and j->i are both set in adj
-    pairs = tf.multiply(adj, tf.transpose(adj, [0, 2, 1]))
-    len_2_cycles = tf.greater(tf.reduce_sum(tf.reshape(pairs, [batch_size, -1]), axis=-1), tf.constant(0.))
-
-    # svd_loss = 0.
-    # try:
-    # s = tf.py_func(np.linalg.svd, [laplacian, False, False], [laplacian.dtype])
-    with tf.device('/cpu:0'):
-      s = tf.svd(laplacian, compute_uv=False)
-
-    # this is the tol used in numpy.linalg.matrix_rank
-    # tol = tf.reduce_max(s) * tf.cast(tf.reduce_max(tf.shape(laplacian)), tf.float32) * np.finfo(np.float32).eps
-
-    # this is what matlab does (maybe the numpy one is more suitable for QR? idk)
-    tol = tf.cast(tf.reduce_max(tf.shape(laplacian)), tf.float32) * float32_eps
-
-    l_rank = tf.reduce_sum(tf.cast(tf.greater(s, tol), tf.float32), axis=1)
-
-    # cycles iff: 0.5 * l_trace >= l_rank + 1
-    n_cycles = tf.greater_equal(0.5 * l_trace, l_rank + 1)
-
-    # svd_loss = tf.maximum(0.5 * l_trace - (l_rank + 1), tf.constant(0.0))
-    # svd_loss_masked = self.tokens_to_keep3D * svd_loss
-    # svd_loss = self.svd_penalty * tf.reduce_sum(svd_loss)  # / self.n_tokens
-    # except np.linalg.linalg.LinAlgError:
-    #   print("SVD did not converge")
-
-    # n_cycles = tf.cond(tf.equal(l_trace, 70), lambda: tf.Print(n_cycles, [s], "eigenvalues", summarize=50), lambda: n_cycles)
-
-    # ij_0 = (tf.constant(0), n_cycles)
-    # c = lambda i, j: i < batch_size
-    # b = lambda i, j: tf.cond(tf.equal(l_trace[i], 84), lambda: (i+1, tf.Print(n_cycles, [s[i], l_rank[i], tol], "eigenvalues", summarize=50)), lambda: (i+1, n_cycles))
-    # _, n_cycles = tf.while_loop(c, b, ij_0)
-
-    # n_cycles = tf.Print(n_cycles, [tf.reduce_sum(tf.cast(n_cycles, tf.int32))], "n_cycles in batch", summarize=50)
-    # len_2_cycles = tf.Print(len_2_cycles, [tf.reduce_sum(tf.cast(len_2_cycles, tf.int32))], "len_2_cycles in batch", summarize=50)
-
-    # logits3D = tf.reshape(logits2D_masked, [batch_size, bucket_size, bucket_size])
-    # ij_0 = (tf.constant(0), n_cycles)
-    # c = lambda i, j: i < batch_size
-    # b = lambda i, j: tf.cond(tf.logical_or(n_cycles[i], len_2_cycles[i]), lambda: (i + 1, tf.Print(n_cycles, [adj[i], logits3D[i]], summarize=10000)), lambda: (i + 1, n_cycles))
-    # _, n_cycles = tf.while_loop(c, b, ij_0)
-
-    return n_cycles, len_2_cycles
+    # the predicted heads, checked by pointer jumping rather than the svd of
+    # their laplacian (find_cycles_svd); as floats, like output_svd's -1s
+    # when there's nothing to check
+    heads = tf.to_int32(tf.argmax(tf.reshape(logits2D_masked, [batch_size, bucket_size, bucket_size]), axis=2))
+    n_cycles, len_2_cycles = find_cycles(heads, tf.squeeze(tokens_to_keep3D, 2))
+    return tf.to_float(n_cycles), tf.to_float(len_2_cycles)
 
 
   ######### roots loss (diag) ##########
@@ -1714,38 +1739,18 @@ class NN(Configurable):
     # has_cycle = len_2_cycles or (0.5 * np.trace(laplacian) >= rank + 1)
     return int(len_2_cycles), int((0.5 * np.trace(laplacian) >= rank + 1))
 
-  # ensure at least one root
-  def ensure_gt_one_root(self, parse_preds, parse_probs, tokens):
-    # The current root probabilities
-    root_probs = np.diagonal(parse_probs[tokens])
-    # The current head probabilities
-    old_head_probs = parse_probs[tokens, parse_preds[tokens]]
-    # Get new potential root probabilities
-    new_root_probs = root_probs / old_head_probs
-    # Select the most probable root
-    new_root = tokens[np.argmax(new_root_probs)]
-    # Make the change
-    parse_preds[new_root] = new_root
-    return parse_preds
-
-  # ensure at most one root
-  def ensure_lt_two_root(self, parse_preds, parse_probs, roots, tokens):
-    # The probabilities of the current heads
-    root_probs = parse_probs[roots, roots]
-    # Set the probability of depending on the root zero
-    parse_probs[roots, roots] = 0
-    # Get new potential heads and their probabilities
-    new_heads = np.argmax(parse_probs[roots][:, tokens], axis=1) # + 1
-    new_head_probs = parse_probs[roots, new_heads] / root_probs
-    # Select the most probable root
-    new_root = roots[np.argmin(new_head_probs)]
-    # Make the change
-    parse_preds[roots] = new_heads
-    parse_preds[new_root] = new_root
-    return parse_preds
-
   #=============================================================
-  def parse_argmax(self, parse_probs, tokens_to_keep, n_cycles=-1, len_2_cycles=-1):
+  def parse_trees(self, mb_parse_probs, mb_tokens_to_keep):
+    """"""
+    
+    # the best single-rooted tree for each sentence in the minibatch
+    mb_parse_probs = mb_parse_probs * mb_tokens_to_keep[:,None,:]
+    with np.errstate(divide='ignore'):
+      mb_log_probs = np.log(mb_parse_probs)
+    return mst_decode(mb_log_probs, np.sum(mb_tokens_to_keep, axis=1))
+  
+  #=============================================================
+  def parse_argmax(self, parse_probs, tokens_to_keep, n_cycles=-1, len_2_cycles=-1, tree_preds=None):
     """"""
     # tokens_to_keep[0] = True
     length = np.sum(tokens_to_keep)
@@ -1767,53 +1772,9 @@ class NN(Configurable):
       # len_2_cycles, n_cycles = self.check_cycles_svd(parse_preds, length)
 
     if self.ensure_tree:
-      if roots_lt:
-        parse_preds = self.ensure_gt_one_root(parse_preds, parse_probs, tokens)
-      elif roots_gt:
-        parse_preds = self.ensure_lt_two_root(parse_preds, parse_probs, roots, tokens)
-
-      # root_probs = np.diag(parse_probs)
-      # parse_probs_no_roots = parse_probs * (1 - np.eye(parse_probs.shape[0]))
-      # parse_probs_roots_aug = np.hstack([np.expand_dims(root_probs, -1), parse_probs_no_roots])
-      # # parse_probs_roots_aug = np.vstack([np.zeros(parse_probs.shape[0]+1), parse_probs_roots_aug])
-      # parse_preds_roots_aug = np.argmax(parse_probs_roots_aug, axis=1)
-      #
-      # np.set_printoptions(threshold=np.nan)
-      #
-      # coo = scipy.sparse.coo_matrix((np.ones(length), (np.arange(1, length + 1), parse_preds_roots_aug[:length])),
-      #                               shape=(length + 1, length + 1))
-      coo2 = scipy.sparse.coo_matrix((np.ones(length), (tokens, parse_preds[:length])), shape=(length, length))
-      cc_count, ccs = scipy.sparse.csgraph.connected_components(coo2, directed=True, connection='weak', return_labels=True)
-      if (cc_count > 1 and( n_cycles == 0 and len_2_cycles == 0)) or (cc_count == 1 and (n_cycles > 0 or len_2_cycles > 0)):
-        # _, sizes = np.unique(ccs, return_counts=True)
-        # len_2_cycles_tar = np.any(sizes == 2)
-        # n_cycles_tar = np.any(sizes != 2)
-        print("SVD: len_2_cycles: %d; n_cycles: %d" % (len_2_cycles, n_cycles))
-        print("Tarjan: n_cycles: %d" % (cc_count > 1))
-        print("labels: ", ccs)
-        # a = coo.toarray()
-        # for r in a:
-        #   print(' '.join(map(str, r)))
-
-        a = coo2.toarray()
-        for r in a:
-          print("[%s]," % ', '.join(map(str, r)))
-
-      if not self.svd_tree or len_2_cycles or n_cycles:
-        root_probs = np.diag(parse_probs)
-        parse_probs_no_roots = parse_probs * (1 - np.eye(parse_probs.shape[0]))
-        parse_probs_roots_aug = np.hstack([np.expand_dims(root_probs, -1), parse_probs_no_roots])
-        parse_probs_roots_aug = np.vstack([np.zeros(parse_probs.shape[0]+1), parse_probs_roots_aug])
-        mst = scipy.sparse.csgraph.minimum_spanning_tree(-parse_probs_roots_aug)
-        mst_arr = mst.toarray()[1:length+1]
-        roots = mst_arr[:,0]
-        mst_arr = mst_arr[:,1:length+1]
-        mst_arr[tokens, tokens] = roots
-        parse_preds = np.argmin(mst_arr, axis=1)
-
-        # print("tree parse preds", parse_preds)
-
-
+      if tree_preds is None:
+        tree_preds = self.parse_trees(parse_probs[None], tokens_to_keep[None])[0]
+      parse_preds = tree_preds
 
     # # if ensure_tree:
     #   len_2_cycles = n_cycles = 0
@@ -1903,3 +1864,64 @@ class NN(Configurable):
   # @property
   # def global_sigmoid(self):
   #   return self._global_sigmoid
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+
+  import time
+
+  # time and memory allocated in a forward and backward pass of one self-attention
+  # layer on the CPU, at conll05's 8 heads of 64, with the first head's
+  # weights left alone, swapped for given ones and hardened
+  def allocated_mb(run_metadata):
+    return sum([memory.total_bytes for dev_stats in run_metadata.step_stats.dev_stats
+                for node_stats in dev_stats.node_stats for memory in node_stats.memory]) / 2.**20
+
+  batch_size, num_heads, head_size = 16, 8, 64
+  hidden_size = num_heads * head_size
+  for bucket_size in (64, 128):
+    inputs = tf.constant(np.random.randn(batch_size, bucket_size, hidden_size), dtype=tf.float32)
+    lengths = np.random.randint(bucket_size//2, bucket_size+1, size=batch_size)
+    lengths[0] = bucket_size
+    bias = attention_bias_ignore_padding(tf.constant(lengths))
+    manual_attn = tf.nn.softmax(tf.constant(np.random.randn(batch_size, bucket_size, bucket_size), dtype=tf.float32))
+    for name, attn_args in (('plain', (None, False)), ('manual', (manual_attn, False)), ('hard', (None, True))):
+      with tf.variable_scope('%s-%d' % (name, bucket_size)):
+        outputs, _ = multihead_attention(inputs, bias, hidden_size, hidden_size, hidden_size, num_heads, .9, 0, *attn_args)
+        train_op = tf.gradients(tf.reduce_sum(tf.square(outputs)), [inputs] + tf.trainable_variables(tf.get_variable_scope().name))
+      with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        run_metadata = tf.RunMetadata()
+        sess.run(train_op, run_metadata=run_metadata, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+        start_time = time.time()
+        for _ in xrange(20):
+          sess.run(train_op)
+        step_time = (time.time() - start_time) / 20
+      print('L=%3d %-6s  %7.1f MB allocated  %7.1f ms/layer' % (bucket_size, name, allocated_mb(run_metadata), 1000 * step_time))
+
+  # cycle checks of svd_tree on a batch of random trees, a third of them with
+  # 2 to 5 of their tokens made into a cycle
+  heads = tf.placeholder(tf.int32, [None, None])
+  tokens_to_keep = tf.placeholder(tf.float32, [None, None])
+  cycles = find_cycles(heads, tokens_to_keep)
+  cycles_svd = find_cycles_svd(heads, tokens_to_keep)
+  for bucket_size in (50, 100, 200):
+    lengths = np.random.randint(bucket_size//2, bucket_size+1, size=batch_size)
+    lengths[0] = bucket_size
+    feed_heads = np.zeros([batch_size, bucket_size], dtype=np.int32)
+    for sent_heads, length in zip(feed_heads, lengths):
+      order = np.random.permutation(length)
+      sent_heads[order] = [order[np.random.randint(i)] if i else order[0] for i in xrange(length)]
+      if np.random.rand() < 1/3:
+        cycle = np.random.permutation(length)[:np.random.randint(2, 6)]
+        sent_heads[cycle] = np.roll(cycle, 1)
+    feed_dict = {heads: feed_heads, tokens_to_keep: np.arange(bucket_size) < lengths[:,None]}
+    with tf.Session() as sess:
+      for name, fetches in (('pointer jumping', cycles), ('svd', cycles_svd)):
+        sess.run(fetches, feed_dict=feed_dict)
+        start_time = time.time()
+        for _ in xrange(20):
+          n_cycles, len_2_cycles = sess.run(fetches, feed_dict=feed_dict)
+        step_time = (time.time() - start_time) / 20
+        print('L=%3d %-15s  %7.2f ms/batch  %2d with cycles, %2d with 2-cycles' % (bucket_size, name, 1000 * step_time, np.sum(n_cycles), np.sum(len_2_cycles)))
@@ -19,11 +19,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import time
+
 import numpy as np
 import tensorflow as tf
 
 from vocab import Vocab
 from lib.models import NN
+from lib.etc.viterbi import viterbi_decode
 
 #***************************************************************
 class BaseParser(NN):
@@ -36,7 +39,7 @@ class BaseParser(NN):
     raise NotImplementedError
   
   #=============================================================
-  def prob_argmax(self, parse_probs, rel_probs, tokens_to_keep, n_cycles=-1, len_2_cycles=-1):
+  def prob_argmax(self, parse_probs, rel_probs, tokens_to_keep, n_cycles=-1, len_2_cycles=-1, tree_preds=None):
     """"""
     
     raise NotImplementedError
@@ -67,6 +70,8 @@ class BaseParser(NN):
     """"""
     
     sents = []
+    # without ensure_tree there's nothing to repair, so these are the heads
+    # and labels the graph already picked rather than their probabilities
     mb_parse_probs, mb_rel_probs = mb_probs
     total_time = 0.0
     roots_lt_total = 0.
@@ -89,14 +94,37 @@ class BaseParser(NN):
 
     # print("srl_preds", srl_preds.shape, srl_preds)
     # print("srl_trigger", srl_triggers.shape, srl_triggers)
+    if transition_params is not None:
+      # decode every predicted predicate in the minibatch at once; each one
+      # runs the length of its sentence
+      mb_lengths = np.sum(np.greater(mb_inputs[:,:,0], Vocab.ROOT), axis=1)
+      mb_n_preds = np.sum(np.equal(srl_triggers, 1) & (np.arange(srl_triggers.shape[1]) < mb_lengths[:,None]), axis=1)
+      pred_lengths = np.repeat(mb_lengths, mb_n_preds)
+      srl_preds = srl_preds.copy()
+      srl_preds[:len(pred_lengths), :np.max(mb_lengths)] = viterbi_decode(srl_logits[:len(pred_lengths), :np.max(mb_lengths)], pred_lengths, transition_params)
+
+    if self.ensure_tree:
+      # decode the trees for the whole minibatch at once
+      start_time = time.time()
+      mb_tree_preds = self.parse_trees(mb_parse_probs, np.greater(mb_inputs[:,:,0], Vocab.ROOT))
+      total_time += time.time() - start_time
+    else:
+      mb_tree_preds = [None] * len(mb_inputs)
+
     srl_pred_idx = 0
     n_tokens = 0.
-    for inputs, targets, parse_probs, rel_probs, n_cycle, len_2_cycle, srl_trigger, srl_trigger_target, pos_pred in zip(mb_inputs, mb_targets, mb_parse_probs, mb_rel_probs, n_cycles, len_2_cycles, srl_triggers, srl_trigger_targets, pos_preds):
+    for inputs, targets, parse_probs, rel_probs, n_cycle, len_2_cycle, srl_trigger, srl_trigger_target, pos_pred, tree_preds in zip(mb_inputs, mb_targets, mb_parse_probs, mb_rel_probs, n_cycles, len_2_cycles, srl_triggers, srl_trigger_targets, pos_preds, mb_tree_preds):
       tokens_to_keep = np.greater(inputs[:,0], Vocab.ROOT)
       length = np.sum(tokens_to_keep)
       n_tokens += length
-      parse_preds, rel_preds, argmax_time, roots_lt, roots_gt = self.prob_argmax(parse_probs, rel_probs, tokens_to_keep, n_cycle, len_2_cycle)
-      total_time += argmax_time
+      if self.ensure_tree:
+        parse_preds, rel_preds, argmax_time, roots_lt, roots_gt = self.prob_argmax(parse_probs, rel_probs, tokens_to_keep, n_cycle, len_2_cycle, tree_preds)
+        total_time += argmax_time
+      else:
+        parse_preds, rel_preds = parse_probs, rel_probs
+        n_roots = np.sum(np.equal(parse_preds[:length], np.arange(length)))
+        roots_lt = 1. if n_roots < 1 else 0.
+        roots_gt = 1. if n_roots > 1 else 0.
       roots_lt_total += roots_lt
       roots_gt_total += roots_gt
       cycles_2_total += int(len_2_cycle)
@@ -120,14 +148,6 @@ class BaseParser(NN):
 
       # print("srl pred", len(srl_pred), srl_pred)
 
-      if transition_params is not None and num_pred_srls > 0:
-        srl_unary_scores = srl_logits[srl_pred_idx:srl_pred_idx+num_pred_srls, tokens]
-        # print("unary scores shape", srl_unary_scores.shape)
-        for pred_idx, single_pred_unary_scores in enumerate(srl_unary_scores):
-          viterbi_sequence, _ = tf.contrib.crf.viterbi_decode(single_pred_unary_scores, transition_params)
-          # print("viterbi seq", len(viterbi_sequence), viterbi_sequence)
-          srl_pred[pred_idx] = viterbi_sequence
-
       srl_pred_idx += num_pred_srls
 
       # print("s_pred shape", srl_pred.shape)
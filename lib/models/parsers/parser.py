@@ -287,8 +287,8 @@ class Parser(BaseParser):
                                                            self.attn_dropout, self.relu_dropout, self.prepost_dropout,
                                                            self.relu_hidden_size, self.info_func, self.ff_kernel, reuse,
                                                            this_layer_capsule_heads, manual_attn, hard_attn)
-                # head x batch x seq_len x seq_len
-                attn_weights_by_layer[i] = tf.transpose(attn_weights, [1, 0, 2, 3])
+                # batch x head x seq_len x seq_len
+                attn_weights_by_layer[i] = attn_weights
 
                 if i == self.pos_layer:
                   pos_pred_inputs = top_recur
@@ -429,13 +429,13 @@ class Parser(BaseParser):
     ##### MULTITASK ATTN LOSS ######
     if not self.full_parse:
       for l, attn_weights in attn_weights_by_layer.iteritems():
-        # attn_weights is: head x batch x seq_len x seq_len
+        # attn_weights is: batch x head x seq_len x seq_len
         # idx into attention heads
         attn_idx = self.num_capsule_heads
         cap_attn_idx = 0
         if 'parents' in self.multi_layers.keys() and l in self.multi_layers['parents']:
-          outputs = self.output(attn_weights[attn_idx], multitask_targets['parents'])
-          parse_probs = tf.nn.softmax(attn_weights[attn_idx])
+          outputs = self.output(attn_weights[:, attn_idx], multitask_targets['parents'])
+          parse_probs = tf.nn.softmax(attn_weights[:, attn_idx])
           # todo this is a bit of a hack
           attn_idx += 1
           loss = self.multi_penalties['parents'] * outputs['loss']
@@ -443,13 +443,13 @@ class Parser(BaseParser):
           multitask_correct['parents%s' % l] = outputs['n_correct']
           multitask_loss_sum += loss
         if 'grandparents' in self.multi_layers.keys() and l in self.multi_layers['grandparents']:
-          outputs = self.output(attn_weights[attn_idx], multitask_targets['grandparents'])
+          outputs = self.output(attn_weights[:, attn_idx], multitask_targets['grandparents'])
           attn_idx += 1
           loss = self.multi_penalties['grandparents'] * outputs['loss']
           multitask_losses['grandparents%s' % l] = loss
           multitask_loss_sum += loss
         if 'children' in self.multi_layers.keys() and l in self.multi_layers['children']:
-          outputs = self.output_transpose(attn_weights[cap_attn_idx], multitask_targets['children'])
+          outputs = self.output_transpose(attn_weights[:, cap_attn_idx], multitask_targets['children'])
           cap_attn_idx += 1
           loss = self.multi_penalties['children'] * outputs['loss']
           multitask_losses['children%s' % l] = loss
@@ -540,17 +540,20 @@ class Parser(BaseParser):
         # gathered_predicates: num_triggers_in_batch x 1 x self.trigger_mlp_size
         # role mlp: batch x seq_len x self.role_mlp_size
         # gathered roles: need a (bucket_size x self.role_mlp_size) role representation for each trigger,
-        # i.e. a (num_triggers_in_batch x bucket_size x self.role_mlp_size) tensor
+        # i.e. a (num_triggers_in_batch x bucket_size x self.role_mlp_size) tensor, which is just the
+        # role mlp of the trigger's sentence; gathering it by batch index keeps the biggest tensor here
+        # at num_triggers_in_batch x bucket_size x self.role_mlp_size, rather than tiling role mlp out
+        # to batch x seq_len x seq_len x self.role_mlp_size first
         predicate_gather_indices = tf.where(tf.equal(predicate_predictions, 1))
         # predicate_gather_indices = tf.Print(predicate_gather_indices, [predicate_predictions, tf.shape(predicate_gather_indices), tf.shape(predicate_predictions)], "predicate gather shape", summarize=200)
         gathered_predicates = tf.expand_dims(tf.gather_nd(predicate_mlp, predicate_gather_indices), 1)
-        tiled_roles = tf.reshape(tf.tile(role_mlp, [1, bucket_size, 1]), [batch_size, bucket_size, bucket_size, self.role_mlp_size])
-        gathered_roles = tf.gather_nd(tiled_roles, predicate_gather_indices)
+        gathered_roles = tf.gather(role_mlp, predicate_gather_indices[:,0])
 
         # now multiply them together to get (num_triggers_in_batch x bucket_size x num_srl_classes) tensor of scores
         srl_logits = self.bilinear_classifier_nary(gathered_predicates, gathered_roles, num_srl_classes)
         srl_logits_transpose = tf.transpose(srl_logits, [0, 2, 1])
-        srl_output = self.output_srl_gather(srl_logits_transpose, srl_target, predicate_predictions, transition_params if self.viterbi_train else None)
+        srl_output = self.output_srl_gather(srl_logits_transpose, srl_target, predicate_predictions, transition_params if self.viterbi_train else None,
+                                            transition_params if self.viterbi_in_graph and moving_params is not None else None)
         return srl_output
 
     def compute_srl_simple(srl_target):
@@ -562,6 +565,7 @@ class Parser(BaseParser):
         srl_output = {f: output[f] for f in ['loss', 'probabilities', 'predictions', 'correct', 'count']}
         srl_output['logits'] = srl_logits
         srl_output['transition_params'] = tf.constant(0.)
+        srl_output['viterbi_predictions'] = srl_output['predictions']
         srl_output['correct'] = output['n_correct']
         return srl_output
 
@@ -572,6 +576,7 @@ class Parser(BaseParser):
         'loss': tf.constant(0.),
         'probabilities':  tf.constant(0.), # tf.zeros([num_triggers, bucket_size, num_srl_classes]),
         'predictions': tf.reshape(tf.transpose(srl_targets, [0, 2, 1]), [-1, bucket_size]), # tf.zeros([num_triggers, bucket_size]),
+        'viterbi_predictions': tf.reshape(tf.transpose(srl_targets, [0, 2, 1]), [-1, bucket_size]),
         'logits':  tf.constant(0.), # tf.zeros([num_triggers, bucket_size, num_srl_classes]),
         'correct':  tf.constant(0.),
         'count':  tf.constant(0.)
@@ -604,6 +609,20 @@ class Parser(BaseParser):
                                         rel_output['probabilities']])
     output['predictions'] = tf.stack([arc_output['predictions'],
                                       rel_output['predictions']])
+
+    # the heads and labels that prob_argmax picks when it doesn't have to
+    # repair trees, so that testing only needs to fetch these
+    head_preds = tf.to_int32(tf.argmax(parse_probs * tf.transpose(self.tokens_to_keep3D, [0, 2, 1]), axis=2))
+    if self.rel_loss_penalty != 0:
+      head_idxs = tf.stack([tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, bucket_size]),
+                            tf.tile(tf.expand_dims(tf.range(bucket_size), 0), [batch_size, 1]),
+                            head_preds], axis=-1)
+      rel_probs_at_heads = tf.gather_nd(rel_output['probabilities'], head_idxs)
+      rel_probs_at_heads *= 1 - tf.one_hot(Vocab.PAD, num_rel_classes)
+      rel_preds = tf.to_int32(tf.argmax(rel_probs_at_heads, axis=-1))
+    else:
+      rel_preds = tf.zeros_like(head_preds)
+    output['parse_preds'] = tf.tuple([head_preds, rel_preds])
     output['correct'] = arc_output['correct'] * rel_output['correct']
     output['tokens'] = arc_output['tokens']
     output['n_correct'] = tf.reduce_sum(output['correct'])
@@ -636,6 +655,7 @@ class Parser(BaseParser):
 
     output['srl_loss'] = srl_loss
     output['srl_preds'] = srl_output['predictions']
+    output['srl_viterbi_preds'] = srl_output['viterbi_predictions']
     output['srl_probs'] = srl_output['probabilities']
     output['srl_logits'] = srl_output['logits']
     output['srl_correct'] = srl_output['correct']
@@ -654,21 +674,68 @@ class Parser(BaseParser):
     output['pos_correct'] = pos_correct
     output['pos_preds'] = pos_preds
 
-    # transpose and softmax attn weights
-    attn_weights_by_layer_softmaxed = {k: tf.transpose(tf.nn.softmax(v), [1, 0, 2, 3]) for k, v in
-                                       attn_weights_by_layer.iteritems()}
-
-    output['attn_weights'] = attn_weights_by_layer_softmaxed
+    # softmaxed attn weights (batch x head x seq_len x seq_len), only
+    # built if they're going to be saved
+    if self.save_attn_weights:
+      output['attn_weights'] = {k: tf.nn.softmax(v) for k, v in attn_weights_by_layer.iteritems()}
     output['attn_correct'] = multitask_correct
 
     return output
   
   #=============================================================
-  def prob_argmax(self, parse_probs, rel_probs, tokens_to_keep, n_cycles=-1, len_2_cycles=-1):
+  def prob_argmax(self, parse_probs, rel_probs, tokens_to_keep, n_cycles=-1, len_2_cycles=-1, tree_preds=None):
     """"""
     start_time = time.time()
-    parse_preds, roots_lt, roots_gt = self.parse_argmax(parse_probs, tokens_to_keep, n_cycles, len_2_cycles)
+    parse_preds, roots_lt, roots_gt = self.parse_argmax(parse_probs, tokens_to_keep, n_cycles, len_2_cycles, tree_preds)
     rel_probs = rel_probs[np.arange(len(parse_preds)), parse_preds]
     rel_preds = self.rel_argmax(rel_probs, tokens_to_keep)
     total_time = time.time() - start_time
     return parse_preds, rel_preds, total_time, roots_lt, roots_gt
+
+#***************************************************************
+if __name__ == '__main__':
+  """"""
+
+  from lib import linalg
+
+  # peak memory of scoring every predicate's roles, forward and backward, when
+  # role mlp is tiled out for every token and when it's gathered per predicate,
+  # on buckets of long sentences with a CoNLL-2012 number of predicates
+  def peak_mb(sess, fetches, feed_dict):
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, run_metadata=run_metadata,
+             options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+    return max([memory.peak_bytes for dev_stats in run_metadata.step_stats.dev_stats
+                for node_stats in dev_stats.node_stats for memory in node_stats.memory] + [0]) / 2.**20
+
+  batch_size, predicate_mlp_size, role_mlp_size, num_srl_classes = 32, 200, 200, 129
+  predicate_mlp = tf.placeholder(tf.float32, [None, None, predicate_mlp_size])
+  role_mlp = tf.placeholder(tf.float32, [None, None, role_mlp_size])
+  predicate_predictions = tf.placeholder(tf.int32, [None, None])
+  bucket_size = tf.shape(role_mlp)[1]
+  predicate_gather_indices = tf.where(tf.equal(predicate_predictions, 1))
+  gathered_predicates = tf.expand_dims(tf.gather_nd(predicate_mlp, predicate_gather_indices), 1)
+  tiled_roles = tf.reshape(tf.tile(role_mlp, [1, bucket_size, 1]), [batch_size, bucket_size, bucket_size, role_mlp_size])
+  fetches = {}
+  for name, gathered_roles in (('tiled', tf.gather_nd(tiled_roles, predicate_gather_indices)),
+                               ('gathered', tf.gather(role_mlp, predicate_gather_indices[:,0]))):
+    with tf.variable_scope('Bilinear', reuse=tf.AUTO_REUSE):
+      srl_logits = linalg.bilinear_noreshape(gathered_predicates, gathered_roles, num_srl_classes)
+    loss = tf.reduce_sum(tf.square(srl_logits))
+    fetches[name] = (loss, [tf.convert_to_tensor(grad) for grad in tf.gradients(loss, [predicate_mlp, role_mlp])])
+
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    for sent_len in (60, 100, 150):
+      predicates = np.zeros((batch_size, sent_len), dtype=np.int32)
+      for predicates_i in predicates:
+        predicates_i[np.random.choice(sent_len, sent_len // 8, replace=False)] = 1
+      feed_dict = {predicate_mlp: np.random.randn(batch_size, sent_len, predicate_mlp_size),
+                   role_mlp: np.random.randn(batch_size, sent_len, role_mlp_size),
+                   predicate_predictions: predicates}
+      tiled_loss, tiled_grads = sess.run(fetches['tiled'], feed_dict=feed_dict)
+      gathered_loss, gathered_grads = sess.run(fetches['gathered'], feed_dict=feed_dict)
+      assert np.allclose(tiled_loss, gathered_loss, rtol=1e-4)
+      assert all(np.allclose(tiled, gathered, rtol=1e-3, atol=1e-3) for tiled, gathered in zip(tiled_grads, gathered_grads))
+      print('%d x %d bucket, %d predicates: tiled %7.1f MB peak, gathered %7.1f MB peak' %
+            (batch_size, sent_len, np.sum(predicates), peak_mb(sess, fetches['tiled'], feed_dict), peak_mb(sess, fetches['gathered'], feed_dict)))
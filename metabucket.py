@@ -73,6 +73,31 @@ class Metabucket(Configurable):
     self._data.append( (bkt_idx, idx) )
     return len(self._data)-1
   
+  #=============================================================
+  def fill(self, bucket):
+    """
+      Sorts all the sentences of a finalized bucket into the (freshly reset,
+      unpadded) buckets by length and finalizes them, as if they'd been added
+      one by one.
+    """
+    
+    if isinstance(self._data, np.ndarray):
+      raise TypeError("The buckets have already been finalized, you can't add more to them")
+    if self._data:
+      raise ValueError('Only empty buckets can be filled')
+    
+    lens = bucket.get_lens(slice(None))
+    bkt_idxs = np.searchsorted(self._sizes, lens)
+    if np.any(bkt_idxs == len(self._sizes)):
+      raise ValueError('No bucket for sequences of len %d' % np.max(lens))
+    idxs = np.zeros_like(bkt_idxs)
+    for bkt_idx in xrange(len(self._sizes)):
+      sent_idxs = np.where(bkt_idxs == bkt_idx)[0]
+      idxs[sent_idxs] = np.arange(len(sent_idxs))
+      self._buckets[bkt_idx].fill(bucket, sent_idxs)
+    self._data = np.stack([bkt_idxs, idxs], axis=1)
+    return
+  
   #=============================================================
   def _finalize(self):
     """"""
@@ -22,7 +22,9 @@ from __future__ import print_function
 import os
 import sys
 import time
+import zipfile
 import pickle as pkl
+from io import BytesIO
 
 import numpy as np
 import tensorflow as tf
@@ -34,6 +36,9 @@ from lib import rnn_cells
 from configurable import Configurable
 from vocab import Vocab
 from dataset import Dataset
+from lib.etc.prefetch import Prefetcher
+from lib.etc.eval_worker import EvalWorker
+from lib.etc.scorers import ParseScorer, SRLScorer, props_phrases, read_conll, read_props
 import contextlib
 from subprocess import check_output, CalledProcessError
 import operator
@@ -84,17 +89,27 @@ class Network(Configurable):
 
     print("Loading vocabs")
     sys.stdout.flush()
+    # count every vocab that has to be built from the training file in one pass
+    vocab_specs = [(name, index, self.cased if not i else True) for i, (vocab_file, index, name, embed_size) in enumerate(vocab_files)]
+    missing = [i for i, (vocab_file, index, name, embed_size) in enumerate(vocab_files) if not os.path.isfile(vocab_file)]
+    vocab_counts = [None] * len(vocab_files)
+    if missing:
+      for i, counts in zip(missing, Vocab.count_train_file(self._config, [vocab_specs[i] for i in missing])):
+        vocab_counts[i] = counts
     for i, (vocab_file, index, name, embed_size) in enumerate(vocab_files):
       vocab = Vocab(vocab_file, index, embed_size, self._config,
                     name=name,
-                    cased=self.cased if not i else True,
-                    use_pretrained=(not i))
+                    cased=vocab_specs[i][2],
+                    use_pretrained=(not i),
+                    counts=vocab_counts[i])
       self._vocabs.append(vocab)
 
     print("Predicates vocab: ")
     for l, i in sorted(self._vocabs[4].iteritems(), key=operator.itemgetter(1)):
       print("%s: %d" % (l, i))
     print("predicate_true_start_idx", self._vocabs[4].predicate_true_start_idx)
+    self._srl_label_table = self._build_srl_label_table()
+    self._gold_files = {}
 
     print("Loading data")
     sys.stdout.flush()
@@ -111,15 +126,20 @@ class Network(Configurable):
       'valid_accuracy': [],
       'test_acuracy': 0
     }
+    # with async_eval, the validation runs are scored in a process of their
+    # own, which has to be forked now, before there's a session
+    self._eval_worker = EvalWorker(self.score_outputs) if self.async_eval else None
     return
   
   #=============================================================
-  def train_minibatches(self):
+  def train_minibatches(self, sess):
     """"""
     
     return self._trainset.get_minibatches(self.train_batch_size,
                                           self.model.input_idxs,
-                                          self.model.target_idxs)
+                                          self.model.target_idxs,
+                                          sess=sess,
+                                          with_costs=True)
   
   #=============================================================
   def valid_minibatches(self):
@@ -148,6 +168,12 @@ class Network(Configurable):
     sys.stdout.flush()
     save_path = os.path.join(self.save_dir, self.name.lower() + '-pretrained')
     saver = tf.train.Saver(self.save_vars, max_to_keep=1, save_relative_paths=True)
+    if self.async_eval:
+      # validation is decoded and scored in the eval worker, so the weights it
+      # was run with are kept in a candidate checkpoint until its score is in
+      eval_worker = self._eval_worker
+      candidate_saver = tf.train.Saver(self.save_vars, max_to_keep=None, save_relative_paths=True)
+      best_candidate = None
     
     n_bkts = self.n_bkts
     train_iters = self.train_iters
@@ -171,6 +197,9 @@ class Network(Configurable):
       n_train_correct = 0
       n_train_tokens = 0
       n_train_iters = 0
+      train_step_costs = []
+      train_step_times = []
+      train_wait_time = 0
       n_train_srl_correct = 0
       n_train_srl_count = 0
       n_train_predicate_count = 0
@@ -180,9 +209,12 @@ class Network(Configurable):
       valid_loss = 0
       valid_accuracy = 0
       while total_train_iters < train_iters:
-        for j, (feed_dict, _) in enumerate(self.train_minibatches()):
-          # train_inputs = feed_dict[self._trainset.inputs]
-          train_targets = feed_dict[self._trainset.targets]
+        # build the next minibatches in the background while this one runs
+        # (tf.data does its own prefetching)
+        train_batches = Prefetcher(self.train_minibatches(sess), 0 if self.use_tf_data else self.n_prefetch)
+        for j, (feed_dict, train_sents, train_cost) in enumerate(train_batches):
+          train_wait_time += train_batches.wait_time
+          train_batches.wait_time = 0
 
           start_time = time.time()
 
@@ -196,6 +228,8 @@ class Network(Configurable):
           _, loss, n_correct, n_tokens, roots_loss, cycle2_loss, svd_loss, log_loss, rel_loss, srl_loss, srl_correct, srl_count, predicate_loss, predicate_count, predicate_correct, pos_loss, pos_correct, multitask_losses, lr, sample_prob = sess.run(self.ops['train_op_srl'], feed_dict=feed_dict)
           total_train_iters += 1
           train_time += time.time() - start_time
+          train_step_times.append(time.time() - start_time)
+          train_step_costs.append(train_cost)
           train_loss += loss
           train_log_loss += log_loss
           train_roots_loss += roots_loss
@@ -213,7 +247,7 @@ class Network(Configurable):
               train_mul_loss[n] = 0.
             train_mul_loss[n] += l
 
-          n_train_sents += len(train_targets)
+          n_train_sents += len(train_sents)
           n_train_correct += n_correct
           n_train_tokens += n_tokens
           n_train_srl_correct += srl_correct
@@ -265,7 +299,15 @@ class Network(Configurable):
               train_mul_loss[n] = l/n_train_iters
               multitask_losses_str += '\t%s loss: %f' % (n, train_mul_loss[n])
             print(multitask_losses_str)
+            # scale the cost model to seconds over this interval and see how well it predicts each step
+            step_times = np.array(train_step_times)
+            step_estimates = np.array(train_step_costs) * np.sum(step_times) / max(np.sum(train_step_costs), 1e-12)
+            print('\tStep time: %.4fs    Input wait: %.4fs    Cost model estimate: %.4fs    Mean abs error: %.1f%%' %
+                  (np.mean(step_times), train_wait_time / len(step_times), np.mean(step_estimates), 100 * np.mean(np.abs(step_estimates - step_times)) / np.mean(step_times)))
             sys.stdout.flush()
+            train_step_costs = []
+            train_step_times = []
+            train_wait_time = 0
             train_time = 0
             train_loss = 0
             n_train_sents = 0
@@ -292,24 +334,39 @@ class Network(Configurable):
             # if not self.viterbi_train:
             #   correct = self.test(sess, validate=True)
             #   current_score = correct[self.eval_criterion]
-            if self.viterbi_decode or self.viterbi_train:
-              correct = self.test(sess, viterbi=True, validate=True)
+            if self.async_eval:
+              # one evaluation at a time, so candidates don't pile up
+              for candidate, correct in eval_worker.results(block=True):
+                current_best, best_candidate = self.keep_if_best(candidate, correct, current_best, best_candidate)
+              viterbi = self.viterbi_decode or self.viterbi_train
+              batch_outputs, forward_total_time = self.run_outputs(sess, viterbi=viterbi, validate=True)
+              candidate = None
+              if self.save:
+                candidate = candidate_saver.save(sess, os.path.join(self.save_dir, self.name.lower() + '-trained'),
+                                                 latest_filename=self.name.lower() + '-candidates',
+                                                 global_step=total_train_iters,
+                                                 write_meta_graph=False)
+              eval_worker.submit(candidate, batch_outputs, forward_total_time,
+                                 viterbi=viterbi, validate=True, srl_sanity=self.periodic_srl_sanity)
             else:
-              correct = self.test(sess, validate=True)
-            current_score = correct[self.eval_criterion]
-            # las = np.mean(correct["LAS"]) * 100
-            # uas = np.mean(correct["UAS"]) * 100
-            # print('UAS: %.2f    LAS: %.2f' % (uas, las))
-            if self.save and current_score > current_best:
-              current_best = current_score
-              print("Writing model to %s" % (os.path.join(self.save_dir, self.name.lower() + '-trained')))
-              saver.save(sess, os.path.join(self.save_dir, self.name.lower() + '-trained'),
-                         latest_filename=self.name.lower(),
-                         global_step=self.global_epoch,
-                         write_meta_graph=False)
-              if self.eval_parse:
-                with open(os.path.join(self.save_dir, "parse_results.txt"), 'w') as parse_results_f:
-                  print(correct['parse_eval'], file=parse_results_f)
+              if self.viterbi_decode or self.viterbi_train:
+                correct = self.test(sess, viterbi=True, validate=True, srl_sanity=self.periodic_srl_sanity)
+              else:
+                correct = self.test(sess, validate=True, srl_sanity=self.periodic_srl_sanity)
+              current_score = correct[self.eval_criterion]
+              # las = np.mean(correct["LAS"]) * 100
+              # uas = np.mean(correct["UAS"]) * 100
+              # print('UAS: %.2f    LAS: %.2f' % (uas, las))
+              if self.save and current_score > current_best:
+                current_best = current_score
+                print("Writing model to %s" % (os.path.join(self.save_dir, self.name.lower() + '-trained')))
+                saver.save(sess, os.path.join(self.save_dir, self.name.lower() + '-trained'),
+                           latest_filename=self.name.lower(),
+                           global_step=self.global_epoch,
+                           write_meta_graph=False)
+                if self.eval_parse:
+                  with open(os.path.join(self.save_dir, "parse_results.txt"), 'w') as parse_results_f:
+                    print(correct['parse_eval'], file=parse_results_f)
             # with open(os.path.join(self.save_dir, 'history.pkl'), 'w') as f:
             #   pkl.dump(self.history, f)
             # self.test(sess, validate=True)
@@ -328,24 +385,155 @@ class Network(Configurable):
     #   pkl.dump(self.history, f)
     # with open(os.path.join(self.save_dir, 'scores.txt'), 'a') as f:
     #   pass
+    if self.async_eval:
+      for candidate, correct in eval_worker.results(block=True):
+        current_best, best_candidate = self.keep_if_best(candidate, correct, current_best, best_candidate)
+      eval_worker.close()
     self.test(sess, validate=True)
     return
+  
+  #=============================================================
+  def keep_if_best(self, candidate, correct, current_best, best_candidate):
+    """
+      Makes the candidate checkpoint of an asynchronous validation the saved
+      model if it scored better than current_best, replacing best_candidate,
+      and otherwise deletes it. Returns the new best score and checkpoint.
+    """
+    
+    current_score = correct[self.eval_criterion]
+    if current_score <= current_best:
+      if candidate is not None:
+        tf.train.remove_checkpoint(candidate)
+      return current_best, best_candidate
+    if candidate is not None:
+      print("Writing model to %s" % candidate)
+      tf.train.update_checkpoint_state(self.save_dir, os.path.basename(candidate), latest_filename=self.name.lower())
+      if best_candidate is not None:
+        tf.train.remove_checkpoint(best_candidate)
+      if self.eval_parse:
+        with open(os.path.join(self.save_dir, "parse_results.txt"), 'w') as parse_results_f:
+          print(correct['parse_eval'], file=parse_results_f)
+    return current_score, candidate
+
+
+  # how props_strings sees each srl label: a plain O, B-x or I-x label, a
+  # token it should look straight through (PAD), or something with U/L
+  # pieces or several '/'-separated parts that only convert_bilou handles
+  SRL_O, SRL_B, SRL_I, SRL_SKIP, SRL_NESTED = range(5)
 
+  #=============================================================
+  def _build_srl_label_table(self):
+    """"""
+    
+    srls = self._vocabs[3]
+    n_labels = max(idx for _, idx in srls.iteritems()) + 1
+    strings = np.empty(n_labels, dtype=object)
+    parts = [[] for _ in xrange(n_labels)]
+    codes = np.full(n_labels, self.SRL_NESTED, dtype=np.int32)
+    # the props string of a label given (starts_span, ends_span) as 2*starts + ends
+    brackets = np.empty((n_labels, 4), dtype=object)
+    brackets[:] = ['*', '*)', '*', '*)']
+    types = np.empty(n_labels, dtype=object)
+    bio_codes = {'O': self.SRL_O, 'B': self.SRL_B, 'I': self.SRL_I}
+    for string, idx in srls.iteritems():
+      strings[idx] = string
+      parts[idx] = [(label[0], label[2:]) for label in string.split('/')]
+      if len(parts[idx]) == 1:
+        bilou, label_type = parts[idx][0]
+        if bilou in bio_codes:
+          codes[idx] = bio_codes[bilou]
+          brackets[idx, 2:] = ['(%s*' % label_type, '(%s*)' % label_type]
+          types[idx] = label_type
+        elif bilou not in 'UL':
+          codes[idx] = self.SRL_SKIP
+    return {'strings': strings, 'parts': parts, 'codes': codes, 'brackets': brackets, 'types': types}
+
+  #=============================================================
+  def _srl_boundaries(self, codes):
+    """"""
+    
+    # where the spans of a (n_tokens x n_predicates) array of plain BIO label
+    # codes start and end, for all of the predicates at once; a span is open
+    # after a token if the last O/B/I label up to it isn't O
+    n_tokens, n_preds = codes.shape
+    tokens = np.arange(n_tokens)[:,None]
+    last_labeled = np.maximum.accumulate(np.where(codes != self.SRL_SKIP, tokens, -1), axis=0)
+    is_open = (last_labeled >= 0) & (codes[np.maximum(last_labeled, 0), np.arange(n_preds)] != self.SRL_O)
+    was_open = np.concatenate([np.zeros((1, n_preds), dtype=bool), is_open[:-1]])
+    next_codes = np.concatenate([codes[1:], np.full((1, n_preds), self.SRL_O, dtype=np.int32)])
+    starts = (codes == self.SRL_B) | ((codes == self.SRL_I) & ~was_open)
+    ends = is_open & ((next_codes == self.SRL_O) | (next_codes == self.SRL_B))
+    return starts, ends
+
+  #=============================================================
+  def read_gold(self, filename, reader):
+    """"""
+    
+    # the gold files don't change, so each one is only read once
+    if filename not in self._gold_files:
+      self._gold_files[filename] = reader(filename) if os.path.isfile(filename) else None
+    return self._gold_files[filename]
+
+  #=============================================================
+  def props_strings(self, srl_preds):
+    """
+      Turns the (n_tokens x n_predicates) srl label ids of one sentence into
+      its CoNLL props bracket strings, one list per token (or [] if there are
+      no predicates). Spans are found for all the predicates at once from the
+      label table; only labels that need convert_bilou's general handling are
+      sent through it, a predicate at a time.
+    """
+    
+    n_tokens, n_preds = srl_preds.shape
+    if not n_preds:
+      return []
+    table = self._srl_label_table
+    codes = table['codes'][srl_preds]
+    if np.any(codes == self.SRL_NESTED):
+      srl_preds_str = map(list, zip(*[self.convert_bilou(j) for j in np.transpose(srl_preds)]))
+      if not self.parens_check(np.transpose(srl_preds_str)):
+        print(np.transpose(srl_preds_str))
+        print(map(lambda i: self._vocabs[3][i], np.transpose(srl_preds)))
+      return srl_preds_str
+    
+    starts, ends = self._srl_boundaries(codes)
+    return table['brackets'][srl_preds, 2*starts + ends].tolist()
 
+  #=============================================================
+  def srl_spans(self, srl_preds):
+    """
+      The phrases of each column of a (n_tokens x n_predicates) array of srl
+      label ids, in the form props_phrases gives them, read off the same
+      boundaries as props_strings.
+    """
+    
+    n_tokens, n_preds = srl_preds.shape
+    table = self._srl_label_table
+    codes = table['codes'][srl_preds]
+    if np.any(codes == self.SRL_NESTED):
+      return [props_phrases(tags) for tags in zip(*self.props_strings(srl_preds))]
+    
+    starts, ends = self._srl_boundaries(codes)
+    spans = [[] for _ in xrange(n_preds)]
+    # spans are flat, so the k-th start of a column goes with its k-th end
+    start_tokens, start_preds = np.where(np.transpose(starts))[::-1]
+    end_tokens = np.where(np.transpose(ends))[1]
+    roles = table['types'][srl_preds[start_tokens, start_preds]]
+    for pred, start, end, role in zip(start_preds, start_tokens, end_tokens, roles):
+      spans[pred].append((start, end, role, ()))
+    return spans
+
+  #=============================================================
   def convert_bilou(self, indices):
-    strings = map(lambda i: self._vocabs[3][i], indices)
+    all_parts = self._srl_label_table['parts']
     converted = []
     started_types = []
-    # print(strings)
-    for i, s in enumerate(strings):
-      label_parts = s.split('/')
+    for i, label_parts in enumerate([all_parts[j] for j in indices]):
       curr_len = len(label_parts)
       combined_str = ''
       Itypes = []
       Btypes = []
-      for idx, label in enumerate(label_parts):
-        bilou = label[0]
-        label_type = label[2:]
+      for idx, (bilou, label_type) in enumerate(label_parts):
         props_str = ''
         if bilou == 'I':
           Itypes.append(label_type)
@@ -401,83 +589,118 @@ class Network(Configurable):
     return True
 
   def merge_preds(self, all_preds, dataset):
-    # want a sentences x tokens x fields array
-    preds_merged = []
-    current_sentid = -1
-    current_sent_shared = None
-    current_srls = []
-    current_predicates = None
-    merged_indices = []
-    examples = 0
-    sentences = 0
+    """
+      Merges the one-predicate examples of each sentence back into a
+      (tokens x fields) array for the sentence: the fields of its first
+      example, the number of predicates at each token in column 4, and then
+      the predicted srl column (the last one) of each example that has one.
+      Also returns the (bkt_idx, idx) of each sentence's first example.
+    """
+    
     predicate_idx = 4
-
-    # for each example
-    for bkt_idx, idx in dataset._metabucket.data:
-      examples += 1
-      preds = all_preds[bkt_idx][idx]
-      this_sent_id = preds[0, 6]
-      # if this_sent_id < 4:
-      #   print("orig preds", preds)
-      # print("preds", preds)
-      if this_sent_id != current_sentid:
-        sentences += 1
-        current_sentid = this_sent_id
-        # print("processing sent %d" % current_sentid)
-        merged_indices.append((bkt_idx, idx))
-        if current_sent_shared is not None:
-          # print("last sent had: %d/%d preds" % (len(current_srls), np.sum(current_predicates)))
-          # merge and add to merged list
-          # print(merged_srls)
-          # if len(merged_srls.shape) == 1:
-          #   merged_srls = np.expand_dims(merged_srls, -1)
-          # print("merged srls", len(merged_srls.shape), merged_srls.shape, merged_srls)
-          # print("current shared", current_sent_shared.shape, current_sent_shared)
-          current_sent_shared[:, predicate_idx] = current_predicates
-          if current_srls:
-            merged_srls = np.concatenate(current_srls, axis=-1)
-            merged_sent = np.concatenate([current_sent_shared, merged_srls], axis=1)
-          else:
-            merged_sent = current_sent_shared
-          preds_merged.append(merged_sent)
-        current_sent_shared = preds[:, :17]
-        current_srls = []
-        current_predicates = np.zeros(current_sent_shared.shape[0])
-      if preds.shape[1] > 16:
-        # print(current_sent_shared)
-        current_srls.append(np.expand_dims(preds[:, -1], -1))
-        current_predicates += (preds[:, predicate_idx] > self._vocabs[4].predicate_true_start_idx).astype(np.int32)
-        # print("predicates", (preds[:, predicate_idx] > self._vocabs[4].predicate_true_start_idx).astype(np.int32))
-
-    # deal with last one
-    current_sent_shared[:, predicate_idx] = current_predicates
-    if current_srls:
-      merged_srls = np.concatenate(current_srls, axis=-1)
-      merged_sent = np.concatenate([current_sent_shared, merged_srls], axis=1)
-    else:
-      merged_sent = current_sent_shared
-    preds_merged.append(merged_sent)
-
-    print("Merged %d examples into %d/%d sentences" % (examples, len(preds_merged), sentences))
-    return preds_merged, merged_indices
+    sent_id_idx = 6
+    # examples of the same sentence are next to each other in the data
+    merged_indices = dataset._metabucket.data
+    examples = [all_preds[bkt_idx][idx] for bkt_idx, idx in merged_indices]
+    sent_ids = np.array([preds[0, sent_id_idx] for preds in examples])
+    sent_starts = np.where(np.concatenate([[True], sent_ids[1:] != sent_ids[:-1]]))[0]
+    
+    # the srl columns of every example with a predicate, end to end, so that
+    # each sentence's come out of a single reshape; the predicate counts of
+    # all the sentences' tokens are summed up in one go
+    has_srl = np.array([preds.shape[1] > 16 for preds in examples], dtype=bool)
+    srl_examples = [preds for preds in examples if preds.shape[1] > 16]
+    srl_lens = np.array([len(preds) for preds in srl_examples], dtype=np.int64)
+    srl_offsets = np.cumsum(srl_lens) - srl_lens
+    srl_starts = (np.cumsum(has_srl) - has_srl)[sent_starts]
+    srl_stops = np.concatenate([srl_starts[1:], [len(srl_examples)]]).astype(np.int64)
+    sent_lens = np.array([len(examples[sent_start]) for sent_start in sent_starts], dtype=np.int64)
+    sent_offsets = np.cumsum(sent_lens) - sent_lens
+    n_predicates = np.zeros(np.sum(sent_lens), dtype=np.int64)
+    if srl_examples:
+      srl_cols = np.concatenate([preds[:, -1] for preds in srl_examples])
+      is_predicate = np.concatenate([preds[:, predicate_idx] for preds in srl_examples]) > self._vocabs[4].predicate_true_start_idx
+      srl_sents = np.repeat(np.arange(len(sent_starts)), srl_stops - srl_starts)
+      merged_tokens = np.arange(len(srl_cols)) - np.repeat(srl_offsets - sent_offsets[srl_sents], srl_lens)
+      n_predicates = np.bincount(merged_tokens, weights=is_predicate, minlength=len(n_predicates)).astype(np.int64)
+    
+    preds_merged = []
+    for sent_start, srl_start, srl_stop, sent_offset, sent_len in zip(sent_starts, srl_starts, srl_stops, sent_offsets, sent_lens):
+      merged_sent = examples[sent_start][:, :17]
+      merged_sent[:, predicate_idx] = n_predicates[sent_offset:sent_offset+sent_len]
+      n_srls = srl_stop - srl_start
+      if n_srls:
+        srl_offset = srl_offsets[srl_start]
+        merged_sent = np.concatenate([merged_sent, srl_cols[srl_offset:srl_offset+n_srls*sent_len].reshape(n_srls, sent_len).T], axis=1)
+      preds_merged.append(merged_sent)
+    
+    print("Merged %d examples into %d/%d sentences" % (len(examples), len(preds_merged), len(sent_starts)))
+    return preds_merged, [merged_indices[sent_start] for sent_start in sent_starts]
 
     
   #=============================================================
   # TODO make this work if lines_per_buff isn't set to 0
-  def test(self, sess, viterbi=False, validate=False):
+  def test(self, sess, viterbi=False, validate=False, srl_sanity=True):
     """"""
     
+    batch_outputs, forward_total_time = self.run_outputs(sess, viterbi, validate)
+    return self.score_outputs(batch_outputs, forward_total_time, viterbi, validate, srl_sanity)
+  
+  #=============================================================
+  def run_outputs(self, sess, viterbi=False, validate=False):
+    """
+      The part of test() that needs the session: runs the validation or test
+      minibatches through the graph and returns, for each of them, its inputs,
+      targets, words and fetched outputs, along with the time it all took.
+      With save_attn_weights, each minibatch's attention weights are written
+      out as they come rather than kept.
+    """
+    
+    test_op = self.ops['test_op_viterbi' if viterbi else 'test_op']
     if validate:
-      filename = self.valid_file
       minibatches = self.valid_minibatches
       dataset = self._validset
-      op = self.ops['test_op'][:15]
+      op = test_op[0]
+      attn_op = self.ops['attn_weights'][0]
     else:
-      filename = self.test_file
       minibatches = self.test_minibatches
       dataset = self._testset
-      op = self.ops['test_op'][15:]
+      op = test_op[1]
+      attn_op = self.ops['attn_weights'][1]
     
+    batch_outputs = []
+    forward_total_time = 0.
+    attn_file = None
+    if self.save_attn_weights:
+      # the same file np.savez would make, with an array for each minibatch
+      # and layer, but built up a minibatch at a time
+      attn_file = zipfile.ZipFile(os.path.join(self.save_dir, 'attention_weights.npz'), 'w', allowZip64=True)
+    for batch_num, (feed_dict, sents) in enumerate(minibatches()):
+      forward_start = time.time()
+      if attn_file is None:
+        outputs = sess.run(op, feed_dict=feed_dict)
+      else:
+        outputs, attn_weights = sess.run([op, attn_op], feed_dict=feed_dict)
+      forward_total_time += time.time() - forward_start
+      if attn_file is not None:
+        for k, v in attn_weights.iteritems():
+          array_file = BytesIO()
+          np.lib.format.write_array(array_file, v)
+          attn_file.writestr("b%d:layer%d.npy" % (batch_num, k), array_file.getvalue())
+      batch_outputs.append((feed_dict[dataset.inputs], feed_dict[dataset.targets], sents, outputs))
+    if attn_file is not None:
+      attn_file.close()
+    return batch_outputs, forward_total_time
+  
+  #=============================================================
+  def score_outputs(self, batch_outputs, forward_total_time, viterbi=False, validate=False, srl_sanity=True):
+    """
+      The rest of test(), which only needs run_outputs' arrays: decodes them,
+      writes out the predictions and scores them. With async_eval it runs in
+      the evaluation worker while training carries on.
+    """
+    
+    dataset = self._validset if validate else self._testset
     all_predictions = [[]]
     all_sents = [[]]
     bkt_idx = 0
@@ -489,22 +712,14 @@ class Network(Configurable):
     not_tree_total = 0.
     srl_correct_total = 0.
     srl_count_total = 0.
-    forward_total_time = 0.
     non_tree_preds_total = []
-    attention_weights = {}
     attn_correct_counts = {}
     pos_correct_total = 0.
     n_tokens = 0.
-    for batch_num, (feed_dict, sents) in enumerate(minibatches()):
-      mb_inputs = feed_dict[dataset.inputs]
-      mb_targets = feed_dict[dataset.targets]
-      forward_start = time.time()
-      probs, n_cycles, len_2_cycles, srl_probs, srl_preds, srl_logits, srl_correct, srl_count, srl_predicates, srl_predicate_targets, transition_params, attn_weights, attn_correct, pos_correct, pos_preds = sess.run(op, feed_dict=feed_dict)
-      forward_total_time += time.time() - forward_start
-      preds, parse_time, roots_lt, roots_gt, cycles_2, cycles_n, non_trees, non_tree_preds, n_tokens_batch = self.model.validate(mb_inputs, mb_targets, probs, n_cycles, len_2_cycles, srl_preds, srl_logits, srl_predicates, srl_predicate_targets, pos_preds, transition_params if viterbi else None)
+    for mb_inputs, mb_targets, sents, outputs in batch_outputs:
+      probs, n_cycles, len_2_cycles, srl_preds, srl_logits, srl_correct, srl_count, srl_predicates, srl_predicate_targets, transition_params, attn_correct, pos_correct, pos_preds = outputs
+      preds, parse_time, roots_lt, roots_gt, cycles_2, cycles_n, non_trees, non_tree_preds, n_tokens_batch = self.model.validate(mb_inputs, mb_targets, probs, n_cycles, len_2_cycles, srl_preds, srl_logits, srl_predicates, srl_predicate_targets, pos_preds, transition_params if viterbi and not self.viterbi_in_graph else None)
       n_tokens += n_tokens_batch
-      for k, v in attn_weights.iteritems():
-        attention_weights["b%d:layer%d" % (batch_num, k)] = v
       for k, v in attn_correct.iteritems():
         if k not in attn_correct_counts:
           attn_correct_counts[k] = 0.
@@ -553,7 +768,19 @@ class Network(Configurable):
 
       parse_gold_fname = self.gold_dev_parse_file if validate else self.gold_test_parse_file
 
-      # write predicted parse
+      # write predicted parse, scoring it on the way. Like for srl-eval.pl,
+      # the gold parse comes from the gold file if there is one, since the
+      # data can't tell a gold root from a head pointing at its own token
+      parse_scorer = ParseScorer()
+      gold_parse = self.read_gold(parse_gold_fname, read_conll)
+      n_written = sum(self.eval_single_token_sents or len(all_sents[bkt_idx][idx]) > 1 for bkt_idx, idx in data_indices)
+      if gold_parse is not None and len(gold_parse) != n_written:
+        print("%s has %d sentences rather than %d; not using it" % (parse_gold_fname, len(gold_parse), n_written))
+        gold_parse = None
+      gold_idx = 0
+      # with eval_by_domain, each sentence also goes to its domain's file on
+      # the same pass, for bin/eval.pl to cross-check the per-domain scores
+      domain_files = {}
       parse_pred_fname = os.path.join(self.save_dir, "parse_preds.tsv")
       with open(parse_pred_fname, 'w') as f:
         for p_idx, (bkt_idx, idx) in enumerate(data_indices):
@@ -566,6 +793,7 @@ class Network(Configurable):
           # sent[:, 10] = targets[tokens, 2]  # 9 = gold parse label
           sent_len = len(words)
           if self.eval_single_token_sents or sent_len > 1:
+            sent_str = ''
             for i, (word, pred) in enumerate(zip(words, preds)):
               head = pred[8] + 1
               tok_id = i + 1
@@ -578,113 +806,148 @@ class Network(Configurable):
                 str(head if head != tok_id else 0),  # pred head
                 self.rels[pred[9]] # pred label
               )
-              f.write('%s\t%s\t_\t%s\t_\t_\t%s\t%s\n' % tup)
-            f.write('\n')
+              sent_str += '%s\t%s\t_\t%s\t_\t_\t%s\t%s\n' % tup
+            sent_str += '\n'
+            f.write(sent_str)
+            domain = self._vocabs[5][preds[0, 5]]
+            if self.eval_by_domain and self.perl_eval and domain not in self._vocabs[5].SPECIAL_TOKENS:
+              if domain not in domain_files:
+                domain_files[domain] = open(os.path.join(self.save_dir, '%s_parse_preds.tsv' % domain), 'w')
+              domain_files[domain].write(sent_str)
+            if gold_parse is not None:
+              gold_words, gold_heads, gold_rels = gold_parse[gold_idx]
+              heads = preds[:sent_len, 8] + 1
+              heads[heads == np.arange(1, sent_len+1)] = 0
+              parse_scorer.add(gold_words, heads, self.rels[preds[:sent_len, 9]], gold_heads, gold_rels, domain=domain)
+            else:
+              parse_scorer.add(words, preds[:, 8], preds[:, 9], preds[:, 10], preds[:, 11], domain=domain)
+            gold_idx += 1
+      for domain_file in domain_files.itervalues():
+        domain_file.close()
 
-      with open(os.devnull, 'w') as devnull:
-        try:
-          parse_eval = check_output(["perl", "bin/eval.pl", "-g", parse_gold_fname, "-s", parse_pred_fname], stderr=devnull)
-          short_str = parse_eval.split('\n')[:3]
-          print('\n'.join(short_str))
+      parse_eval = parse_scorer.summary()
+      print(parse_eval)
+      print('\n')
+      parse_scores = parse_scorer.scores()
+      correct['parse_eval'] = parse_eval
+      correct['LAS'] = round(parse_scores['LAS'], 2)
+      correct['UAS'] = round(parse_scores['UAS'], 2)
+      if self.eval_by_domain:
+        for d in parse_scorer.domains:
+          print('\n'.join(map(lambda s: "%s %s" % (d, s), parse_scorer.summary(d).split('\n'))))
           print('\n')
-          correct['parse_eval'] = parse_eval
-          correct['LAS'] = short_str[0].split()[9]
-          correct['UAS'] = short_str[1].split()[9]
-        except CalledProcessError as e:
-          print("Call to parse eval failed: %s" % e.output)
 
-      if self.eval_by_domain:
+      if self.perl_eval:
+        with open(os.devnull, 'w') as devnull:
+          try:
+            parse_eval = check_output(["perl", "bin/eval.pl", "-g", parse_gold_fname, "-s", parse_pred_fname], stderr=devnull)
+            short_str = parse_eval.split('\n')[:3]
+            print("bin/eval.pl:")
+            print('\n'.join(short_str))
+            print('\n')
+            correct['parse_eval'] = parse_eval
+            if abs(float(short_str[0].split()[9]) - correct['LAS']) > .01 or abs(float(short_str[1].split()[9]) - correct['UAS']) > .01:
+              print("WARNING: bin/eval.pl disagrees with the in-process parse scores")
+          except CalledProcessError as e:
+            print("Call to parse eval failed: %s" % e.output)
+
         parse_gold_fname_path = '/'.join(parse_gold_fname.split('/')[:-1])
         parse_gold_fname_end = parse_gold_fname.split('/')[-1]
-        for d in self._vocabs[5].keys():
-          if d not in self._vocabs[5].SPECIAL_TOKENS:
-            domain_gold_fname = os.path.join(parse_gold_fname_path, d + '_' + parse_gold_fname_end)
-            domain_fname = os.path.join(self.save_dir, '%s_parse_preds.tsv' % d)
-            with open(domain_fname, 'w') as f:
-              for p_idx, (bkt_idx, idx) in enumerate(data_indices):
-                preds = all_predictions[p_idx] if self.one_example_per_predicate else all_predictions[bkt_idx][idx]
-                words = all_sents[bkt_idx][idx]
-                domain = '-'
-                sent_len = len(words)
-                if self.eval_single_token_sents or sent_len > 1:
-                  for i, (word, pred) in enumerate(zip(words, preds)):
-                    domain = self._vocabs[5][pred[5]]
-                    head = pred[8] + 1
-                    tok_id = i + 1
-                    if domain == d:
-                      tup = (
-                        tok_id,  # id
-                        word,  # form
-                        self.tags[pred[7]],  # gold tag
-                        # self.tags[pred[11]] if self.joint_pos_predicates or self.train_pos else self.tags[pred[4]], # pred tag or auto tag
-                        str(head if head != tok_id else 0),  # pred head
-                        self.rels[pred[9]]  # pred label
-                      )
-                      f.write('%s\t%s\t_\t%s\t_\t_\t%s\t%s\n' % tup)
-                  if domain == d:
-                    f.write('\n')
-            with open(os.devnull, 'w') as devnull:
-              try:
-                parse_eval_d = check_output(["perl", "bin/eval.pl", "-g", domain_gold_fname, "-s", domain_fname],
-                                          stderr=devnull)
-                short_str_d = map(lambda s: "%s %s" % (d, s), parse_eval_d.split('\n')[:3])
-                print('\n'.join(short_str_d))
-                print('\n')
-                # correct['parse_eval'] = parse_eval
-                # correct['LAS'] = short_str[0].split()[9]
-                # correct['UAS'] = short_str[1].split()[9]
-              except CalledProcessError as e:
-                print("Call to eval failed: %s" % e.output)
+        for d in sorted(domain_files):
+          domain_gold_fname = os.path.join(parse_gold_fname_path, d + '_' + parse_gold_fname_end)
+          with open(os.devnull, 'w') as devnull:
+            try:
+              parse_eval_d = check_output(["perl", "bin/eval.pl", "-g", domain_gold_fname, "-s", domain_files[d].name],
+                                        stderr=devnull)
+              short_str_d = map(lambda s: "%s %s" % (d, s), parse_eval_d.split('\n')[:3])
+              print('\n'.join(short_str_d))
+              print('\n')
+            except CalledProcessError as e:
+              print("Call to eval failed: %s" % e.output)
 
     if self.eval_srl:
       # load the real gold preds file
       srl_gold_fname = self.gold_dev_props_file if validate else self.gold_test_props_file
 
-      # save SRL gold output for debugging purposes
-      srl_sanity_fname = os.path.join(self.save_dir, 'srl_sanity.tsv')
-      with open(srl_sanity_fname, 'w') as f, open(filename, 'r') as orig_f:
-        for p_idx, (bkt_idx, idx) in enumerate(data_indices):
-          # for each word, if predicate print word, otherwise -
-          # then all the SRL labels
-          data = dataset._metabucket[bkt_idx].data[idx]
-          preds = all_predictions[p_idx] if self.one_example_per_predicate else all_predictions[bkt_idx][idx]
-          # if len(preds.shape) < 2:
-          #   preds = np.reshape(preds, [1, preds.shape[0]])
-          words = all_sents[bkt_idx][idx]
-          num_gold_srls = preds[0, 13]
-          num_pred_srls = preds[0, 14]
-          srl_preds = preds[:, 15+num_pred_srls+num_gold_srls:]
-          srl_golds = preds[:, 15+num_pred_srls:15+num_gold_srls+num_pred_srls]
-          srl_preds_bio = map(lambda p: self._vocabs[3][p], srl_preds)
-          srl_preds_str = map(list, zip(*[self.convert_bilou(j) for j in np.transpose(srl_preds)]))
-          # todo if you want golds in here get it from the props file
-          # srl_golds_str = map(list, zip(*[self.convert_bilou(j) for j in np.transpose(srl_golds)]))
-          # print(srl_golds_str)
-          # print(srl_preds_str)
-          for i, (datum, word, pred) in enumerate(zip(data, words, preds)):
-            orig_line = orig_f.readline().strip()
-            while not orig_line:
-              orig_line = orig_f.readline().strip()
-            orig_split_line = orig_line.split('\t')
-            docid = orig_split_line[0]
-            sentid = orig_split_line[1]
-            domain = self._vocabs[5][pred[5]]
-            orig_pred = srl_preds_str[i] if srl_preds_str else []
-            # gold_pred = srl_golds_str[i] if srl_golds_str else []
-            bio_pred = srl_preds_bio[i] if srl_preds_bio else []
-            word_str = word
-            tag0_str = self.tags[pred[7]] # gold tag
-            tag1_str = self.tags[pred[3]] # auto tag
-            tag2_str = self.tags[pred[12]] # predicted tag
-            # gold_pred = word if np.any(["(V*" in p for p in gold_pred]) else '-'
-            pred_pred = word if np.any(["(V*" in p for p in orig_pred]) else '-'
-            # fields = (domain,) + (word_str,) + (tag0_str,) + (tag1_str,) + (tag2_str,) + (gold_pred,) + (pred_pred,) + tuple(bio_pred) + tuple(orig_pred)
-            fields = (docid,) + (sentid,) + (word_str,) + (tag0_str,) + (tag1_str,) + (tag2_str,) + (pred_pred,) + tuple(bio_pred) + tuple(orig_pred)
-            owpl_str = '\t'.join(fields)
-            f.write(owpl_str + "\n")
-          f.write('\n')
+      # the props strings of each sentence, shared by all of the writers
+      # below, and the in-process scores. The gold props come from the gold
+      # props file like they do for srl-eval.pl, since the data drops nested
+      # columns along with their predicates; without the file, the gold
+      # columns of the data stand in (except in merged
+      # one-example-per-predicate sentences, which only keep the first one)
+      gold_props = self.read_gold(srl_gold_fname, read_props)
+      if gold_props is not None and len(gold_props) != len(data_indices):
+        print("%s has %d sentences rather than %d; not using it" % (srl_gold_fname, len(gold_props), len(data_indices)))
+        gold_props = None
+      native_srl_eval = gold_props is not None or not self.one_example_per_predicate
+      srl_scorer = SRLScorer()
+      all_srl_preds = []
+      all_srl_preds_str = []
+      for p_idx, (bkt_idx, idx) in enumerate(data_indices):
+        preds = all_predictions[p_idx] if self.one_example_per_predicate else all_predictions[bkt_idx][idx]
+        num_gold_srls = preds[0, 13]
+        num_pred_srls = preds[0, 14]
+        all_srl_preds.append(preds[:, 15 + num_gold_srls + num_pred_srls:])
+        all_srl_preds_str.append(self.props_strings(all_srl_preds[-1]))
+        if gold_props is not None:
+          sent_gold_props = gold_props[p_idx][1]
+        elif native_srl_eval:
+          gold_positions = np.where(preds[:, 4] > self._vocabs[4].predicate_true_start_idx)[0]
+          gold_srls = preds[:, 15 + num_pred_srls:15 + num_pred_srls + num_gold_srls]
+          sent_gold_props = dict(zip(gold_positions, self.srl_spans(gold_srls)))
+        if native_srl_eval:
+          if self.one_example_per_predicate:
+            pred_positions = np.where(preds[:, 4] == 1)[0]
+          else:
+            pred_positions = preds[0, 15:15 + num_pred_srls]
+          srl_scorer.add(sent_gold_props,
+                         dict(zip(pred_positions, self.srl_spans(all_srl_preds[-1]))),
+                         domain=self._vocabs[5][preds[0, 5]])
 
-      # save SRL output
+      # save SRL gold output for debugging purposes (which can be skipped
+      # when validating during training)
+      if srl_sanity:
+        srl_sanity_fname = os.path.join(self.save_dir, 'srl_sanity.tsv')
+        with open(srl_sanity_fname, 'w') as f:
+          for p_idx, (bkt_idx, idx) in enumerate(data_indices):
+            # for each word, if predicate print word, otherwise -
+            # then all the SRL labels
+            data = dataset._metabucket[bkt_idx].get_data(idx)
+            preds = all_predictions[p_idx] if self.one_example_per_predicate else all_predictions[bkt_idx][idx]
+            # if len(preds.shape) < 2:
+            #   preds = np.reshape(preds, [1, preds.shape[0]])
+            words = all_sents[bkt_idx][idx]
+            num_gold_srls = preds[0, 13]
+            num_pred_srls = preds[0, 14]
+            srl_preds = all_srl_preds[p_idx]
+            srl_golds = preds[:, 15+num_pred_srls:15+num_gold_srls+num_pred_srls]
+            srl_preds_bio = self._srl_label_table['strings'][srl_preds].tolist()
+            srl_preds_str = all_srl_preds_str[p_idx]
+            # todo if you want golds in here get it from the props file
+            # srl_golds_str = map(list, zip(*[self.convert_bilou(j) for j in np.transpose(srl_golds)]))
+            # print(srl_golds_str)
+            # print(srl_preds_str)
+            docid, sentid = dataset.sent_ids(preds[0, 6])
+            for i, (datum, word, pred) in enumerate(zip(data, words, preds)):
+              domain = self._vocabs[5][pred[5]]
+              orig_pred = srl_preds_str[i] if srl_preds_str else []
+              # gold_pred = srl_golds_str[i] if srl_golds_str else []
+              bio_pred = srl_preds_bio[i] if srl_preds_bio else []
+              word_str = word
+              tag0_str = self.tags[pred[7]] # gold tag
+              tag1_str = self.tags[pred[3]] # auto tag
+              tag2_str = self.tags[pred[12]] # predicted tag
+              # gold_pred = word if np.any(["(V*" in p for p in gold_pred]) else '-'
+              pred_pred = word if np.any(["(V*" in p for p in orig_pred]) else '-'
+              # fields = (domain,) + (word_str,) + (tag0_str,) + (tag1_str,) + (tag2_str,) + (gold_pred,) + (pred_pred,) + tuple(bio_pred) + tuple(orig_pred)
+              fields = (docid,) + (sentid,) + (word_str,) + (tag0_str,) + (tag1_str,) + (tag2_str,) + (pred_pred,) + tuple(bio_pred) + tuple(orig_pred)
+              owpl_str = '\t'.join(fields)
+              f.write(owpl_str + "\n")
+            f.write('\n')
+
+      # save SRL output, and with eval_by_domain each sentence to its
+      # domain's file too, for bin/srl-eval.pl's per-domain cross-check
+      domain_files = {}
       srl_preds_fname = os.path.join(self.save_dir, 'srl_preds.tsv')
       # print("writing srl preds file: %s" % srl_preds_fname)
       with open(srl_preds_fname, 'w') as f:
@@ -698,7 +961,6 @@ class Network(Configurable):
           # print("preds", preds)
           num_gold_srls = preds[0, 13]
           num_pred_srls = preds[0, 14]
-          srl_preds = preds[:, 15 + num_gold_srls + num_pred_srls:]
           if self.one_example_per_predicate:
             # srl_preds = preds[:, 14 + num_gold_srls + num_pred_srls:]
             predicate_indices = np.where(preds[:, 4] == 1)[0]
@@ -706,7 +968,7 @@ class Network(Configurable):
           else:
             predicate_indices = preds[0, 15:15+num_pred_srls]
           # print("predicate indices", predicate_indices)
-          srl_preds_str = map(list, zip(*[self.convert_bilou(j) for j in np.transpose(srl_preds)]))
+          srl_preds_str = all_srl_preds_str[p_idx]
           # if len(predicate_indices) == 0:
           # if preds[0,6] < 4:
           #   print("preds", preds)
@@ -714,71 +976,61 @@ class Network(Configurable):
           #   print("srl_preds_str", srl_preds_str)
           #   print("srl_preds", srl_preds)
           #   print("words", words)
+          sent_str = ''
           for i, word in enumerate(words):
             pred = srl_preds_str[i] if srl_preds_str else []
             word_str = word if i in predicate_indices else '-'
             fields = (word_str,) + tuple(pred)
             owpl_str = '\t'.join(fields)
-            f.write(owpl_str + "\n")
-          if not self.parens_check(np.transpose(srl_preds_str)):
-            print(np.transpose(srl_preds_str))
-            print(map(lambda i: self._vocabs[3][i], np.transpose(srl_preds)))
-          f.write('\n')
+            sent_str += owpl_str + "\n"
+          sent_str += '\n'
+          f.write(sent_str)
+          domain = self._vocabs[5][preds[0, 5]]
+          if self.eval_by_domain and self.perl_eval and domain not in self._vocabs[5].SPECIAL_TOKENS:
+            if domain not in domain_files:
+              domain_files[domain] = open(os.path.join(self.save_dir, '%s_srl_preds.tsv' % domain), 'w')
+            domain_files[domain].write(sent_str)
+      for domain_file in domain_files.itervalues():
+        domain_file.close()
 
       srl_acc = (srl_correct_total / srl_count_total)*100.0
 
-      with open(os.devnull, 'w') as devnull:
-        try:
-          srl_eval = check_output(["perl", "bin/srl-eval.pl", srl_gold_fname, srl_preds_fname], stderr=devnull)
-          print(srl_eval)
-          overall_f1 = float(srl_eval.split('\n')[6].split()[-1])
-          correct['F1'] = overall_f1
-        except CalledProcessError as e:
-          print("Call to eval failed: %s" % e.output)
+      if native_srl_eval:
+        print(srl_scorer.summary())
+        correct['F1'] = round(srl_scorer.scores()['F1'], 2)
+        if self.eval_by_domain:
+          for d in srl_scorer.domains:
+            print("%sSRL %s:" % ("viterbi " if viterbi else "", d))
+            print(srl_scorer.summary(d).split('\n')[6])
+      else:
+        print("No gold props to score SRL against")
+
+      if self.perl_eval:
+        with open(os.devnull, 'w') as devnull:
+          try:
+            srl_eval = check_output(["perl", "bin/srl-eval.pl", srl_gold_fname, srl_preds_fname], stderr=devnull)
+            print("bin/srl-eval.pl:")
+            print(srl_eval)
+            overall_f1 = float(srl_eval.split('\n')[6].split()[-1])
+            if abs(overall_f1 - correct['F1']) > .01:
+              print("WARNING: bin/srl-eval.pl disagrees with the in-process SRL scores")
+          except CalledProcessError as e:
+            print("Call to eval failed: %s" % e.output)
 
-      if self.eval_by_domain:
         srl_gold_fname_path = '/'.join(srl_gold_fname.split('/')[:-1])
         srl_gold_fname_end = srl_gold_fname.split('/')[-1]
-        for d in self._vocabs[5].keys():
-          if d not in self._vocabs[5].SPECIAL_TOKENS:
-            domain_gold_fname = os.path.join(srl_gold_fname_path, d + '_' + srl_gold_fname_end)
-            domain_fname = os.path.join(self.save_dir, '%s_srl_preds.tsv' % d)
-            with open(domain_fname, 'w') as f:
-              for p_idx, (bkt_idx, idx) in enumerate(data_indices):
-                # for each word, if predicate print word, otherwise -
-                # then all the SRL labels
-                # data = dataset._metabucket[bkt_idx].data[idx]
-                preds = all_predictions[p_idx] if self.one_example_per_predicate else all_predictions[bkt_idx][idx]
-                words = all_sents[bkt_idx][idx]
-                num_gold_srls = preds[0, 13]
-                num_pred_srls = preds[0, 14]
-                srl_preds = preds[:, 15 + num_gold_srls + num_pred_srls:]
-                predicate_indices = preds[:, 15:15 + num_pred_srls]
-                srl_preds_str = map(list, zip(*[self.convert_bilou(j) for j in np.transpose(srl_preds)]))
-                domain = '-'
-                for i, (word, p) in enumerate(zip(words, preds)):
-                  domain = self._vocabs[5][p[5]]
-                  if domain == d:
-                    pred = srl_preds_str[i] if srl_preds_str else []
-                    word_str = word if i in predicate_indices else '-'
-                    fields = (word_str,) + tuple(pred)
-                    owpl_str = '\t'.join(fields)
-                    f.write(owpl_str + "\n")
-                if not self.parens_check(np.transpose(srl_preds_str)):
-                  print(np.transpose(srl_preds_str))
-                  print(map(lambda i: self._vocabs[3][i], np.transpose(srl_preds)))
-                if domain == d:
-                  f.write('\n')
-            with open(os.devnull, 'w') as devnull:
-              try:
-                srl_eval_d = check_output(["perl", "bin/srl-eval.pl", domain_gold_fname, domain_fname], stderr=devnull)
-                # print(srl_eval)
-                str_d = srl_eval_d.split('\n')[6]
-              except CalledProcessError as e:
-                print("Call to eval failed: %s" % e.output)
-                str_d = ""
-            print("%sSRL %s:" % ("viterbi " if viterbi else "", d))
-            print(str_d)
+        for d in sorted(domain_files):
+          domain_gold_fname = os.path.join(srl_gold_fname_path, d + '_' + srl_gold_fname_end)
+          with open(os.devnull, 'w') as devnull:
+            try:
+              srl_eval_d = check_output(["perl", "bin/srl-eval.pl", domain_gold_fname, domain_files[d].name], stderr=devnull)
+              # print(srl_eval)
+              str_d = srl_eval_d.split('\n')[6]
+            except CalledProcessError as e:
+              print("Call to eval failed: %s" % e.output)
+              str_d = ""
+          print("%sSRL %s:" % ("viterbi " if viterbi else "", d))
+          print(str_d)
 
       # with open(os.path.join(self.save_dir, 'scores.txt'), 'a') as f:
       #   s, correct = self.model.evaluate(os.path.join(self.save_dir, os.path.basename(filename)), punct=self.model.PUNCT)
@@ -793,10 +1045,6 @@ class Network(Configurable):
         multitask_uas_str += '\t%s UAS: %.2f' % (k, attn_correct_counts[k] * 100)
       print(multitask_uas_str)
 
-    if self.save_attn_weights:
-      attention_weights = {str(k): v for k, v in attention_weights.iteritems()}
-      np.savez(os.path.join(self.save_dir, 'attention_weights'), **attention_weights)
-
     pos_accuracy = (pos_correct_total/n_tokens)*100.0
     correct['POS'] = pos_accuracy
     # if validate:
@@ -894,37 +1142,29 @@ class Network(Configurable):
                        valid_output['n_correct'],
                        valid_output['n_tokens'],
                        valid_output['predictions']]
-    ops['test_op'] = [valid_output['probabilities'],
-                      valid_output['n_cycles'],
-                      valid_output['len_2_cycles'],
-                      valid_output['srl_probs'],
-                      valid_output['srl_preds'],
-                      valid_output['srl_logits'],
-                      valid_output['srl_correct'],
-                      valid_output['srl_count'],
-                      valid_output['srl_predicates'],
-                      valid_output['srl_predicate_targets'],
-                      valid_output['transition_params'],
-                      valid_output['attn_weights'],
-                      valid_output['attn_correct'],
-                      valid_output['pos_correct'],
-                      valid_output['pos_preds'],
-                      test_output['probabilities'],
-                      test_output['n_cycles'],
-                      test_output['len_2_cycles'],
-                      test_output['srl_probs'],
-                      test_output['srl_preds'],
-                      test_output['srl_logits'],
-                      test_output['srl_correct'],
-                      test_output['srl_count'],
-                      test_output['srl_predicates'],
-                      test_output['srl_predicate_targets'],
-                      test_output['transition_params'],
-                      test_output['attn_weights'],
-                      test_output['attn_correct'],
-                      test_output['pos_correct'],
-                      test_output['pos_preds'],
-                      ]
+    def test_fetches(output, viterbi):
+      # the probabilities are only needed to repair trees, and the srl logits
+      # and transitions to run viterbi, on the host; otherwise fetch the
+      # predictions the graph has already made
+      host_viterbi = viterbi and not self.viterbi_in_graph
+      return [output['probabilities'] if self.ensure_tree else output['parse_preds'],
+              output['n_cycles'],
+              output['len_2_cycles'],
+              output['srl_viterbi_preds'] if viterbi and self.viterbi_in_graph else output['srl_preds'],
+              output['srl_logits'] if host_viterbi else tf.constant(0.),
+              output['srl_correct'],
+              output['srl_count'],
+              output['srl_predicates'],
+              output['srl_predicate_targets'],
+              output['transition_params'] if host_viterbi else tf.constant(0.),
+              output['attn_correct'],
+              output['pos_correct'],
+              output['pos_preds']]
+    # [validation fetches, test fetches]
+    ops['test_op'] = [test_fetches(valid_output, False), test_fetches(test_output, False)]
+    ops['test_op_viterbi'] = [test_fetches(valid_output, True), test_fetches(test_output, True)]
+    # only built with save_attn_weights
+    ops['attn_weights'] = [valid_output.get('attn_weights'), test_output.get('attn_weights')]
     # ops['optimizer'] = optimizer
     
     return ops
@@ -21,6 +21,7 @@ from __future__ import print_function
 
 import os
 import sys
+import functools
 from collections import Counter
 
 import numpy as np
@@ -47,6 +48,7 @@ class Vocab(Configurable):
     self._conll_idx = conll_idx
     # global_step = kwargs.pop('global_step', None)
     cased = kwargs.pop('cased', None)
+    counts = kwargs.pop('counts', None)
     self._use_pretrained = kwargs.pop('use_pretrained', False)
     super(Vocab, self).__init__(*args, **kwargs)
 
@@ -87,7 +89,7 @@ class Vocab(Configurable):
     if os.path.isfile(self.vocab_file):
       self.load_vocab_file()
     else:
-      self.add_train_file()
+      self.add_train_file(counts)
       self.save_vocab_file()
     if self.use_pretrained:
       self.load_embed_file()
@@ -172,70 +174,75 @@ class Vocab(Configurable):
     return partial
   
   #=============================================================
-  def add_train_file(self):
+  def add_train_file(self, counts=None):
     """"""
-    counts = Counter()
-
-    with open(self.train_file, 'r') as f:
-      buff = []
-      for line_num, line in enumerate(f):
-        line = line.strip().split()
-        # print(line)
-        if line and (not self.train_domains_set or line[0].split('/')[0] in self.train_domains_set or self.name == "Tags"):
-          if self.conll and len(line) == 10:
-            if hasattr(self.conll_idx, '__iter__'):
-              for idx in self.conll_idx:
-                self.add(counts, line[idx])
-            else:
-              self.add(counts, line[self.conll_idx])
-          elif self.conll2012: #and len(line) > 1:
-            if hasattr(self.conll_idx, '__iter__'):
-              if self.name == "Predicates":
-                actual = "False" if line[self.conll_idx[0]] == '-' else "True"
-                actual = actual + "/" + line[self.conll_idx[1]]
-                self.add(counts, actual)
-              else:
-                for idx in self.conll_idx:
-                  if idx < len(line) and (self.name != 'SRLs' or (idx != len(line)-1 and (self.train_on_nested or '/' not in line[idx]))):
-                    # print("adding ", line[idx])
-                    self.add(counts, line[idx])
-            else:
-              if self.name == "Predicates":
-                actual = "False" if line[self.conll_idx] == '-' else "True"
-                self.add(counts, actual)
-              elif self.name == "Domains":
-                actual = line[self.conll_idx].split('/')[0]
-                self.add(counts, actual)
-              else:
-                self.add(counts, line[self.conll_idx])
-          else:
-            print('The training file is misformatted at line %d (had %d columns, expected %d)' % (line_num+1, len(line), 13))
-
-      # # add all the labels
-      # if self.name == "SRLs":
-      #   with open(self.valid_file, 'r') as f:
-      #     for line_num, line in enumerate(f):
-      #       line = line.strip().split()
-      #       if line:
-      #         if hasattr(self.conll_idx, '__iter__'):
-      #           for idx in self.conll_idx:
-      #             if idx < len(line)-1 and (self.train_on_nested or '/' not in line[idx]):
-      #               # print("adding ", line[idx])
-      #               self.add(counts, line[idx])
-      #   with open(self.test_file, 'r') as f:
-      #     for line_num, line in enumerate(f):
-      #       line = line.strip().split()
-      #       if line:
-      #         if hasattr(self.conll_idx, '__iter__'):
-      #           for idx in self.conll_idx:
-      #             if idx < len(line)-1 and (self.train_on_nested or '/' not in line[idx]):
-      #               # print("adding ", line[idx])
-      #               self.add(counts, line[idx])
-
-
+    
+    if counts is None:
+      counts = self.count_train_file(self._config, [(self.name, self.conll_idx, self.cased)])[0]
     self._counts = counts
     self._str2idx, self._idx2str = self.index_vocab_joint(counts) if self.joint_pos_predicates and self.name == "Predicates" else self.index_vocab(counts)
     return
+  
+  #=============================================================
+  @classmethod
+  def count_train_file(cls, config, specs):
+    """
+      Counts the training file for several vocabs in a single pass, where specs
+      holds a (name, conll_idx, cased) triple for each of them. The file is split
+      on sentence boundaries and counted by n_load_workers processes.
+    """
+    
+    from lib.etc.shards import map_shards
+    options = Configurable(config)
+    shard_counts = map_shards(functools.partial(cls._count_shard, options, specs), options.train_file, options.n_load_workers)
+    counts = [Counter() for spec in specs]
+    for shard in shard_counts:
+      for vocab_counts, vocab_shard_counts in zip(counts, shard):
+        vocab_counts.update(vocab_shard_counts)
+    return counts
+  
+  #=============================================================
+  @staticmethod
+  def _count_shard(options, specs, filename, start, stop):
+    """"""
+    
+    from lib.etc.shards import iter_lines
+    conll, conll2012 = options.conll, options.conll2012
+    train_on_nested = options.train_on_nested
+    train_domains_set = set(options.train_domains.split(',')) if options.train_domains != '-' else set()
+    counts = [Counter() for spec in specs]
+    
+    for line_num, line in enumerate(iter_lines(filename, start, stop)):
+      line = line.strip().split()
+      if not line:
+        continue
+      if not (conll and len(line) == 10) and not conll2012:
+        print('The training file is misformatted at line %d%s (had %d columns, expected %d)' % (line_num+1, ' of the shard at byte %d' % start if start else '', len(line), 13))
+        continue
+      in_domain = not train_domains_set or line[0].split('/')[0] in train_domains_set
+      for (name, conll_idx, cased), vocab_counts in zip(specs, counts):
+        if not (in_domain or name in ("Tags", "Domains")):
+          continue
+        if conll and len(line) == 10:
+          if hasattr(conll_idx, '__iter__'):
+            words = [line[idx] for idx in conll_idx]
+          else:
+            words = [line[conll_idx]]
+        elif hasattr(conll_idx, '__iter__'):
+          if name == "Predicates":
+            words = [("False" if line[conll_idx[0]] == '-' else "True") + "/" + line[conll_idx[1]]]
+          else:
+            words = [line[idx] for idx in conll_idx if idx < len(line) and (name != 'SRLs' or (idx != len(line)-1 and (train_on_nested or '/' not in line[idx])))]
+        else:
+          if name == "Predicates":
+            words = ["False" if line[conll_idx] == '-' else "True"]
+          elif name == "Domains":
+            words = [line[conll_idx].split('/')[0]]
+          else:
+            words = [line[conll_idx]]
+        for word in words:
+          vocab_counts[word if cased else word.lower()] += 1
+    return counts
 
   #=============================================================
   def load_embed_file(self):
@@ -303,7 +310,17 @@ class Vocab(Configurable):
     """"""
     
     return self._embed2str[key]
-  
+
+  #=============================================================
+  def index_array(self, keys):
+    """"""
+
+    # look up each distinct string once and broadcast back with the inverse index
+    n_cols = 2 if self.use_pretrained else 1
+    uniq, inverse = np.unique(np.asarray(keys), return_inverse=True)
+    idxs = np.array([self[key] for key in uniq], dtype=np.int32).reshape(len(uniq), n_cols)
+    return idxs[inverse]
+
   #=============================================================
   def _finalize(self):
     """"""